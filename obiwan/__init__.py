@@ -1,18 +1,151 @@
-import weakref
-import inspect
-import gc
-import types
-import opcode
-import decimal
+import _thread
 import atexit
+import itertools
+import math
+import operator
+import os
 import sys
-import collections.abc
+import time
+
+
+class _lazy_module:
+    """stands in for a module until it is first used, when it is imported and replaces the global
+    bound to this, so that import obiwan only pays for the modules the features in use need"""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = __import__(self._name)  # like import a.b, this returns a with a.b imported
+        for key, value in list(globals().items()):
+            if value is self:
+                globals()[key] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazily imported module %r>" % (self._name,)
+
+
+collections = _lazy_module("collections.abc")
+decimal = _lazy_module("decimal")
+functools = _lazy_module("functools")
+gc = _lazy_module("gc")
+importlib = _lazy_module("importlib")
+inspect = _lazy_module("inspect")
+opcode = _lazy_module("opcode")
+random = _lazy_module("random")
+types = _lazy_module("types")
+weakref = _lazy_module("weakref")
 
 _enabled = False
+_disabled = os.environ.get("OBIWAN_DISABLED", "") not in ("", "0")  # see configure()
+_profiler = None  # the obiwan.profiling.Profiler gathering statistics, if enabled
 
 
 class ObiwanError(Exception):
-    "Thrown by Obiwan checker if a function call or object definition does not match at runtime"
+    """Thrown by Obiwan checker if a function call or object definition does not match at runtime
+
+    The checkers raise these with a message relative to the failing object, and the path
+    to it is recorded as the error propagates; the context string is only rendered if you
+    actually look at the error.  path is a tuple of the dict keys and list indices from
+    the root object to the failing object, and ctx is the description of the root.
+    offset is the byte offset of the failing value when validating a stream, else None.
+    sampled is the indexes a spotcheck looked at of the container the failing object is in, else None"""
+    sampled = None
+
+    def __init__(self, message, ctx=None):
+        super().__init__(message)
+        self.message = message
+        self.ctx = ctx
+        self.offset = None
+        self._segments = []  # (format, key) innermost first
+
+    def _at(self, fmt, key):
+        "records that the error happened inside key of the enclosing object"
+        self._segments.append((fmt, key))
+        return self
+
+    @property
+    def path(self):
+        return tuple(key for fmt, key in reversed(self._segments) if fmt is not _TEXT)
+
+    def __str__(self):
+        rendered = "" if self.ctx is None else str(self.ctx)
+        for fmt, key in reversed(self._segments):
+            rendered = fmt % (rendered, key)
+        if rendered and not self.message.startswith(" "):
+            rendered = "%s %s" % (rendered, self.message)
+        else:
+            rendered += self.message
+        if self.offset is not None:
+            rendered += " (at byte offset %d)" % self.offset
+        return rendered
+
+
+class _ObiwanErrors(ObiwanError):
+    """the errors found so far in a container, when validate() is collecting errors;
+    the path is added to each of them as this propagates"""
+    def __init__(self, errors):
+        super().__init__(" has %d errors" % len(errors))
+        self.errors = errors
+
+    def _at(self, fmt, key):
+        for error in self.errors:
+            error._at(fmt, key)
+        return self
+
+    @property
+    def ctx(self):
+        return None
+
+    @ctx.setter
+    def ctx(self, ctx):
+        for error in getattr(self, "errors", ()):
+            if error.ctx is None:
+                error.ctx = ctx
+
+    def __str__(self):
+        return "\n".join(map(str, self.errors))
+
+
+class _Collector(_thread._local):  # threading.local, without importing threading
+    max_errors = None  # set while validate() is collecting errors
+    count = 0  # the errors collected so far
+
+
+_collector = _Collector()
+
+
+def _failed(errors, e):
+    """called with the ObiwanError of a child and the errors of its siblings so far, if any;
+    raises it, unless validate() is collecting errors, when it returns the errors so far.
+    Once max_errors have been collected, raises them all"""
+    if _collector.max_errors is None:
+        raise e
+    if isinstance(e, _ObiwanErrors):
+        found = e.errors
+    else:
+        found = [e]
+        _collector.count += 1
+    errors = found if errors is None else errors + found
+    if _collector.count >= _collector.max_errors:
+        raise _ObiwanErrors(errors)
+    return errors
+
+
+def _check_items(check, items, fmt):
+    "checks each (key, item) of items, carrying on past failures when validate() is collecting errors"
+    errors = None
+    key = None
+    items = iter(items)
+    while True:
+        try:
+            for key, item in items:
+                check(item)
+            break
+        except ObiwanError as e:
+            errors = _failed(errors, e._at(fmt, key))  # and carry on with the next item
+    if errors is not None:
+        raise _ObiwanErrors(errors)
 
 
 class ObiwanCheck:
@@ -22,30 +155,88 @@ class ObiwanCheck:
         raise NotImplementedError("subclasses of ObiwanCheck must override check()")
 
 
+def _class_attribute(kind, name):
+    "the attribute name as found on class kind or its bases, without invoking descriptors"
+    for klass in kind.__mro__:
+        attr = klass.__dict__.get(name, _missing)
+        if attr is not _missing:
+            return attr
+    return _missing
+
+
+def _class_level_attribute(kind, name, instance_dict):
+    """the class attribute that getattr(obj, name) comes from, if it behaves the same for every
+    instance and can't be changed in place e.g. methods and immutable values, but not properties
+    or lists; else _missing"""
+    if kind.__getattribute__ is not object.__getattribute__ or (instance_dict is not None and name in instance_dict):
+        return _missing
+    attr = _class_attribute(kind, name)
+    if isinstance(attr, (types.FunctionType, staticmethod, classmethod, types.BuiltinFunctionType)) or \
+            (not hasattr(type(attr), "__get__") and _is_immutable(attr)):
+        return attr
+    return _missing
+
+
 class duck(ObiwanCheck):
-    "something that has specified attributes"
+    """something that has specified attributes;
+    attributes that come from the class, such as methods, are checked once per class"""
     def __init__(self, *extends, **attributes):
-        duckable(extends, [lambda obj: isinstance(obj, duck)], "duckable template extends")
+        _pin(_DUCK_EXTENDS).check(extends, "duckable template extends")
         self.extends = extends
         self.attributes = attributes
+        # class -> {name: the class attribute that was found to match}; if a class is changed
+        # then the attribute found won't be the one remembered, and it is checked again
+        self._class_checked = weakref.WeakKeyDictionary()
 
     def check(self, obj, ctx, checked=None):
         if checked is None and self.extends:
             checked = set()
+        errors = None
+        kind = type(obj)
+        class_checked = self._class_checked.get(kind)
+        instance_dict = getattr(obj, "__dict__", None)
+        if not isinstance(instance_dict, dict):
+            instance_dict = None
         for name, value in self.attributes.items():
             if checked is not None:
                 if name in checked:
                     continue
                 checked.add(name)
+            if class_checked is not None:
+                attr = class_checked.get(name, _missing)
+                if attr is not _missing and _class_attribute(kind, name) is attr and \
+                        (instance_dict is None or name not in instance_dict):
+                    continue
             if isinstance(value, optional):
                 if not hasattr(obj, name):
                     continue
-                value = value.template
+                value = value.key
             if not hasattr(obj, name):
-                raise ObiwanError("%s does not have a %s" % (ctx, name))
-            duckable(getattr(obj, name), value, "%s.%s" % (ctx, name))
+                errors = _failed(errors, ObiwanError("%s does not have a %s" % (ctx, name)))
+                continue
+            try:
+                compile(value)._check(getattr(obj, name))
+            except ObiwanError as e:
+                e._at(_ATTRIBUTE, name)
+                if e.ctx is None:
+                    e.ctx = ctx
+                errors = _failed(errors, e)
+                continue
+            attr = _class_level_attribute(kind, name, instance_dict)
+            if attr is not _missing:
+                if class_checked is None:
+                    try:
+                        class_checked = self._class_checked.setdefault(kind, {})
+                    except TypeError:  # can't be weakly referenced
+                        class_checked = {}
+                class_checked[name] = attr
         for parent in self.extends:
-            parent.check(obj, ctx, checked)
+            try:
+                parent.check(obj, ctx, checked)
+            except ObiwanError as e:
+                errors = _failed(errors, e)
+        if errors is not None:
+            raise _ObiwanErrors(errors)
 
 
 class function(ObiwanCheck):
@@ -68,14 +259,33 @@ class function(ObiwanCheck):
         self.ellipsis = args.count(Ellipsis)
         if self.ellipsis:
             if self.ellipsis != 1:
-                raise ObiwanError("bad template: %s ellipsis can only occur at end of function types" % args)
+                raise ObiwanError("bad template: %s ellipsis can only occur at end of function types" % (args,))
             if args[-1] != Ellipsis:
-                raise ObiwanError("bad template: %s ellipsis can only occur at end of function types" % args)
+                raise ObiwanError("bad template: %s ellipsis can only occur at end of function types" % (args,))
             self.args = args[:-1]
         else:
             self.args = args
+        # the functions that have passed, and their code when they did; and the same for bound methods,
+        # which are made afresh each time they are looked up, by their underlying function
+        self._passed = weakref.WeakKeyDictionary()
+        self._passed_bound = weakref.WeakKeyDictionary()
 
     def check(self, obj, ctx):
+        func = getattr(obj, "__func__", obj)
+        passed = self._passed if func is obj else self._passed_bound
+        try:
+            if passed.get(func, _missing) is getattr(func, "__code__", None):
+                return
+        except TypeError:  # unhashable
+            passed = None
+        self._check_signature(obj, ctx)
+        if passed is not None:
+            try:
+                passed[func] = getattr(func, "__code__", None)
+            except TypeError:  # can't be weakly referenced
+                pass
+
+    def _check_signature(self, obj, ctx):
         self.check_is_function(obj, ctx)
         try:
             args = inspect.getfullargspec(obj)
@@ -121,6 +331,49 @@ class DecimalCheck(ObiwanCheck):
             raise ObiwanError("%s is %s but should be a string containing a decimal value" % (ctx, type(s)))
 
 
+class RangeCheck(ObiwanCheck):
+    """an example check that ensures values are numbers within bounds;
+    lists of these, including numpy arrays, are checked in bulk"""
+    def __init__(self, minimum=None, maximum=None, types=(int, float)):
+        self.minimum, self.maximum, self.types = minimum, maximum, types
+
+    def check(self, x, ctx):
+        if not isinstance(x, self.types):
+            raise ObiwanError("%s is %s but should be one of %s" % (ctx, type(x), self.types))
+        if self.minimum is not None and not x >= self.minimum:
+            raise ObiwanError("%s is %s, but must be at least %s" % (ctx, x, self.minimum))
+        if self.maximum is not None and not x <= self.maximum:
+            raise ObiwanError("%s is %s, but must be at most %s" % (ctx, x, self.maximum))
+
+    def check_many(self, seq):
+        "the index of the first item that fails, or None; lists of ObiwanChecks use this if it exists"
+        numpy = sys.modules.get("numpy")
+        if numpy is not None and isinstance(seq, numpy.ndarray):
+            if seq.ndim != 1 or seq.dtype.kind not in "iuf" or not issubclass(
+                    {"f": float}.get(seq.dtype.kind, int), self.types):
+                return 0 if len(seq) else None
+            bad = numpy.zeros(len(seq), dtype=bool)
+            if self.minimum is not None:
+                bad |= seq < self.minimum
+            if self.maximum is not None:
+                bad |= seq > self.maximum
+            if seq.dtype.kind == "f":
+                bad |= numpy.isnan(seq)
+            bad = numpy.flatnonzero(bad)
+            return int(bad[0]) if len(bad) else None
+        if not len(seq):
+            return None
+        kinds = set(map(type, seq))
+        if all(issubclass(t, self.types) for t in kinds) and not (
+                any(issubclass(t, float) for t in kinds) and any(map(math.isnan, seq))) and not (
+                (self.minimum is not None and min(seq) < self.minimum) or
+                (self.maximum is not None and max(seq) > self.maximum)):
+            return None
+        minimum, maximum, types = self.minimum, self.maximum, self.types  # some fail, so find the first
+        return next((i for i, x in enumerate(seq) if not isinstance(x, types) or
+            (minimum is not None and not x >= minimum) or (maximum is not None and not x <= maximum)), None)
+
+
 class optional:
     def __init__(self, key):
         self.key = key
@@ -135,15 +388,66 @@ class noneable:
         self.template = template
 
 
+class union:
+    """a template that matches any of its alternatives, like a set of them, but the alternatives can be
+    dicts and lists too.  With a discriminator key, the dict alternatives that have a str at that key
+    e.g. {"type": "login", ...} are chosen by the value of that key in the object being checked"""
+    def __init__(self, *alternatives, discriminator=None):
+        self.alternatives = alternatives
+        self.discriminator = discriminator
+    def __repr__(self):
+        args = [repr(alternative) for alternative in self.alternatives]
+        if self.discriminator is not None:
+            args.append("discriminator=%r" % (self.discriminator,))
+        return "union(%s)" % ", ".join(args)
+
+
+class spotcheck:
+    """a [T] list, {K: V} dict or {T} set template whose items are spot-checked when there are lots
+    of them: the first items, the last items and a random sample of the others, so checking costs
+    the same however big the container is.  The type of the container is always checked.  Pass a
+    seed to sample the same items every time.  indexes() gives the indexes, in iteration order, that
+    are checked of a container of a given size, and the errors found carry them as sampled"""
+    def __init__(self, template, first=10, last=10, sample=100, seed=None):
+        self.template = template
+        self.first, self.last, self.sample, self.seed = first, last, sample, seed
+
+    def indexes(self, size):
+        "the sorted indexes to check of a container of size items, or None for all of them"
+        first, last = self.first, self.last
+        if size <= first + last + self.sample:
+            return None
+        # a fresh generator for each check, so that checks in different threads don't share its state
+        sampler = random if self.seed is None else random.Random(self.seed)
+        middle = sampler.sample(range(first, size - last), self.sample)
+        middle.sort()
+        return list(range(first)) + middle + list(range(size - last, size))
+
+    def __repr__(self):
+        return "spotcheck(%r, first=%d, last=%d, sample=%d)" % (self.template, self.first, self.last, self.sample)
+
+
 number = {int, float}  # a type that is a number
 
+_missing = object()  # marker for absent dict children
+
+
+class _marker:
+    "a unique marker object that survives pickling, so templates can be sent to other processes"
+    def __init__(self, name):
+        self.name = name
+    def __reduce__(self):
+        return self.name  # i.e. the module global of this name
+    def __repr__(self):
+        return "obiwan." + self.name
 
-options = object() # marker for dict templates e.g. { options: [strict]
-strict = object() # attribute for dict template options
+
+options = _marker("options") # marker for dict templates e.g. { options: [strict]
+strict = _marker("strict") # attribute for dict template options
 
 class subtype:
     def __init__(self, *types):
-        duckable(types, [dict], "subtype constructor")
+        _pin(_SUBTYPE_TYPES).check(types, "subtype constructor")
         self.types = types
     def template(self):
         template = {}
@@ -204,118 +508,1074 @@ def _check_function_template(obj, template, ctx=""):
         duckable(g.annotation, e.annotation, "%s function %s parameter %d" % (ctx, got, i))
     
 
-def duckable(obj, template, ctx="checking"):
+# path segment formats; an ObiwanError renders its ctx by applying these outermost first
+_CHILD = "%s[\"%s\"]"
+_INDEX = "%s[%s]"
+_ATTRIBUTE = "%s.%s"
+_KEY = "key %s[%s]"
+_KEY_CHILD = "key %s[\"%s\"]"
+_TEXT = "%s%s"  # ctx text from a nested check; not part of the path
+_ANY_INDEX = "*"
+
+
+def _accept(obj):
+    pass
+
+
+def _check_none(obj):
+    if obj is not None:
+        raise ObiwanError(" is %s but should be None" % type(obj))
+
+
+def _bad_template(message):
+    "a checker for a template that cannot be satisfied; the error is reported when it is used, not compiled"
+    def check_bad_template(obj):
+        raise ObiwanError(" " + message)
+    return check_bad_template
+
+
+def _compile_type(template):
+    if isinstance(template, type):
+        def check_type(obj):
+            if not isinstance(obj, template):
+                raise ObiwanError(" is %s but should be %s" % (type(obj), template))
+        return check_type
+    def check_type_like(obj):
+        try:
+            if isinstance(obj, template):
+                return
+        except TypeError:
+            raise ObiwanError(" template %s is not a valid type template" % (template,))
+        raise ObiwanError(" is %s but should be %s" % (type(obj), template))
+    return check_type_like
+
+
+def _compile_custom(check):
+    """custom checks format their own messages from the ctx they are given;
+    they are given an empty ctx, which the path is prepended to if they fail"""
+    def check_custom(obj):
+        try:
+            check(obj, "")
+        except ObiwanError as e:
+            for error in getattr(e, "errors", (e,)):
+                if error.ctx is not None:  # from a nested duckable(); its ctx is relative to here
+                    if error.ctx:
+                        error._at(_TEXT, error.ctx)
+                    error.ctx = None
+            raise
+        except Exception as e:  # user code can throw anything
+            raise ObiwanError(" internal error: %s" % e)
+    return check_custom
+
+
+def _check_is_function(obj):
+    function.check_is_function(obj, "")
+
+
+def _compile_lambda(template):
+    def check_lambda(obj):
+        try:
+            ok = template(obj)
+        except Exception as e:
+            raise ObiwanError(" internal error: %s" % e)
+        if not ok:
+            raise ObiwanError(" failed lambda check")
+    return check_lambda
+
+
+def _compile_set(template, timed=None):
+    if len(template) == 1:  # we expect a set, all of a particular type
+        typ = tuple(template)[0]
+        check_item = _compile_child(typ, _INDEX, _ANY_INDEX, timed)
+        def check_set_of(obj):
+            if not isinstance(obj, set):
+                raise ObiwanError(" is %s but should be a set of %s" % (type(obj), typ))
+            _check_items(check_item, enumerate(obj), _INDEX)
+        return check_set_of
+    return _compile_choice(tuple(template), template, timed=timed)
+
+
+def _kind_test(template):
+    """returns test(kind), which is whether template could accept an object of type kind, or None
+    if it could accept anything; for choosing between alternatives without trying them all"""
+    if isinstance(template, CompiledTemplate):
+        return _kind_test(template.template)
+    if isinstance(template, spotcheck):
+        return _kind_test(template.template)
+    if isinstance(template, (optional, noneable)):
+        inner = _kind_test(template.key if isinstance(template, optional) else template.template)
+        return None if inner is None else lambda kind: kind is type(None) or inner(kind)
+    if template is None:
+        return lambda kind: kind is type(None)
+    if isinstance(template, dict):
+        return lambda kind: issubclass(kind, dict)
+    if isinstance(template, list):
+        return lambda kind: issubclass(kind, collections.abc.Sequence) or _is_ndarray_type(kind)
+    if isinstance(template, tuple):
+        return lambda kind: issubclass(kind, collections.abc.Sequence)
+    if isinstance(template, set) and len(template) == 1:
+        return lambda kind: issubclass(kind, set)
+    if isinstance(template, (set, union)):
+        tests = [_kind_test(t) for t in (template if isinstance(template, set) else template.alternatives)]
+        if None in tests:
+            return None
+        return lambda kind: any(test(kind) for test in tests)
+    if isinstance(template, type) and template is not duck and template is not function:
+        return lambda kind: issubclass(kind, template)
+    return None
+
+
+def _discriminator_tag(template, discriminator):
+    "the str value of the discriminator key in a dict template, else None"
+    while isinstance(template, CompiledTemplate):
+        template = template.template
+    if not isinstance(template, dict):
+        return None
     try:
-        if isinstance(template, str):  # allow docstrings
+        template, _ = _dict_template(template)
+    except ValueError:
+        return None
+    tag = template.get(discriminator)
+    return tag if isinstance(tag, str) else None
+
+
+_MAX_DISPATCH_TYPES = 256  # the types remembered per choice of alternatives
+
+
+def _compile_choice(alternatives, template, discriminator=None, timed=None):
+    """checks obj against only those alternatives that could accept its type, which are looked up
+    per type; and dict alternatives tagged with a discriminator are looked up by their tag"""
+    allow_none = any(alternative is None for alternative in alternatives)
+    tagged, untagged = {}, []
+    for alternative in alternatives:
+        if alternative is None:
+            continue
+        tag = None if discriminator is None else _discriminator_tag(alternative, discriminator)
+        if tag is None:
+            untagged.append((_compile_node(alternative, timed), _kind_test(alternative)))
+        elif tag in tagged:
+            return _bad_template("bad template: %s has more than one alternative with %s %s" % (template, discriminator, tag))
+        else:
+            tagged[tag] = _compile_node(alternative, timed)
+    every = tuple(check for check, test in untagged)
+    by_type = {}
+
+    def candidates(kind):
+        found = by_type.get(kind)
+        if found is None:
+            found = []
+            for check, test in untagged:
+                try:
+                    if test is None or test(kind):
+                        found.append(check)
+                except TypeError:  # an unusual type; try it anyway
+                    found.append(check)
+            found = tuple(found)
+            if len(by_type) < _MAX_DISPATCH_TYPES:
+                by_type[kind] = found
+        return found
+
+    def check_choice(obj):
+        if obj is None and allow_none:
             return
-        if isinstance(template, optional):
-            if obj is None:
+        if tagged and isinstance(obj, dict):
+            tag = obj.get(discriminator)
+            check = tagged.get(tag) if isinstance(tag, str) else None
+            if check is not None:
+                check(obj)
                 return
-            template = template.template
-        elif isinstance(template, noneable):
-            if obj is not None:
-                duckable(obj, template.template, ctx)
-        elif template is any:
-            pass
-        elif template is function:
-            function.check_is_function(obj, ctx)
-        elif isinstance(template, ObiwanCheck):
-            template.check(obj, ctx)
-        elif isinstance(template, set):
-            if len(template) == 1: # we expect a set, all of a particular type
-                typ = tuple(template)[0]
-                if not isinstance(obj, set):
-                    raise ObiwanError("%s is %s but should be a set of %s" % (ctx, type(obj), typ))
-                for i, o in enumerate(obj):
-                    duckable(o, typ, ctx + ("[%d]" % i))
-            else: # leaf datatype multiple-choice
-                for typ in template:
-                    try:
-                        duckable(obj, typ, ctx)
-                        break
-                    except ObiwanError:
-                        pass
-                else:
-                    if not (obj is None and None in template):
-                        raise ObiwanError("%s is %s but should be one of %s" % (ctx, type(obj), template))
-        elif isinstance(template, dict):
-            if not isinstance(obj, dict):
-                raise ObiwanError("%s is %s but should be a dict" % (ctx, type(obj)))
-            if options in template:
-                is_strict = False
-                for opt in template[options]:
-                    if opt is strict:
-                        if is_strict:
-                            raise ObiwanError("%s template specifies strict option twice" % ctx)
-                        is_strict = True
-                    elif isinstance(opt, subtype):
-                        tmpl = opt.template()
-                        tmpl.update(template)
-                        template = tmpl
-                    else:
-                        raise ObiwanError("%s unsupported template option %s: %s" % (ctx, type(opt), opt))
+        nested = None  # the errors inside each alternative, when validate() is collecting errors
+        for alternative in candidates(type(obj)):
+            try:
+                alternative(obj)
+                return
+            except _ObiwanErrors as e:
+                nested = (nested or []) + [e.errors]
+            except Exception:
+                pass
+        if obj.__class__ is not type(obj):  # e.g. a mock, which isinstance() might accept as another class
+            for alternative in every:
+                try:
+                    alternative(obj)
+                    return
+                except Exception:
+                    pass
+        if nested is not None:
+            # the errors of the alternatives that failed don't count, as we only want to report one
+            _collector.count -= sum(map(len, nested))
+            if len(nested) == 1:  # only one alternative got past the type of obj, so its errors are the interesting ones
+                errors = None
+                for e in nested[0]:
+                    errors = _failed(errors, e)
+                raise _ObiwanErrors(errors)
+        if tagged and isinstance(obj, dict) and not candidates(dict):
+            if discriminator not in obj:
+                raise ObiwanError(" should have child called %s" % (discriminator,))
+            raise ObiwanError(" is %r but should be one of %s" % (obj[discriminator], ", ".join(sorted(tagged))))._at(
+                _CHILD, discriminator)
+        raise ObiwanError(" is %s but should be one of %s" % (type(obj), template))
+    return check_choice
+
+
+def _dict_template(template):
+    """resolves the options of a dict template, returning (merged template, is_strict);
+    raises ValueError describing a bad template"""
+    is_strict = False
+    if options in template:
+        for opt in template[options]:
+            if opt is strict:
                 if is_strict:
-                    for key in obj:
-                        if not key in template and not optional(key) in template:
-                            raise ObiwanError("%s should not have a child called %s" % (ctx, key))
-            for key, value in template.items():
-                if key is options:
-                    continue
-                elif isinstance(key, optional):
-                    key = key.key
-                    if key not in obj:
-                        continue
-                elif isinstance(key, noneable):
-                    key = key.template
-                    if obj[key] is None:
-                        continue
-                elif isinstance(key, str):
-                    if key not in obj:
-                        raise ObiwanError("%s should have child called %s" % (ctx, key))
-                    duckable(obj[key], value, "%s[\"%s\"]" % (ctx, key))
-                else: # ensure that *all* keys and values are of right type in dict
-                    for k, v in obj.items():
-                        duckable(k, key, "key %s[%s]" % (ctx, k))
-                        duckable(v, value, "key %s[\"%s\"]" % (ctx, k))
-        elif isinstance(template, list):
-            if not isinstance(obj, collections.abc.Sequence):
-                raise ObiwanError("%s is %s but should be %s" % (ctx, type(obj), template))
-            if len(template) != 1:
-                raise ObiwanError("%s bad template: %s lists must all be of the same type" % (ctx, template))
-            template = template[0]
-            for i, item in enumerate(obj):
-                duckable(item, template, "%s[%s]" % (ctx, i))
-        elif isinstance(template, tuple):
-            if not isinstance(obj, collections.abc.Sequence):
-                raise ObiwanError("%s is %s but should be packed %s" % (ctx, type(obj), template))
-            for i, expect in enumerate(template):
-                if expect is any:
+                    raise ValueError("template specifies strict option twice")
+                is_strict = True
+            elif isinstance(opt, subtype):
+                tmpl = opt.template()
+                tmpl.update(template)
+                template = tmpl
+            else:
+                raise ValueError("unsupported template option %s: %s" % (type(opt), opt))
+    return template, is_strict
+
+
+def _dict_sources(template):
+    "template and the dict templates it inherits from through subtype options; its compiled form depends on them all"
+    sources = [template]
+    try:
+        for opt in template.get(options, ()):
+            if isinstance(opt, subtype):
+                for parent in opt.types:
+                    sources.extend(_dict_sources(parent))
+    except TypeError:  # options is not a list; _dict_template() complains about that
+        pass
+    return sources
+
+
+def _all_of_types(items, types):
+    "whether every item is one of types; at C speed"
+    return all(issubclass(t, types) for t in set(map(type, items)))
+
+
+def _index_dict(template, timed=None, templates=False):
+    """normalizes a dict template into (required, noneables, optionals, generics, allowed key set, is_strict);
+    the keys and values are compiled into checker closures, or into CompiledTemplates if templates is true,
+    for the modules that descend into them such as obiwan.stream.  Raises ValueError describing a bad template"""
+    template, is_strict = _dict_template(template)
+    child = _template_child if templates else _compile_child
+    allowed = set()
+    required, noneables, optionals, generics = [], [], [], []
+    for key, value in template.items():
+        if key is options:
+            continue
+        elif isinstance(key, optional):
+            optionals.append((key.key, child(value, _CHILD, key.key, timed)))
+            allowed.add(key.key)
+        elif isinstance(key, noneable):
+            noneables.append((key.template, child(value, _CHILD, key.template, timed)))
+            allowed.add(key.template)
+        elif isinstance(key, str):
+            required.append((key, child(value, _CHILD, key, timed)))
+            allowed.add(key)
+        else:  # ensure that *all* keys and values are of right type in dict; plain types are checked in bulk
+            generics.append((child(key, _KEY, _ANY_INDEX, timed), child(value, _INDEX, _ANY_INDEX, timed),
+                _leaf_types(key), _leaf_types(value)))
+    if generics:
+        is_strict = False  # every key has to match the generic keys anyway
+    return tuple(required), tuple(noneables), tuple(optionals), tuple(generics), frozenset(allowed), is_strict
+
+
+def _compile_dict(template, timed=None):
+    """the template is indexed once, but if keys are added to or removed from it or the templates it
+    inherits from, it is indexed again"""
+    parents = tuple(_dict_sources(template)[1:])
+    required = noneables = optionals = generics = allowed = is_strict = size = parents_size = None
+    def index():
+        nonlocal required, noneables, optionals, generics, allowed, is_strict, size, parents_size
+        required, noneables, optionals, generics, allowed, is_strict = _index_dict(template, timed)
+        size, parents_size = len(template), sum(map(len, parents))
+    try:
+        index()
+    except ValueError as e:
+        return _bad_template(str(e))
+    def check_dict(obj):
+        if len(template) != size or (parents and sum(map(len, parents)) != parents_size):
+            try:
+                index()
+            except ValueError as e:
+                raise ObiwanError(" " + str(e))
+        if not isinstance(obj, dict):
+            raise ObiwanError(" is %s but should be a dict" % type(obj))
+        errors = None
+        if is_strict and not allowed.issuperset(obj):
+            for key in obj:
+                if key not in allowed:
+                    errors = _failed(errors, ObiwanError(" should not have a child called %s" % (key,)))
+        for key, check in required:
+            value = obj.get(key, _missing)
+            if value is _missing:
+                errors = _failed(errors, ObiwanError(" should have child called %s" % (key,)))
+                continue
+            try:
+                check(value)
+            except ObiwanError as e:
+                errors = _failed(errors, e._at(_CHILD, key))
+        for key, check in noneables:
+            value = obj.get(key, _missing)
+            if value is _missing:
+                errors = _failed(errors, ObiwanError(" should have child called %s" % (key,)))
+                continue
+            if value is not None:
+                try:
+                    check(value)
+                except ObiwanError as e:
+                    errors = _failed(errors, e._at(_CHILD, key))
+        for key, check in optionals:
+            value = obj.get(key, _missing)
+            if value is not _missing:
+                try:
+                    check(value)
+                except ObiwanError as e:
+                    errors = _failed(errors, e._at(_CHILD, key))
+        for check_key, check_value, key_types, value_types in generics:
+            keys_ok = key_types is not None and _all_of_types(obj, key_types)
+            values_ok = value_types is not None and _all_of_types(obj.values(), value_types)
+            if keys_ok and values_ok:
+                continue
+            for k, v in obj.items():
+                if not keys_ok:
+                    try:
+                        check_key(k)
+                    except ObiwanError as e:
+                        errors = _failed(errors, e._at(_KEY, k))
+                if not values_ok:
+                    try:
+                        check_value(v)
+                    except ObiwanError as e:
+                        errors = _failed(errors, e._at(_KEY_CHILD, k))
+        if errors is not None:
+            raise _ObiwanErrors(errors)
+    return check_dict
+
+
+# the Python type of the items of array.arrays and memoryviews by typecode, and of numpy arrays by dtype kind
+_ARRAY_ITEM_TYPES = {"b": int, "B": int, "h": int, "H": int, "i": int, "I": int, "l": int, "L": int,
+    "q": int, "Q": int, "n": int, "N": int, "e": float, "f": float, "d": float, "?": bool, "u": str, "w": str}
+_NUMPY_ITEM_TYPES = {"b": bool, "i": int, "u": int, "f": float, "c": complex, "U": str, "S": bytes}
+
+
+def _ndarray(obj):
+    "obj if it is a numpy array; we never import numpy ourselves, if it is in use it has been imported"
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return obj
+    return None
+
+
+def _is_ndarray_type(kind):
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and issubclass(kind, numpy.ndarray)
+
+
+def _item_type(seq):
+    "the Python type of every item of an array.array, 1-d memoryview or 1-d numpy array, else None"
+    array = sys.modules.get("array")  # like numpy, there can't be any arrays until it is imported
+    if array is not None and isinstance(seq, array.array):
+        return _ARRAY_ITEM_TYPES.get(seq.typecode)
+    if isinstance(seq, memoryview):
+        return _ARRAY_ITEM_TYPES.get(seq.format.lstrip("@=<>!")) if seq.ndim == 1 else None
+    if _ndarray(seq) is not None and seq.ndim == 1:
+        return _NUMPY_ITEM_TYPES.get(seq.dtype.kind)
+    return None
+
+
+def _leaf_types(template):
+    "the tuple of types template accepts, if it's a plain type or a multiple-choice of plain types; else None"
+    while isinstance(template, CompiledTemplate):
+        template = template.template
+    def is_plain(typ):
+        return isinstance(typ, type) and typ is not duck and typ is not function
+    if is_plain(template):
+        return (template,)
+    if isinstance(template, set) and len(template) > 1 and all(t is None or is_plain(t) for t in template):
+        return tuple(type(None) if t is None else t for t in template)
+    return None
+
+
+def _first_bad_type(seq, types):
+    "the index of the first item of seq that is not one of types, or None; at C speed"
+    seen = set(map(type, seq))
+    bad = [t for t in seen if not issubclass(t, types)]
+    if not bad:
+        return None
+    kinds = list(map(type, seq))
+    return min(kinds.index(t) for t in bad)
+
+
+def _bulk_leaf(types):
+    def first_failure(seq):
+        item_type = _item_type(seq)
+        if item_type is not None:  # O(1)
+            return None if issubclass(item_type, types) or not len(seq) else 0
+        if _ndarray(seq) is not None:
+            seq = seq.tolist()
+        return _first_bad_type(seq, types)
+    return first_failure
+
+
+def _bulk_tuple(template):
+    "for lists of tuples of plain types, e.g. [(int, int)]"
+    slots = []
+    for expect in template:
+        if expect is Ellipsis:
+            break
+        types = None if expect is any else _leaf_types(expect)
+        if types is None and expect is not any:
+            return None
+        slots.append(types)
+    length, open_ended = len(template), Ellipsis in template
+    def first_failure(seq):
+        if _ndarray(seq) is not None:
+            item_type = _NUMPY_ITEM_TYPES.get(seq.dtype.kind)
+            if seq.ndim == 2 and item_type is not None and (seq.shape[1] == length or
+                    open_ended and seq.shape[1] >= len(slots)) and \
+                    all(types is None or issubclass(item_type, types) for types in slots):
+                return None
+            return 0 if len(seq) else None
+        if not seq:
+            return None
+        # the items before the first that isn't a sequence of the right length have their slots checked in bulk
+        end = _first_bad_type(seq, (list, tuple))
+        items = seq if end is None else list(itertools.islice(seq, end))
+        lengths = set(map(len, items))
+        if lengths and ((min(lengths) < len(slots)) if open_ended else (lengths != {length})):
+            end = next(i for i, item in enumerate(items)
+                if (len(item) < len(slots) if open_ended else len(item) != length))
+            items = list(itertools.islice(items, end))
+        failures = [_first_bad_type(list(map(operator.itemgetter(i), items)), types)
+            for i, types in enumerate(slots) if types is not None]
+        failures = [i for i in failures if i is not None]
+        return min(failures, default=end)
+    return first_failure
+
+
+def _bulk_checker(item_template):
+    """a function that checks all the items of a sequence in bulk, returning the index of the
+    first one that fails (or that might; it is checked properly) or None if they all pass"""
+    while isinstance(item_template, CompiledTemplate):
+        item_template = item_template.template
+    types = _leaf_types(item_template)
+    if types is not None:
+        return _bulk_leaf(types)
+    if isinstance(item_template, tuple):
+        return _bulk_tuple(item_template)
+    if isinstance(item_template, ObiwanCheck):
+        return getattr(item_template, "check_many", None)
+    return None
+
+
+def _compile_list(template, timed=None):
+    if len(template) != 1:
+        return _bad_template("bad template: %s lists must all be of the same type" % (template,))
+    item_template = template[0]
+    check_item = _compile_child(item_template, _INDEX, _ANY_INDEX, timed)
+    first_failure = _bulk_checker(item_template)
+    def check_list(obj):
+        if not isinstance(obj, collections.abc.Sequence) and _ndarray(obj) is None:
+            raise ObiwanError(" is %s but should be %s" % (type(obj), template))
+        start = 0
+        if first_failure is not None:
+            start = first_failure(obj)
+            if start is None:
+                return
+        # those before the first that failed in bulk are fine, but it may be a false alarm
+        if _ndarray(obj) is not None:  # converted only from there, as converting it all costs O(n)
+            items = zip(itertools.count(start), obj[start:].tolist())
+        else:
+            items = itertools.islice(enumerate(obj), start, None)
+        _check_items(check_item, items, _INDEX)
+    return check_list
+
+
+def _compile_tuple(template, timed=None):
+    slots = []
+    open_ended = False
+    for i, expect in enumerate(template):
+        if expect is Ellipsis:
+            open_ended = True
+            break
+        if expect is not any:
+            slots.append((i, expect, _compile_child(expect, _INDEX, i, timed)))
+    slots = tuple(slots)
+    length = len(template)
+    def check_tuple(obj):
+        if not isinstance(obj, collections.abc.Sequence):
+            raise ObiwanError(" is %s but should be packed %s" % (type(obj), template))
+        errors = None
+        for i, expect, check in slots:
+            if i >= len(obj):
+                errors = _failed(errors, ObiwanError(" should be %s but is omitted" % (expect,))._at(_INDEX, i))
+                break
+            try:
+                check(obj[i])
+            except ObiwanError as e:
+                errors = _failed(errors, e._at(_INDEX, i))
+        else:
+            if not open_ended and len(obj) != length:
+                errors = _failed(errors, ObiwanError(" is %s but should be packed %s" % (type(obj), template)))
+        if errors is not None:
+            raise _ObiwanErrors(errors)
+    return check_tuple
+
+
+def _compile_spotcheck(policy, timed=None):
+    template = policy.template
+    while isinstance(template, CompiledTemplate):
+        template = template.template
+    check_all = _compile_node(template, timed)
+    if isinstance(template, list) and len(template) == 1:
+        check_item = _compile_child(template[0], _INDEX, _ANY_INDEX, timed)
+        def sampled(obj):  # arrays of a single type are checked in O(1) anyway
+            return isinstance(obj, collections.abc.Sequence) and _item_type(obj) is None
+        def check_indexes(obj, indexes):
+            _check_items(check_item, ((i, obj[i]) for i in indexes), _INDEX)
+    elif isinstance(template, set) and len(template) == 1:
+        check_item = _compile_child(tuple(template)[0], _INDEX, _ANY_INDEX, timed)
+        def sampled(obj):
+            return isinstance(obj, set)
+        def check_indexes(obj, indexes):
+            items = list(obj)  # at C speed, which is far faster than checking them
+            _check_items(check_item, ((i, items[i]) for i in indexes), _INDEX)
+    elif isinstance(template, dict) and len(template) == 1 and not isinstance(
+            next(iter(template)), (str, optional, noneable, _marker)):
+        (key_template, value_template), = template.items()
+        check_key = _compile_child(key_template, _KEY, _ANY_INDEX, timed)
+        check_value = _compile_child(value_template, _INDEX, _ANY_INDEX, timed)
+        def sampled(obj):
+            return isinstance(obj, dict)
+        def check_indexes(obj, indexes):
+            keys = list(obj)
+            errors = None
+            for i in indexes:
+                key = keys[i]
+                try:
+                    check_key(key)
+                except ObiwanError as e:
+                    errors = _failed(errors, e._at(_KEY, key))
                     continue
-                if expect is Ellipsis:
-                    return
-                if i >= len(obj):
-                    raise ObiwanError("%s[%d] %s but should be packed %s but is omitted" % (ctx, i, expect))
-                got = obj[i]
-                duckable(got, expect, "%s[%d]" % (ctx, i))
-            if len(template) != len(obj):
-                raise ObiwanError("%s is %s but should be packed %s" % (ctx, type(obj), template))
-        elif template is duck:
-            raise ObiwanError("%s you must instansiate a duck and describe its expected attributes" % ctx)
-        elif hasattr(template, "__name__") and template.__name__ == "<lambda>":
-            if not template(obj):
-                raise ObiwanError("%s failed lambda check" % ctx)
-        elif inspect.isfunction(template): # lambdas are also functions, so check for lambda first
-            _check_function_template(obj, template)
-        else:  # single type
+                try:
+                    check_value(obj[key])
+                except ObiwanError as e:
+                    errors = _failed(errors, e._at(_KEY_CHILD, key))
+            if errors is not None:
+                raise _ObiwanErrors(errors)
+    else:
+        return _bad_template("bad template: %s can only spot-check [T], {K: V} and {T} templates" % (policy,))
+    def check_sampled(obj):
+        indexes = policy.indexes(len(obj)) if sampled(obj) else None
+        if indexes is None:
+            return check_all(obj)
+        try:
+            check_indexes(obj, indexes)
+        except ObiwanError as e:
+            for error in getattr(e, "errors", [e]):
+                if error.sampled is None:  # else it was found by a spot-check of a container within
+                    error.sampled = indexes
+            raise
+    return check_sampled
+
+
+def _compile_child(template, fmt, key, timed=None):
+    """compiles the template of a child; timed is (node_timer, path of the parent) when compiling
+    for statistics, and then the child is wrapped by node_timer(its path, check)"""
+    if timed is None:
+        return _compile_node(template)
+    node_timer, parent = timed
+    path = fmt % (parent, key)
+    return node_timer(path, _compile_node(template, (node_timer, path)))
+
+
+def _template_child(template, fmt, key, timed=None):
+    "the CompiledTemplate of a child, for _index_dict() to give to the modules that descend into it"
+    return compile(template)
+
+
+def _compile_timed(template, node_timer):
+    "compiles template with each child node wrapped by node_timer(path, check); see enable_stats()"
+    return _compile_node(template, (node_timer, ""))
+
+
+def _compile_node(template, timed=None):
+    "turns a template into a checker(obj) closure that raises ObiwanError; see _compile_child() for timed"
+    if isinstance(template, str) or template is any:  # allow docstrings
+        return _accept
+    if template is None:
+        return _check_none
+    if isinstance(template, (optional, noneable)):
+        check_inner = _compile_node(template.key if isinstance(template, optional) else template.template, timed)
+        def check_noneable(obj):
+            if obj is not None:
+                check_inner(obj)
+        return check_noneable
+    if template is function:
+        return _check_is_function
+    if isinstance(template, CompiledTemplate):
+        return template._check
+    if isinstance(template, ObiwanCheck):
+        return _compile_custom(template.check)
+    if isinstance(template, set):
+        return _compile_set(template, timed)
+    if isinstance(template, union):
+        return _compile_choice(template.alternatives, template, template.discriminator, timed)
+    if isinstance(template, spotcheck):
+        return _compile_spotcheck(template, timed)
+    if isinstance(template, dict):
+        return _compile_dict(template, timed)
+    if isinstance(template, list):
+        return _compile_list(template, timed)
+    if isinstance(template, tuple):
+        return _compile_tuple(template, timed)
+    if template is duck:
+        return _bad_template("you must instansiate a duck and describe its expected attributes")
+    if getattr(template, "__name__", None) == "<lambda>":
+        return _compile_lambda(template)
+    if inspect.isfunction(template):  # lambdas are also functions, so check for lambda first
+        def check_function_template(obj):
+            _check_function_template(obj, template, "")
+        return check_function_template
+    return _compile_type(template)  # single type
+
+
+class CompiledTemplate(ObiwanCheck):
+    """a template that has been specialised once into a tree of checker closures;
+    obtain these with compile() and reuse them, or use them as templates themselves"""
+    def __init__(self, template):
+        self.template = template
+        self.sampling = None  # a sampling policy for check(), the json wrapper and the runtime checker
+        self.memo = None  # a ValidationCache of immutable objects known to be valid; see memoize()
+        self.limits = None  # the limits on the size of objects checked; see limit()
+        self._check = _compile_node(template)
+
+    def check(self, obj, ctx="checking"):
+        memo = self.memo
+        if memo is not None and memo.hit(obj):
+            return
+        try:
+            if self.limits is not None:
+                self.limits.check(obj)
+            self._check(obj)
+        except ObiwanError as e:
+            if e.ctx is None:
+                e.ctx = ctx
+            raise
+        except RecursionError:
+            raise ObiwanError(" is nested too deeply to check", ctx)
+        except Exception as e:
+            raise ObiwanError(" internal error: %s" % e, ctx)
+        if memo is not None:
+            memo.add(obj)
+
+    __call__ = check
+
+    def is_valid(self, obj):
+        try:
+            self.check(obj)
+            return True
+        except ObiwanError:
+            return False
+
+    def __repr__(self):
+        return "<obiwan.CompiledTemplate %r>" % (self.template,)
+
+
+_IMMUTABLE_SCALARS = frozenset((int, float, complex, str, bytes, bool, type(None), range))  # and Decimal; see _is_decimal
+
+
+def _is_decimal(kind):
+    "whether kind is decimal.Decimal, without importing decimal; there can't be any Decimals until it is"
+    decimal = sys.modules.get("decimal")
+    return decimal is not None and kind is decimal.Decimal
+
+
+def _is_immutable(obj, depth=0):
+    "whether obj and everything in it can never change"
+    kind = type(obj)
+    if kind in _IMMUTABLE_SCALARS or _is_decimal(kind):
+        return True
+    if depth > 100:
+        return False
+    if isinstance(obj, (tuple, frozenset)):
+        if kind is not tuple and kind is not frozenset and hasattr(obj, "__dict__"):
+            return False  # a subclass that can have attributes set; namedtuples can't
+        return all(_is_immutable(item, depth + 1) for item in obj)
+    params = getattr(kind, "__dataclass_params__", None)
+    if params is not None and params.frozen:
+        return all(_is_immutable(getattr(obj, name), depth + 1) for name in kind.__dataclass_fields__)
+    return False
+
+
+class _strong_ref:
+    "the same interface as a weakref, for things that can't be weakly referenced"
+    __slots__ = ("obj",)
+    def __init__(self, obj):
+        self.obj = obj
+    def __call__(self):
+        return self.obj
+
+
+class ValidationCache:
+    """a bounded LRU of immutable objects that are known to match a template, so they are
+    not checked again; see memoize().  Mutable objects such as dicts and lists, and
+    containers that hold them, are never cached.  Scalars are looked up by type and value;
+    tuples, frozensets and frozen dataclasses by identity, because (1,) == (1.0,) but they
+    may not both match.  Things that can be are weakly referenced, so entries die with them.
+    hits, misses, evictions and uncacheable count what happened"""
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()  # key -> ref, or None for scalars
+        self.hits = self.misses = self.evictions = self.uncacheable = 0
+
+    def _key(self, obj):
+        kind = type(obj)
+        if kind in _IMMUTABLE_SCALARS or _is_decimal(kind):
+            return (kind, obj), False
+        if isinstance(obj, (tuple, frozenset)) or hasattr(kind, "__dataclass_params__"):
+            return id(obj), True
+        return None, False
+
+    def hit(self, obj):
+        "whether obj is known to be valid"
+        key, by_identity = self._key(obj)
+        if key is None:
+            self.uncacheable += 1
+            return False
+        try:
+            ref = self._entries[key]
+            if by_identity and ref() is not obj:
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, obj):
+        "records that obj is valid, if it is immutable"
+        key, by_identity = self._key(obj)
+        if key is None or not _is_immutable(obj):
+            return
+        ref = None
+        if by_identity:
             try:
-                if not isinstance(obj, template):
-                    raise ObiwanError("%s is %s but should be %s" % (ctx, obj, template))
+                ref = weakref.ref(obj, functools.partial(self._expire, key))
             except TypeError:
-                raise ObiwanError("%s template %s is not a valid type template" % (ctx, template))
-    except ObiwanError:
-        raise
-    except Exception as e:
-        raise ObiwanError("%s internal error: %s" % (ctx, e))
+                ref = _strong_ref(obj)  # which also stops its id being reused while it is cached
+        entries = self._entries
+        entries[key] = ref
+        while len(entries) > self.maxsize:
+            try:
+                entries.popitem(last=False)
+            except KeyError:  # another thread got there first
+                break
+            self.evictions += 1
+
+    def _expire(self, key, ref):
+        if self._entries.get(key) is ref:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = self.uncacheable = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<obiwan.ValidationCache %d/%d hits=%d misses=%d evictions=%d>" % (
+            len(self), self.maxsize, self.hits, self.misses, self.evictions)
+
+
+def memoize(template, maxsize=1024):
+    """remembers which immutable objects (strings, numbers, tuples, frozensets, frozen dataclasses)
+    have matched template, so checking them again is a lookup; returns the ValidationCache"""
+    compiled = _pin(template)
+    compiled.memo = ValidationCache(maxsize)
+    return compiled.memo
+
+
+_LEAF_TYPES = frozenset((int, float, complex, bool, type(None)))
+
+
+class limits:
+    """bounds on the objects checked against a template, so that hostile input costs bounded time
+    and memory; objects that go beyond them fail before the template is checked at all:
+        depth: how deeply dicts, lists, tuples and sets can be nested
+        nodes: how many values there can be in total, counting the object itself
+        length: how many items each dict, list, tuple or set can have
+        string: how long each string, bytes or dict key can be
+    the object is walked with an explicit stack, so deep nesting can't exhaust the Python stack,
+    and the walk stops at the first limit exceeded.  Attach it to templates with limit()"""
+    def __init__(self, depth=None, nodes=None, length=None, string=None):
+        self.depth, self.nodes, self.length, self.string = depth, nodes, length, string
+
+    def check(self, obj):
+        "raises an ObiwanError at the first limit obj exceeds"
+        self._walk(obj, 1, 1, None)
+
+    def reader(self):
+        """returns a _LimitsReader, for the streaming loaders to check the limits as they read a
+        document, so that it fails at the first limit exceeded without the rest being read"""
+        return _LimitsReader(self)
+
+    def _walk(self, obj, depth, nodes, where):
+        "checks obj found at depth with nodes values counted so far, counting obj, and returns the new count"
+        max_depth, max_nodes, max_length, max_string = self.depth, self.nodes, self.length, self.string
+        stack = [(obj, depth, where)]  # (value, depth, (parent entry, path format, key) or None at the root)
+        while stack:
+            entry = stack.pop()
+            value, depth, where = entry
+            kind = type(value)
+            if kind in _LEAF_TYPES:
+                continue
+            if isinstance(value, (str, bytes, bytearray)):
+                if max_string is not None and len(value) > max_string:
+                    raise self._error(where, " is %d long, more than the limit of %d" % (len(value), max_string))
+                continue
+            if not isinstance(value, (dict, list, tuple, set, frozenset)):
+                continue
+            size = len(value)
+            if not size:
+                continue
+            if max_length is not None and size > max_length:
+                raise self._error(where, " has %d items, more than the limit of %d" % (size, max_length))
+            if max_depth is not None and depth > max_depth:
+                raise self._error(where, " is nested more than the limit of %d deep" % max_depth)
+            nodes += size
+            if max_nodes is not None and nodes > max_nodes:
+                raise self._error(where, " has more than the limit of %d values in all" % max_nodes)
+            if isinstance(value, dict):
+                if max_string is not None:
+                    for key in value:
+                        if isinstance(key, str) and len(key) > max_string:
+                            raise self._error((entry, _KEY, key),
+                                " is %d long, more than the limit of %d" % (len(key), max_string))
+                if not _LEAF_TYPES.issuperset(map(type, value.values())):  # pushed in reverse, so popped in order
+                    stack.extend((item, depth + 1, (entry, _CHILD, key)) for key, item in reversed(value.items()))
+            elif not _LEAF_TYPES.issuperset(map(type, value)):
+                if isinstance(value, (set, frozenset)):
+                    stack.extend((item, depth + 1, (entry, _INDEX, _ANY_INDEX)) for item in value)
+                else:
+                    stack.extend((value[i], depth + 1, (entry, _INDEX, i)) for i in range(size - 1, -1, -1))
+        return nodes
+
+    @staticmethod
+    def _error(where, message):
+        error = ObiwanError(message)
+        while where is not None:
+            parent, fmt, key = where
+            error._at(fmt, key)
+            where = parent[2]
+        return error
+
+    def __repr__(self):
+        return "<obiwan.limits depth=%s nodes=%s length=%s string=%s>" % (
+            self.depth, self.nodes, self.length, self.string)
+
+
+class _LimitsReader:
+    """the limits of a document that is read a value at a time: the parser calls enter() as each
+    dict, list or tuple starts and leave() as it ends, item() before each of its items if its size
+    wasn't known, and string() for each string and dict key.  Errors are at the byte offset given
+    and the path of the container, or of the string, which the parser adds to"""
+    def __init__(self, limits):
+        self.limits = limits
+        self.depth = 0  # of the container being read; the document itself is at 1
+        self.nodes = 1  # the document itself
+
+    def enter(self, size, offset):
+        "a container of size items starts at offset, or of items that are only known as they are read if None"
+        self.depth += 1
+        if size:
+            length = self.limits.length
+            if length is not None and size > length:
+                raise self._error(offset, " has %d items, more than the limit of %d" % (size, length))
+            self._count(size, offset)
+
+    def item(self, index, offset):
+        "item index of a container whose size was None starts at offset"
+        length = self.limits.length
+        if length is not None and index >= length:
+            raise self._error(offset, " has more than the limit of %d items" % length)
+        self._count(1, offset)
+
+    def _count(self, count, offset):
+        limits = self.limits
+        if limits.depth is not None and self.depth > limits.depth:
+            raise self._error(offset, " is nested more than the limit of %d deep" % limits.depth)
+        self.nodes += count
+        if limits.nodes is not None and self.nodes > limits.nodes:
+            raise self._error(offset, " has more than the limit of %d values in all" % limits.nodes)
+
+    def leave(self):
+        self.depth -= 1
+
+    def string(self, value, offset):
+        "a value or dict key was read at offset, which is too long if it is a string or bytes longer than the limit"
+        string = self.limits.string
+        if string is not None and isinstance(value, (str, bytes, bytearray)) and len(value) > string:
+            raise self._error(offset, " is %d long, more than the limit of %d" % (len(value), string))
+
+    @staticmethod
+    def _error(offset, message):
+        error = ObiwanError(message)
+        error.offset = offset
+        return error
+
+
+def limit(template, policy):
+    """checks that objects are within the limits policy before checking them against template;
+    applies to duckable(), check() and the json, msgpack and cbor wrappers, including streaming and bulk
+    validation.  A policy of None removes the limits.
+    Returns policy"""
+    _pin(template).limits = policy
+    return policy
+
+
+class sampling:
+    """a policy for checking only some of the time, when checking everything costs too much:
+        first: always check the first N times
+        every: after that, check 1 in every K times
+        rate: check this fraction of the time, at random
+        per_second: check at most N times a second
+    a check is done only if all the given limits allow it.  Call it to decide whether to check;
+    performed and skipped count the decisions.  Attach it to templates and functions with sample()"""
+    def __init__(self, first=0, every=None, rate=None, per_second=None):
+        self.first, self.every, self.rate, self.per_second = first, every, rate, per_second
+        self.reset()
+
+    def reset(self):
+        self.performed = self.skipped = 0
+        self._window_start, self._window_count = None, 0
+
+    def copy(self):
+        "a policy with the same limits and counts of its own, for checking something else"
+        return type(self)(self.first, self.every, self.rate, self.per_second)
+
+    def __call__(self):
+        seen = self.performed + self.skipped
+        if seen >= self.first:
+            if self.every is not None and (seen - self.first) % self.every:
+                self.skipped += 1
+                return False
+            if self.rate is not None and random.random() >= self.rate:
+                self.skipped += 1
+                return False
+            if self.per_second is not None:
+                now = time.monotonic()
+                if self._window_start is None or now - self._window_start >= 1:
+                    self._window_start, self._window_count = now, 0
+                if self._window_count >= self.per_second:
+                    self.skipped += 1
+                    return False
+                self._window_count += 1
+        self.performed += 1
+        return True
+
+    @property
+    def coverage(self):
+        "the fraction of checks that were performed"
+        seen = self.performed + self.skipped
+        return self.performed / seen if seen else 1.0
+
+    def __repr__(self):
+        return "<obiwan.sampling performed=%d skipped=%d>" % (self.performed, self.skipped)
+
+
+_function_sampling = None  # code -> sampling, for the runtime checker; see _weak_caches()
+
+
+def _weak_caches():
+    """creates the weakly keyed caches of code objects the first time checked(), sample() or the runtime
+    checker needs them, as importing weakref is a noticeable part of the time import obiwan takes"""
+    global _function_sampling, _annotation_cache, _checked_code, _monitored_yields
+    if _function_sampling is None:
+        _annotation_cache = weakref.WeakKeyDictionary()
+        _checked_code = weakref.WeakSet()
+        _monitored_yields = weakref.WeakSet()
+        _function_sampling = weakref.WeakKeyDictionary()  # last, as it says whether they all exist
+
+
+def sample(target, policy):
+    """checks target only as often as the sampling policy says; target is a template or an
+    annotated function.  Applies to check(), the json wrapper and the runtime checker,
+    but not to duckable().  A policy of None checks everything again.  Returns policy"""
+    if _is_checked(target):
+        target.sampling = policy
+    elif isinstance(target, types.FunctionType):
+        code = inspect.unwrap(target).__code__
+        _weak_caches()
+        if policy is None:
+            _function_sampling.pop(code, None)
+        else:
+            _function_sampling[code] = policy
+    else:
+        _pin(target).sampling = policy
+    return policy
+
+
+_compiled_cache = {}  # id(template) -> (template, CompiledTemplate); holding template stops its id being reused
+_compiled_cache_size = 1024
+# templates only go in _compiled_cache when they are used a second time, so that throwaway templates
+# written inline in a call, which are new every time, can't evict the ones that are reused
+_new_templates = {}  # id(template) -> (template, CompiledTemplate) of templates used once so far
+_new_templates_size = 64
+_pinned_templates = {}  # the same, for templates with policies attached, which are never evicted; see _pin()
+
+
+def _admit(cache, size, key, entry):
+    "adds entry to cache, evicting the oldest entry if it is full"
+    if len(cache) >= size:
+        try:
+            del cache[next(iter(cache))]
+        except (KeyError, RuntimeError, StopIteration):  # another thread got there first
+            pass
+    cache[key] = entry
+
+
+def compile(template):
+    """returns a reusable CompiledTemplate for template;
+    templates are cached by identity, so don't mutate a template after first use.
+    Adding or removing the keys of dict templates is noticed, but replacing their values is not"""
+    key = id(template)
+    entry = _compiled_cache.get(key)
+    if entry is None:
+        entry = _pinned_templates.get(key)
+        if entry is None:
+            entry = _new_templates.pop(key, None)
+            if entry is not None and entry[0] is template:
+                _admit(_compiled_cache, _compiled_cache_size, key, entry)  # used again, so worth keeping
+    if entry is not None and entry[0] is template:
+        return entry[1]
+    if isinstance(template, CompiledTemplate):
+        return template
+    compiled = CompiledTemplate(template)
+    _admit(_new_templates, _new_templates_size, key, (template, compiled))
+    return compiled
+
+
+def _pin(template):
+    """compiles template and keeps it compiled for as long as the process runs, so that the policies
+    attached to it, e.g. by memoize() and limit(), are not lost when it is evicted from the cache"""
+    compiled = compile(template)
+    if compiled is not template:
+        _pinned_templates[id(template)] = (template, compiled)
+    return compiled
+
+
+_DUCK_EXTENDS = [lambda obj: isinstance(obj, duck)]  # the templates that the duck and subtype constructors check
+_SUBTYPE_TYPES = [dict]
+
+
+def duckable(obj, template, ctx="checking"):
+    compile(template).check(obj, ctx)
 
 def is_duckable(*args):
     try:
@@ -323,14 +1583,108 @@ def is_duckable(*args):
         return True
     except ObiwanError:
         return False
+
+
+def validate(obj, template, max_errors=100, ctx="checking"):
+    """checks obj against template like duckable(), but carries on past mismatches and returns
+    a list of up to max_errors ObiwanErrors, each with its own path; the list is empty if obj is valid.
+    Where a set of alternatives fails and only one of them matched the type of obj, the errors
+    within that alternative are returned rather than a single error about the set"""
+    if max_errors < 1:
+        raise ValueError("max_errors must be at least 1")
+    saved = _collector.max_errors, _collector.count
+    _collector.max_errors, _collector.count = max_errors, 0
+    try:
+        compile(template).check(obj, ctx)
+        return []
+    except ObiwanError as e:
+        return getattr(e, "errors", [e])[:max_errors]
+    finally:
+        _collector.max_errors, _collector.count = saved
+
+
+def validate_records(rows, template, max_errors=100, ctx="checking"):
+    """checks a list of dicts against a dict template like validate(rows, [template]), but a column
+    at a time rather than a row at a time, which is much faster for lots of rows; see obiwan.records"""
+    from obiwan import records
+    return records.validate_records(rows, template, max_errors, ctx)
+
+
+def validated(obj, template, ctx="checking"):
+    """checks obj, a dict or list, against template once and returns a proxy to it that checks each
+    change made through it against just the part of template it touches, before making it; the
+    dicts and lists looked up through it are proxied too.  The object itself is proxy.target"""
+    from obiwan import proxies
+    return proxies.validated(obj, template, ctx)
         
         
-def check(*args):
-    global _enabled
-    if _enabled:
-        duckable(*args)
+def check(obj, template, ctx="checking"):
+    if _enabled and not _disabled:
+        _sampled_check(obj, template, ctx)
+
+
+_check = check  # what check() is while checking is enabled
+
+
+def _check_nothing(obj, template, ctx="checking"):
+    "what check() is while checking is disabled; see configure()"
+
+
+if _disabled:
+    check = _check_nothing
+
+
+def configure(enabled=None):
+    """turns all of obiwan's checking on or off, and returns whether it is on.  While it is off check()
+    does nothing, checked() returns functions as they are, functions it has already wrapped are
+    called straight through, the json wrapper ignores templates, an installed runtime check checks
+    nothing and install_obiwan_runtime_check() does nothing.  Setting OBIWAN_DISABLED=1 in the
+    environment turns it off from import, so that check is bound to a function that does nothing
+    even where it is imported by name.  Explicit validation, such as validate() and
+    compile(template).check(), still checks"""
+    global _disabled, check
+    if enabled is not None:
+        _disabled = not enabled
+        check = _check_nothing if _disabled else _check
+    return not _disabled
+
+
+def _sampled_check(obj, template, ctx):
+    compiled = compile(template)
+    if compiled.sampling is None or compiled.sampling():
+        compiled.check(obj, ctx)
+
 
-import json as _json
+def enable_stats(nodes=False):
+    """starts recording the calls, failures and time spent validating each template and checked
+    function; with nodes, the time spent on each dict child, list item type and so on within
+    templates too, which is slower.  Costs nothing until enabled; see stats()"""
+    global _profiler
+    from obiwan import profiling
+    _profiler = profiling.install(nodes)
+
+
+def disable_stats():
+    "stops recording statistics; those recorded so far are still returned by stats()"
+    global _profiler
+    if _profiler is not None:
+        from obiwan import profiling
+        profiling.uninstall()
+        _profiler = None
+
+
+def stats():
+    """returns a ValidationStats snapshot of the statistics recorded since enable_stats() or reset_stats();
+    print it for a table of the hottest templates, functions and nodes, or use to_json()"""
+    from obiwan import profiling
+    return profiling.stats()
+
+
+def reset_stats():
+    from obiwan import profiling
+    profiling.reset()
+
+_json = _lazy_module("json")
 
 
 class json:
@@ -338,8 +1692,8 @@ class json:
     @classmethod
     def _dump(cls, func, obj, *args, **kwargs):
         template = kwargs.pop("template", None)
-        if template is not None:
-            duckable(obj, template, "json validation ")
+        if template is not None and not _disabled:
+            _sampled_check(obj, template, "json validation ")
         return func(obj, *args, **kwargs)
 
     @classmethod
@@ -353,9 +1707,13 @@ class json:
     @classmethod
     def _load(cls, func, *args, **kwargs):
         template = kwargs.pop("template", None)
-        ret = func(*args, **kwargs)
-        if template is not None:
-            duckable(ret, template, "json validation ")
+        if template is None or _disabled:
+            return func(*args, **kwargs)
+        try:
+            ret = func(*args, **kwargs)
+        except RecursionError:
+            raise ObiwanError(" is nested too deeply to parse", "json validation ")
+        _sampled_check(ret, template, "json validation ")
         return ret
 
     @classmethod
@@ -366,53 +1724,615 @@ class json:
     def loads(cls, *args, **kwargs):
         return cls._load(_json.loads, *args, **kwargs)
 
+    @classmethod
+    def load_stream(cls, source, template=any, chunk_size=1 << 16):
+        """parses JSON from a file object or an iterable of byte chunks, checking it against
+        template as it is read; fails at the first violation without reading the rest"""
+        from obiwan import stream
+        return stream.load(source, any if _disabled else template, "json validation ", chunk_size)
+
+    @classmethod
+    async def aload(cls, source, template=any, executor=None, chunk_size=1 << 16):
+        """parses JSON from an async iterable of byte chunks or a stream with an async read(n), e.g. a
+        request body, checking it against template as it arrives; the event loop runs between chunks
+        and documents bigger than a chunk are parsed by a thread of executor, by default the loop's"""
+        from obiwan import stream
+        return await stream.aload(source, any if _disabled else template, "json validation ", executor, chunk_size)
+
+    @classmethod
+    def validate_lines(cls, source, template, workers=None, only_errors=True):
+        """validates JSON lines (NDJSON) from a file path, or an iterable of lines, using a pool of
+        worker processes; workers=1 validates in this process.  Returns an iterable of
+        obiwan.bulk.LineResult(line, path, message) in line order, only the invalid lines
+        unless only_errors is False, whose lines_per_second etc report the throughput"""
+        from obiwan import bulk
+        return bulk.LineValidation(source, template, workers, only_errors)
+
+    @classmethod
+    def validate_array(cls, path, template, workers=None, only_errors=True):
+        """validates the items of the JSON array in the file at path, memory-mapping it and parsing an
+        item at a time, split across a pool of worker processes; workers=1 validates in this process.
+        template is for the whole array e.g. [int].  Returns an iterable of
+        obiwan.bulk.ItemResult(index, offset, path, message) in order, only the invalid items
+        unless only_errors is False, whose items_per_second etc report the throughput"""
+        from obiwan import bulk
+        return bulk.ArrayValidation(path, template, workers, only_errors)
+
+    @classmethod
+    def iter_items(cls, source, template=any, chunk_size=1 << 16):
+        """yields the items of a JSON array from a file object or an iterable of byte chunks
+        one at a time, checking each as it is read; template is for the whole array e.g. [int]"""
+        from obiwan import stream
+        return stream.iter_items(source, any if _disabled else template, "json validation ", chunk_size)
+
+
+class _packed:
+    """the msgpack and cbor wrappers; like json, but documents are checked against template as they
+    are decoded, failing at the first violation, and errors give the byte offset of the bad value.
+    Decoding reads bytes-likes, including mmaps, in place and file objects in chunks; see obiwan.packed"""
+    _format = _package = None
+
+    @classmethod
+    def _template(cls, template):
+        "template, or any if this document isn't to be checked because of its sampling policy or configure()"
+        if template is None or _disabled:
+            return any
+        compiled = compile(template)
+        if compiled.sampling is None or compiled.sampling():
+            return compiled
+        return any
+
+    @classmethod
+    def loads(cls, data, template=None, chunk_size=1 << 16):
+        from obiwan import packed
+        return packed.loads(cls._format, data, cls._template(template), "%s validation " % cls._format, chunk_size)
+
+    @classmethod
+    def load(cls, fp, template=None, chunk_size=1 << 16):
+        "fp can be a file object or an iterable of byte chunks"
+        return cls.loads(fp, template, chunk_size)
+
+    @classmethod
+    def dumps(cls, obj, template=None, **kwargs):
+        if template is not None and not _disabled:
+            _sampled_check(obj, template, "%s validation " % cls._format)
+        return importlib.import_module(cls._package).dumps(obj, **kwargs)
+
+    @classmethod
+    def dump(cls, obj, fp, template=None, **kwargs):
+        if template is not None and not _disabled:
+            _sampled_check(obj, template, "%s validation " % cls._format)
+        importlib.import_module(cls._package).dump(obj, fp, **kwargs)
+
+
+class msgpack(_packed):
+    """a wrapper around msgpack that enables validation; see _packed.  Decoding uses the msgpack
+    package if it is installed and a pure Python decoder if not, but encoding needs the package"""
+    _format = _package = "msgpack"
+
+
+class cbor(_packed):
+    """a wrapper around CBOR that enables validation; see _packed.  Decoding is done by obiwan,
+    but encoding needs the cbor2 package"""
+    _format, _package = "cbor", "cbor2"
+
+
+_annotation_cache = None  # code -> precompiled checks of its function; see _weak_caches()
+_checked_code = None  # code of functions wrapped by checked(), which do their own checking
+
+# inspect's CO_GENERATOR, CO_COROUTINE, CO_ITERABLE_COROUTINE and CO_ASYNC_GENERATOR, without importing inspect
+_CO_GENERATOR, _CO_COROUTINE, _CO_ITERABLE_COROUTINE, _CO_ASYNC_GENERATOR = 0x20, 0x80, 0x100, 0x200
+_CO_SUSPENDABLE = _CO_GENERATOR | _CO_COROUTINE | _CO_ASYNC_GENERATOR | _CO_ITERABLE_COROUTINE
+_CO_GENERATORS = _CO_GENERATOR | _CO_ASYNC_GENERATOR
+
+
+def _is_foreign_annotation(annotation):
+    "annotations written for other type checkers, e.g. typing.Any or list[int], are not obiwan templates"
+    if isinstance(annotation, types.GenericAlias) or type(annotation).__module__ in ("typing", "typing_extensions"):
+        return True
+    union_type = getattr(types, "UnionType", None)  # int | None
+    return union_type is not None and isinstance(annotation, union_type)
+
+
+def _produces(annotation):
+    """the template of the items a generator yields, from its return annotation e.g. [int]; else None.
+    The return annotation of a generator describes the sequence of what it yields"""
+    if isinstance(annotation, list) and len(annotation) == 1 and not isinstance(annotation[0], str) and \
+            not _is_foreign_annotation(annotation[0]):
+        return compile(annotation[0])
+    return None
+
+
+def _compile_annotations(annotations, code=None):
+    """returns ((arg name, CompiledTemplate, is_variadic), ...), return CompiledTemplate or None,
+    yielded item CompiledTemplate or None; or None if there is nothing to check.
+    The annotation of *args and **kwargs applies to each of them.  The return annotation of a
+    coroutine is what it returns when awaited, and of a generator is the list of what it yields.
+    The items of async generators can't be checked this way; use @checked for them"""
+    variadic = ()
+    if code is not None:
+        count = code.co_argcount + code.co_kwonlyargcount
+        variadic = code.co_varnames[count:count + bool(code.co_flags & inspect.CO_VARARGS) +
+            bool(code.co_flags & inspect.CO_VARKEYWORDS)]
+    arg_checks = tuple((key, compile(constraint), key in variadic) for key, constraint in annotations.items()
+        if key != "return" and not isinstance(constraint, str) and not _is_foreign_annotation(constraint))
+    return_check = annotations.get("return")
+    yield_check = None
+    if code is not None and code.co_flags & _CO_GENERATORS:
+        if code.co_flags & _CO_GENERATOR:
+            yield_check = _produces(return_check)
+        return_check = None
+    elif isinstance(return_check, str) or _is_foreign_annotation(return_check):
+        return_check = None
+    elif "return" in annotations:
+        return_check = compile(return_check)
+    if not arg_checks and return_check is None and yield_check is None:
+        return None
+    return arg_checks, return_check, yield_check
+
+
+def _check_locals(arg_checks, f_locals, name):
+    for key, constraint, is_variadic in arg_checks:
+        arg = f_locals[key]
+        ctx = "%s(%s)" % (name, key)
+        if not is_variadic:
+            constraint.check(arg, ctx)
+        else:
+            for arg in (arg.values() if isinstance(arg, dict) else arg):
+                constraint.check(arg, ctx)
+
+
+def _check_arguments(code, frame, arg_checks):
+    if _profiler is None:
+        _check_locals(arg_checks, frame.f_locals, code.co_name)
+    else:
+        _profiler.time_function(_profiler.code_label(code, frame.f_globals) + "()",
+            _check_locals, arg_checks, frame.f_locals, code.co_name)
+
 
-_annotation_cache = weakref.WeakKeyDictionary()
+def _check_return(code, frame, return_check, ret):
+    "frame is None if it is the caller's caller"
+    ctx = "%s()->" % code.co_name
+    if _profiler is None:
+        return_check.check(ret, ctx)
+    else:
+        frame = frame or sys._getframe(2)
+        _profiler.time_function(_profiler.code_label(code, frame.f_globals) + "()->", return_check.check, ret, ctx)
+
+
+def _check_yield(code, frame, yield_check, item):
+    "frame is None if it is the caller's caller"
+    ctx = "%s()->" % code.co_name
+    try:
+        if _profiler is None:
+            yield_check.check(item, ctx)
+        else:
+            frame = frame or sys._getframe(2)
+            _profiler.time_function(_profiler.code_label(code, frame.f_globals) + "()->", yield_check.check, item, ctx)
+    except ObiwanError as e:
+        raise e._at(_INDEX, _ANY_INDEX)
+
+
+def _function_for_code(code, frame):
+    "finds the function object that code belongs to, preferably without scanning the heap"
+    qualname = getattr(code, "co_qualname", None)
+    if qualname and "<locals>" not in qualname:
+        names = qualname.split(".")
+        obj = frame.f_globals.get(names[0])
+        for name in names[1:]:
+            obj = getattr(obj, "__dict__", {}).get(name)
+        candidates = [obj]
+        if isinstance(obj, property):
+            candidates = [obj.fget, obj.fset, obj.fdel]
+        for obj in candidates:
+            obj = getattr(obj, "__func__", obj)  # staticmethod and classmethod
+            while obj is not None:
+                if getattr(obj, "__code__", None) is code:
+                    return obj
+                obj = getattr(obj, "__wrapped__", None)  # decorated by something using functools.wraps
+    # we assume that first gc referrer is the function itself; this is O(heap) but is only done once per code
+    functions = [obj for obj in gc.get_referrers(code) if isinstance(obj, types.FunctionType)]
+    return functions[0] if functions else None
+
+
+def _code_annotations(code, frame):
+    "the precompiled checks for the function that code belongs to, cached per code object"
+    try:
+        return _annotation_cache[code]
+    except KeyError:
+        pass
+    func = _function_for_code(code, frame)
+    annotations = getattr(func, "__annotations__", None)
+    if not annotations or _is_checked(func) or code in _checked_code:
+        frame_info = None
+    else:
+        frame_info = _compile_annotations(annotations, code)
+    _annotation_cache[code] = frame_info
+    return frame_info
+
+
+def _resumed(frame):
+    "whether a call event is a generator or coroutine carrying on after a yield or await, rather than starting"
+    if not frame.f_code.co_flags & _CO_SUSPENDABLE or frame.f_lasti < 0:
+        return False
+    code = frame.f_code.co_code
+    if opcode.opname[code[frame.f_lasti]] == "RESUME":  # Python 3.11+
+        return code[frame.f_lasti + 1] & 3 != 0  # its argument says where it is resuming from; 0 is the start
+    return True
 
 
 def _runtime_checker(frame, evt, arg):
     global _enabled
-    if not _enabled:
+    if not _enabled or _disabled:
         return
     if evt == "call":
-        # we cache those we've looked up
-        # we use frame.f_code itself as key;
-        if not frame.f_code in _annotation_cache:
-            # we assume that first gc referrer is the function itself
-            # this code seems very fragile and hackish;
-            # TODO much nicer to use inspect.signature(frame) if that works in Python 3.3...
-            frame_info = [obj for obj in gc.get_referrers(frame.f_code) if isinstance(obj, types.FunctionType)]
-            # does the first gc referrer have annotations?
-            if frame_info and hasattr(frame_info[0], "__annotations__") and frame_info[0].__annotations__:
-                frame_info = frame_info[0]
-            else:
-                frame_info = None
-            _annotation_cache[frame.f_code] = frame_info
-        else:
-            frame_info = _annotation_cache[frame.f_code]
-        # frame_info is set to a function object with annoations?
-        if frame_info:
-            return_intercept = None
-            for key, constraint in frame_info.__annotations__.items():
-                if key == "return":  # we want to track the return type too
-                    return_intercept = _runtime_checker
-                    continue
-                arg = frame.f_locals[key]
-                duckable(arg, constraint, "%s(%s)" % (frame.f_code.co_name, key))
-            return return_intercept
+        frame_info = _code_annotations(frame.f_code, frame)
+        # frame_info is set to the precompiled checks of a function with annotations?
+        if frame_info and not _resumed(frame):  # the frame's tracing carries on when it is resumed
+            policy = _function_sampling.get(frame.f_code)
+            if policy is not None and not policy():
+                return
+            arg_checks, return_check, yield_check = frame_info
+            _check_arguments(frame.f_code, frame, arg_checks)
+            if return_check is not None or yield_check is not None:  # we want to track the return type too
+                frame.f_trace_lines = False
+                return _runtime_checker
     elif evt == "return":
-        if (arg is not None) or (opcode.opname[frame.f_code.co_code[frame.f_lasti]] in ('RETURN_VALUE', 'YIELD_VALUE')):
-            frame_info = _annotation_cache[frame.f_code]
-            constraint = frame_info.__annotations__["return"]
-            duckable(arg, constraint, "%s()->" % frame.f_code.co_name)
-        # else we are in an exception! Super messy horrid hack code
-        # http://stackoverflow.com/a/12800909/15721
-
-def install_obiwan_runtime_check():
+        # return events also happen when generators yield and coroutines await, and when exceptions
+        # are raised, when arg is None
+        op = opcode.opname[frame.f_code.co_code[frame.f_lasti]]
+        if op in ("YIELD_VALUE", "RESUME"):  # Python 3.13+ is already at where it will resume
+            if frame.f_code.co_flags & _CO_GENERATOR:
+                _check_yield(frame.f_code, frame, _annotation_cache[frame.f_code][2], arg)
+        elif arg is not None or op in ("RETURN_VALUE", "RETURN_CONST"):
+            return_check = _annotation_cache[frame.f_code][1]
+            if return_check is not None:
+                _check_return(frame.f_code, frame, return_check, arg)
+
+
+_monitoring_tool = None
+_monitored_yields = None  # the code objects that PY_YIELD has been enabled for
+_sampled_out = set()  # the ids of the frames of sampled functions whose calls are not being checked
+
+
+def _monitor_start(code, instruction_offset):
+    if not _enabled or _disabled:
+        return
+    frame = sys._getframe(1)
+    frame_info = _code_annotations(code, frame)
+    if not frame_info:
+        return sys.monitoring.DISABLE  # never called again for this code
+    policy = _function_sampling.get(code)
+    if policy is not None:
+        # the decision is made once per call, and its return is checked only if its arguments are
+        if not policy():
+            _sampled_out.add(id(frame))
+            return
+        _sampled_out.discard(id(frame))  # a frame of a call that raised may have been at the same address
+    _check_arguments(code, frame, frame_info[0])
+    if frame_info[2] is not None and code not in _monitored_yields:
+        # yields are only monitored for generators that have a template for what they yield
+        sys.monitoring.set_local_events(_monitoring_tool, code, sys.monitoring.events.PY_YIELD)
+        _monitored_yields.add(code)
+
+
+def _monitor_yield(code, instruction_offset, value):
+    if not _enabled or _disabled:
+        return
+    frame_info = _annotation_cache.get(code)
+    if not frame_info or frame_info[2] is None:
+        return sys.monitoring.DISABLE
+    _check_yield(code, None, frame_info[2], value)
+
+
+def _monitor_return(code, instruction_offset, retval):
+    if not _enabled or _disabled:
+        return
+    frame_info = _annotation_cache.get(code)
+    if not frame_info or frame_info[1] is None:
+        return sys.monitoring.DISABLE
+    if code in _function_sampling:
+        frame_id = id(sys._getframe(1))
+        if frame_id in _sampled_out:
+            _sampled_out.discard(frame_id)
+            return
+    _check_return(code, None, frame_info[1], retval)
+
+
+def _install_monitoring():
+    "uses PEP 669 sys.monitoring, which is process-wide and costs nothing for unannotated code"
+    global _monitoring_tool
+    if _monitoring_tool is not None:
+        return
+    monitoring = sys.monitoring
+    for tool in range(6):  # ids 0-5 are available to tools
+        if monitoring.get_tool(tool) is None:
+            break
+    else:
+        raise RuntimeError("no free sys.monitoring tool id for obiwan")
+    monitoring.use_tool_id(tool, "obiwan")
+    monitoring.register_callback(tool, monitoring.events.PY_START, _monitor_start)
+    monitoring.register_callback(tool, monitoring.events.PY_RETURN, _monitor_return)
+    monitoring.register_callback(tool, monitoring.events.PY_YIELD, _monitor_yield)
+    # returns are only monitored once we've seen the function is annotated, but
+    # PY_RETURN has to be enabled globally to be DISABLEd per code object
+    monitoring.set_events(tool, monitoring.events.PY_START | monitoring.events.PY_RETURN)
+    _monitoring_tool = tool
+
+
+def _uninstall_monitoring():
+    global _monitoring_tool
+    if _monitoring_tool is None:
+        return
+    sys.monitoring.set_events(_monitoring_tool, 0)
+    sys.monitoring.free_tool_id(_monitoring_tool)
+    _monitoring_tool = None
+    _monitored_yields.clear()
+    _sampled_out.clear()
+
+
+def install_obiwan_runtime_check(backend=None):
+    """checks every call of every annotated function;
+    backend is "monitoring" (all threads; the default on Python 3.12+) or "settrace" (the calling thread only)"""
     global _enabled
+    if _disabled:
+        return  # see configure()
+    if backend is None:
+        backend = "monitoring" if hasattr(sys, "monitoring") else "settrace"
+    _weak_caches()
+    if backend == "monitoring":
+        _install_monitoring()
+    elif backend == "settrace":
+        sys.settrace(_runtime_checker)
+    else:
+        raise ValueError("unknown runtime check backend %r" % (backend,))
     _enabled = True
-    sys.settrace(_runtime_checker)
-    def disable():
-        global _enabled
-        _enabled = False
-    atexit.register(disable)
+    atexit.unregister(_disable_at_exit)  # so installing again doesn't register it again
+    atexit.register(_disable_at_exit)
+
+
+def _disable_at_exit():
+    global _enabled
+    _enabled = False
+
+
+def uninstall_obiwan_runtime_check():
+    "stops runtime checking installed by install_obiwan_runtime_check()"
+    global _enabled
+    _enabled = False
+    if sys.gettrace() is _runtime_checker:
+        sys.settrace(None)
+    _uninstall_monitoring()
+
+
+def _checked_yields(gen, check_item):
+    """yields what generator gen yields, passing on what is sent and thrown to it and returning
+    what it returns; calls check_item(item, index) with each item before it is yielded"""
+    index = 0
+    value = thrown = None
+    while True:
+        try:
+            if thrown is None:
+                item = gen.send(value)
+            else:
+                item, thrown = gen.throw(thrown), None
+        except StopIteration as e:
+            return e.value
+        try:
+            check_item(item, index)
+        except ObiwanError:
+            gen.close()
+            raise
+        index += 1
+        try:
+            value = yield item
+        except GeneratorExit:
+            gen.close()
+            raise
+        except BaseException as e:
+            thrown = e
+
+
+def _is_checked(func):
+    return getattr(func, "__obiwan_checked__", False)
+
+
+def checked(func=None, sampling=None):
+    """decorator that checks the annotated parameters and return value of func on every call;
+    unlike install_obiwan_runtime_check() only the decorated functions pay for checking.
+    Templates are compiled once when decorating; unannotated functions are returned as-is.
+    Can be applied either side of @staticmethod and @classmethod.
+    Use @checked(sampling=...) to check only some calls; see sampling"""
+    if func is None:
+        return functools.partial(checked, sampling=sampling)
+    if _disabled:
+        return func  # see configure()
+    if isinstance(func, (staticmethod, classmethod)):
+        return type(func)(checked(func.__func__, sampling))
+    if _is_checked(func):
+        if sampling is not None:
+            func.sampling = sampling
+        return func
+    annotations = getattr(func, "__annotations__", None)
+    if not annotations or all(isinstance(a, str) or _is_foreign_annotation(a) for a in annotations.values()):
+        return func  # nothing to check, so no wrapper and no overhead
+    name = func.__name__
+    positional, keyword = [], []
+    var_positional = var_keyword = None
+    parameters = inspect.signature(func, follow_wrapped=False).parameters
+    for index, param in enumerate(parameters.values()):
+        constraint = annotations.get(param.name)
+        if constraint is None or isinstance(constraint, str) or _is_foreign_annotation(constraint):
+            continue
+        check = (param.name, compile(constraint), "%s(%s)" % (name, param.name))
+        if param.kind is param.VAR_POSITIONAL:
+            var_positional = (index,) + check
+        elif param.kind is param.VAR_KEYWORD:
+            var_keyword = check
+        elif param.kind is param.KEYWORD_ONLY:
+            keyword.append(check)
+        else:
+            positional.append((index,) + check)
+    positional, keyword = tuple(positional), tuple(keyword)
+    return_check = item_check = None
+    is_generator, is_async_generator = inspect.isgeneratorfunction(func), inspect.isasyncgenfunction(func)
+    if is_generator or is_async_generator:
+        item_check = _produces(annotations.get("return"))
+    elif "return" in annotations and not isinstance(annotations["return"], str) and \
+            not _is_foreign_annotation(annotations["return"]):
+        return_check = compile(annotations["return"])  # for coroutines, what they return when awaited
+    return_ctx = "%s()->" % name
+    label = "%s.%s" % (func.__module__, func.__qualname__)
+    arguments_label, return_label = label + "()", label + "()->"
+
+    def check_arguments(args, kwargs):
+        # defaulted parameters are not checked; they are the author's choice
+        for index, key, constraint, ctx in positional:
+            if index < len(args):
+                constraint.check(args[index], ctx)
+            elif key in kwargs:
+                constraint.check(kwargs[key], ctx)
+        for key, constraint, ctx in keyword:
+            if key in kwargs:
+                constraint.check(kwargs[key], ctx)
+        if var_positional is not None:
+            index, key, constraint, ctx = var_positional
+            for arg in args[index:]:
+                constraint.check(arg, ctx)
+        if var_keyword is not None:
+            key, constraint, ctx = var_keyword
+            for key, arg in kwargs.items():
+                if key not in parameters:
+                    constraint.check(arg, ctx)
+
+    def checking(args, kwargs):
+        "checks the arguments of a call, unless it is sampled out; returns whether it was checked"
+        policy = checked_wrapper.sampling
+        if _disabled or policy is not None and not policy():
+            return False
+        if _profiler is None:
+            check_arguments(args, kwargs)
+        else:
+            _profiler.time_function(arguments_label, check_arguments, args, kwargs)
+        return True
+
+    def check_result(ret, check=None, index=None):
+        check = check or return_check
+        try:
+            if _profiler is None:
+                check.check(ret, return_ctx)
+            else:
+                _profiler.time_function(return_label, check.check, ret, return_ctx)
+        except ObiwanError as e:
+            if index is not None:
+                e._at(_INDEX, index)
+            raise
+
+    def check_item(item, index):
+        check_result(item, item_check, index)
+
+    # generators and coroutines are wrapped in their own kind, so they can still be recognised as such;
+    # their arguments are checked when they start running
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def checked_wrapper(*args, **kwargs):
+            if not checking(args, kwargs):
+                return await func(*args, **kwargs)
+            ret = await func(*args, **kwargs)
+            if return_check is not None:
+                check_result(ret)
+            return ret
+    elif is_generator:
+        @functools.wraps(func)
+        def checked_wrapper(*args, **kwargs):
+            if not checking(args, kwargs) or item_check is None:
+                return (yield from func(*args, **kwargs))
+            return (yield from _checked_yields(func(*args, **kwargs), check_item))
+    elif is_async_generator:
+        @functools.wraps(func)
+        async def checked_wrapper(*args, **kwargs):
+            agen = func(*args, **kwargs)
+            check = check_item if checking(args, kwargs) and item_check is not None else None
+            # async generators can't yield from another, so pass on what is sent and thrown by hand
+            index = 0
+            value = thrown = None
+            while True:
+                try:
+                    if thrown is None:
+                        item = await agen.asend(value)
+                    else:
+                        item, thrown = await agen.athrow(thrown), None
+                except StopAsyncIteration:
+                    return
+                if check is not None:
+                    try:
+                        check(item, index)
+                    except ObiwanError:
+                        await agen.aclose()
+                        raise
+                index += 1
+                try:
+                    value = yield item
+                except GeneratorExit:
+                    await agen.aclose()
+                    raise
+                except BaseException as e:
+                    thrown = e
+    else:
+        @functools.wraps(func)
+        def checked_wrapper(*args, **kwargs):
+            policy = checked_wrapper.sampling
+            if _disabled or policy is not None and not policy():
+                return func(*args, **kwargs)
+            if _profiler is None:
+                check_arguments(args, kwargs)
+            else:
+                _profiler.time_function(arguments_label, check_arguments, args, kwargs)
+            ret = func(*args, **kwargs)
+            if return_check is not None:
+                if _profiler is None:
+                    return_check.check(ret, return_ctx)
+                else:
+                    _profiler.time_function(return_label, return_check.check, ret, return_ctx)
+            return ret
+    checked_wrapper.__obiwan_checked__ = True
+    checked_wrapper.sampling = sampling
+    if hasattr(func, "__code__"):
+        _weak_caches()
+        _checked_code.add(func.__code__)
+    return checked_wrapper
+
+
+def instrument(target, sampling=None):
+    """wraps every annotated function defined in a module or class with checked();
+    classes defined in the module are instrumented too.  Each function gets its own copy()
+    of the sampling policy, so they don't share one budget of checks.  Returns target"""
+    def wrap(func):
+        return checked(func, None if sampling is None else sampling.copy())
+    if isinstance(target, type):
+        for key, value in list(vars(target).items()):
+            if isinstance(value, property):
+                wrapped = property(*(wrap(f) if f is not None else None
+                    for f in (value.fget, value.fset, value.fdel)), value.__doc__)
+            elif isinstance(value, (types.FunctionType, staticmethod, classmethod)):
+                wrapped = wrap(value)
+            elif isinstance(value, type) and value.__module__ == target.__module__ and \
+                    value.__qualname__.startswith(target.__qualname__ + "."):
+                wrapped = instrument(value, sampling)
+            else:
+                continue
+            if wrapped is not value:
+                setattr(target, key, wrapped)
+    elif isinstance(target, types.ModuleType):
+        for key, value in list(vars(target).items()):
+            if getattr(value, "__module__", None) != target.__name__:
+                continue  # imported from elsewhere
+            if isinstance(value, types.FunctionType):
+                wrapped = wrap(value)
+                if wrapped is not value:
+                    setattr(target, key, wrapped)
+            elif isinstance(value, type):
+                instrument(value, sampling)
+    else:
+        raise TypeError("can only instrument modules and classes, not %s" % type(target))
+    return target
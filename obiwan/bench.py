@@ -0,0 +1,251 @@
+"""benchmarks for obiwan, so that releases can be compared
+
+Run with:
+
+    python -m obiwan.bench [-o results.json] [--compare old.json] [duckable json runtime ...]
+
+Results are written as JSON: the time per call of each benchmark, with the Python and
+obiwan versions they were measured with.  With --compare, the ratio of each timing to
+the matching one in an earlier results file is printed too.
+"""
+
+import argparse
+import json as _json
+import platform
+import sys
+import timeit
+
+import obiwan
+from obiwan import duck, duckable, function, number, options, strict, subtype, union
+
+
+class Benchmark:
+    "a named callable to time; params describe its size, so results of different sizes can be told apart"
+
+    def __init__(self, group, name, func, params=None):
+        self.group = group
+        self.name = name
+        self.func = func
+        self.params = params or {}
+
+    def prepare(self):
+        "makes what the benchmark needs, once it is known to be run; most are ready when they are made"
+
+
+def _nested(depth):
+    "a template and a matching document that are nested depth dicts deep"
+    template, document = {"leaf": int}, {"leaf": 1}
+    for level in range(depth):
+        template = {"name": str, "count": int, "child": template, "tags": [str]}
+        document = {"name": "level%d" % level, "count": level, "child": document, "tags": ["a", "b"]}
+    return template, document
+
+
+def _wide(width, chain):
+    "a strict template of width keys, built from a chain of subtypes"
+    template = {"id": int}
+    for link in range(chain):
+        template = {options: [strict, subtype(template)], "field%d" % link: str}
+    template = dict(template, **{"key%d" % i: int for i in range(width)})
+    document = {"id": 1}
+    document.update(("field%d" % link, "x") for link in range(chain))
+    document.update(("key%d" % i, i) for i in range(width))
+    return template, document
+
+
+class _Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def norm(self) -> float:
+        return (self.x ** 2 + self.y ** 2) ** 0.5
+
+
+def _checker(template, obj):
+    return lambda: duckable(obj, template)
+
+
+def duckable_benchmarks():
+    for depth in (4, 16):
+        template, document = _nested(depth)
+        yield Benchmark("duckable", "nested_dict", _checker(template, document), {"depth": depth})
+    for width, chain in ((16, 2), (128, 8)):
+        template, document = _wide(width, chain)
+        yield Benchmark("duckable", "strict_subtype_dict", _checker(template, document),
+                        {"width": width, "chain": chain})
+    for size in (100, 10000):
+        yield Benchmark("duckable", "int_list", _checker([int], list(range(size))), {"size": size})
+        yield Benchmark("duckable", "tuple_ellipsis", _checker((str, int, ...), ("x",) + tuple(range(size))),
+                        {"size": size})
+    yield Benchmark("duckable", "generic_dict", _checker({str: int}, {"k%d" % i: i for i in range(1000)}),
+                    {"size": 1000})
+    yield Benchmark("duckable", "duck", _checker(duck(x=number, y=number, norm=function), _Point(3, 4)))
+    yield Benchmark("duckable", "duck_list", _checker([duck(x=number, y=number)], [_Point(i, i) for i in range(1000)]),
+                    {"size": 1000})
+    variants = [{"type": "event%d" % i, "event%d" % i: int, "payload": {"value": number}} for i in range(20)]
+    last = {"type": "event19", "event19": 1, "payload": {"value": 1.5}}
+    yield Benchmark("duckable", "union", _checker(union(*variants), last), {"variants": 20})
+    yield Benchmark("duckable", "union_discriminator", _checker(union(*variants, discriminator="type"), last),
+                    {"variants": 20})
+    yield Benchmark("duckable", "number_set", _checker([{int, float, str, bytes, None}], [None] * 1000),
+                    {"size": 1000})
+    yield Benchmark("duckable", "lambda", _checker([lambda obj: obj % 2 == 0], list(range(0, 2000, 2))),
+                    {"size": 1000})
+
+
+class _JsonBenchmark(Benchmark):
+    "times load(text) of a JSON document of size items, which is only made if the benchmark is run"
+
+    def __init__(self, name, load, size, documents):
+        super().__init__("json", name, None, {"size": size})
+        self.load = load
+        self.documents = documents  # size -> text, shared by the benchmarks of each size
+
+    def prepare(self):
+        size = self.params["size"]
+        text = self.documents.get(size)
+        if text is None:
+            text = self.documents[size] = _json.dumps([{"id": i, "name": "user%d" % i, "score": i / 3,
+                "tags": ["a", "b"], "owner": {"id": i, "email": "u%d@example.com" % i}} for i in range(size)])
+        self.params["bytes"] = len(text)
+        self.func = lambda: self.load(text)
+
+
+def json_benchmarks():
+    template = [{"id": int, "name": str, "score": float, "tags": [str], "owner": {"id": int, "email": str}}]
+    documents = {}
+    for size in (10, 1000, 100000):
+        yield _JsonBenchmark("loads", _json.loads, size, documents)
+        yield _JsonBenchmark("loads_template", lambda text: obiwan.json.loads(text, template=template), size,
+                             documents)
+
+
+def _call(a: int, b: str, c: [int]) -> int:
+    return a
+
+
+class _RuntimeBenchmark(Benchmark):
+    """times the call with runtime checking installed with backend, or not at all if None, only while
+    it is being timed; any runtime checking that was already installed is put back afterwards"""
+
+    def __init__(self, name, backend, params=None):
+        args = (1, "b", [1, 2, 3])
+        super().__init__("runtime", name, lambda: _call(*args), params)
+        self.backend = backend
+
+    def __enter__(self):
+        self.previous = sys.gettrace(), obiwan._monitoring_tool is not None, obiwan._enabled
+        obiwan.uninstall_obiwan_runtime_check()
+        if self.backend:
+            obiwan.install_obiwan_runtime_check(self.backend)
+
+    def __exit__(self, *exc):
+        obiwan.uninstall_obiwan_runtime_check()
+        trace, monitoring, obiwan._enabled = self.previous
+        sys.settrace(trace)  # whoever's it was, e.g. a coverage tool's
+        if monitoring:
+            obiwan._install_monitoring()
+
+
+def runtime_benchmarks():
+    yield _RuntimeBenchmark("unchecked_call", None)
+    decorated = obiwan.checked(_call)
+    args = (1, "b", [1, 2, 3])
+    yield Benchmark("runtime", "decorated_call", lambda: decorated(*args))
+    backends = ["settrace"]
+    if hasattr(sys, "monitoring"):
+        backends.insert(0, "monitoring")
+    for backend in backends:
+        yield _RuntimeBenchmark("installed_call", backend, {"backend": backend})
+
+
+BENCHMARKS = (duckable_benchmarks, json_benchmarks, runtime_benchmarks)
+
+
+def _key(result):
+    return result["group"], result["name"], tuple(sorted(result["params"].items()))
+
+
+def measure(benchmark, repeat=5, min_time=0.2):
+    "returns the best time per call in seconds, from repeat runs of at least min_time seconds each"
+    timer = timeit.Timer(benchmark.func)
+    calls = 1
+    while True:  # like Timer.autorange, but to min_time
+        if timer.timeit(calls) >= min_time:
+            break
+        calls *= 2 if calls < 10 else 10
+    return min(timer.repeat(repeat, calls)) / calls, calls
+
+
+def run(patterns=(), repeat=5, min_time=0.2, log=None):
+    "runs the benchmarks whose group.name contains any of patterns, or all of them; returns the results dict"
+    results = []
+    for benchmarks in BENCHMARKS:
+        for benchmark in benchmarks():
+            full_name = "%s.%s" % (benchmark.group, benchmark.name)
+            if patterns and not any(pattern in full_name for pattern in patterns):
+                continue
+            benchmark.prepare()
+            if isinstance(benchmark, _RuntimeBenchmark):
+                with benchmark:
+                    seconds, calls = measure(benchmark, repeat, min_time)
+            else:
+                seconds, calls = measure(benchmark, repeat, min_time)
+            results.append({"group": benchmark.group, "name": benchmark.name, "params": benchmark.params,
+                            "seconds_per_call": seconds, "calls": calls})
+            if log:
+                log("%-32s %-32s %12.3f us" % (full_name, _params(benchmark.params), seconds * 1e6))
+    return {"obiwan": _version(), "python": platform.python_version(),
+            "implementation": platform.python_implementation(), "platform": platform.platform(),
+            "benchmarks": results}
+
+
+def compare(old, new):
+    "yields (result, ratio) for results in new that are also in old; a ratio above 1 means slower"
+    before = {_key(result): result for result in old["benchmarks"]}
+    for result in new["benchmarks"]:
+        match = before.get(_key(result))
+        if match:
+            yield result, result["seconds_per_call"] / match["seconds_per_call"]
+
+
+def _params(params):
+    return " ".join("%s=%s" % item for item in sorted(params.items()))
+
+
+def _version():
+    try:
+        from importlib import metadata
+        return metadata.version("obiwan")
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m obiwan.bench", description=__doc__.split("\n")[0])
+    parser.add_argument("filter", nargs="*", help="only run benchmarks whose group.name contains one of these")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file rather than stdout")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per benchmark; the best is kept")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per timing run")
+    parser.add_argument("--compare", help="an earlier JSON results file to compare against")
+    parser.add_argument("-q", "--quiet", action="store_true", help="don't print progress to stderr")
+    args = parser.parse_args(argv)
+    log = None if args.quiet else lambda line: print(line, file=sys.stderr)
+    results = run(args.filter, args.repeat, args.min_time, log)
+    if args.output:
+        with open(args.output, "w") as out:
+            _json.dump(results, out, indent=2)
+    else:
+        _json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            old = _json.load(f)
+        for result, ratio in compare(old, results):
+            print("%-32s %-32s %6.2fx" % ("%s.%s" % (result["group"], result["name"]),
+                                          _params(result["params"]), ratio), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+"""validating files of JSON lines (NDJSON), and big JSON arrays, against a template on all cores
+
+The input is split into chunks which are validated by a pool of worker processes, each of
+which compiles the template once.  Results come back in order, and only a bounded number
+of chunks are in flight at once, so memory does not grow with the input.
+
+JSON array files are memory-mapped and parsed an item at a time, so memory is bounded by the
+biggest item.  As an item can't be told from the middle of a string without parsing everything
+before it, the file is split where items probably start; each chunk is parsed up to the item
+after its end, and if that isn't where the next chunk started, the next chunk is parsed again.
+"""
+
+import collections
+import concurrent.futures
+import mmap
+import multiprocessing
+import os
+import re
+import time
+import json as _json
+
+from obiwan import ObiwanError, compile, _INDEX
+
+LineResult = collections.namedtuple("LineResult", "line path message")
+LineResult.__doc__ = """the outcome of validating a line; line numbers start at 1.
+message is None if the line is valid, and path is None if it is not valid JSON"""
+
+ItemResult = collections.namedtuple("ItemResult", "index offset path message")
+ItemResult.__doc__ = """the outcome of validating an item of a JSON array; indexes start at 0 and
+offset is the byte offset of the problem, or None if the item is valid, when message is None too.
+path is None if it is not valid JSON, when it is the last result"""
+
+DEFAULT_CHUNK_BYTES = 1 << 22
+DEFAULT_CHUNK_LINES = 10000
+DEFAULT_WINDOW = 1 << 20  # the bytes of an array file decoded at a time; it grows to fit big items
+
+_worker_template = None  # the compiled template, in worker processes
+
+
+def _init_worker(template):
+    global _worker_template
+    _worker_template = compile(template)
+
+
+def _check_lines(lines, limits, compiled=None):
+    "returns (line count, byte count, [(index, ObiwanError or message), ...]) for a chunk of lines"
+    compiled = compiled or _worker_template
+    errors = []
+    size = 0
+    for index, line in enumerate(lines):
+        size += len(line)
+        if not line.strip():
+            continue
+        try:
+            value = _json.loads(line)
+            if limits is not None:
+                limits.check(value)
+            compiled._check(value)
+        except ObiwanError as e:
+            errors.append((index, e))
+        except ValueError as e:
+            errors.append((index, "is not valid JSON: %s" % e))
+        except Exception as e:
+            errors.append((index, ObiwanError(" internal error: %s" % e)))
+    return len(lines), size, errors
+
+
+def _read_lines(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.split(b"\n")
+    if data.endswith(b"\n"):
+        lines.pop()
+    return lines
+
+
+def _check_file_range(path, start, end, limits, compiled=None):
+    return _check_lines(_read_lines(path, start, end), limits, compiled)
+
+
+def _file_ranges(path, chunk_bytes):
+    "splits a file into ranges of about chunk_bytes that end at line boundaries"
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            if f.tell() < size:
+                f.readline()
+            end = f.tell()
+            yield start, end
+            start = end
+
+
+def _batches(lines, chunk_lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= chunk_lines:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ordered_results(tasks, template, workers):
+    """yields func(*args) for each (func, args) of tasks, in order, calling them in a pool of workers
+    processes; funcs are given the compiled template as an extra argument if they are called here"""
+    if workers <= 1:
+        compiled = compile(template)
+        for func, args in tasks:
+            yield func(*args, compiled)
+        return
+    context = None
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")  # so templates with lambdas need not be pickled
+    pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+        initializer=_init_worker, initargs=(template,))
+    pending = collections.deque()
+    try:
+        for func, args in tasks:
+            pending.append(pool.submit(func, *args))
+            if len(pending) >= workers * 2:  # bound the work, and so the memory, in flight
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class LineValidation:
+    """iterates over the LineResults of validating JSON lines; by default only the invalid ones.
+    The counters are updated as it goes, so the throughput is known during and afterwards"""
+    def __init__(self, source, template, workers=None, only_errors=True,
+            chunk_bytes=DEFAULT_CHUNK_BYTES, chunk_lines=DEFAULT_CHUNK_LINES):
+        self.source, self.template, self.only_errors = source, template, only_errors
+        self.limits = compile(template).limits
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk_bytes, self.chunk_lines = chunk_bytes, chunk_lines
+        self.lines = self.bytes = self.errors = 0
+        self.started = self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def lines_per_second(self):
+        return self.lines / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return {"lines": self.lines, "bytes": self.bytes, "errors": self.errors, "seconds": self.elapsed,
+            "lines_per_second": self.lines_per_second, "bytes_per_second": self.bytes_per_second}
+
+    def _tasks(self):
+        "yields (function, args) for each chunk of the input"
+        if isinstance(self.source, (str, bytes, os.PathLike)):
+            for start, end in _file_ranges(self.source, self.chunk_bytes):
+                yield _check_file_range, (self.source, start, end, self.limits)
+        else:
+            for batch in _batches(self.source, self.chunk_lines):
+                yield _check_lines, (batch, self.limits)
+
+    def __iter__(self):
+        self.started = time.monotonic()
+        try:
+            for count, size, errors in _ordered_results(self._tasks(), self.template, self.workers):
+                first = self.lines + 1
+                errors = dict(errors)
+                for index in (range(count) if not self.only_errors else sorted(errors)):
+                    error = errors.get(index)
+                    if error is None:
+                        yield LineResult(first + index, (), None)
+                    elif isinstance(error, ObiwanError):
+                        error.ctx = "line %d" % (first + index)
+                        yield LineResult(first + index, error.path, str(error))
+                    else:
+                        yield LineResult(first + index, None, "line %d %s" % (first + index, error))
+                self.lines += count
+                self.bytes += size
+                self.errors += len(errors)
+        finally:
+            self.finished = time.monotonic()
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_SEPARATOR = re.compile(r"[ \t\n\r]*,[ \t\n\r]*")
+_BYTES_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_decoder = _json.JSONDecoder()
+
+
+class ArrayItems:
+    """parses the items of a JSON array from data, a bytes-like such as an mmap, from byte offset pos;
+    first is whether pos is the start of the first item, when the array may be empty.  Only a window
+    of data is decoded at a time, so memory is bounded by the biggest item.  Malformed JSON raises
+    json.JSONDecodeError whose pos is the byte offset"""
+    def __init__(self, data, pos, first=True, window=DEFAULT_WINDOW):
+        self.view = memoryview(data)
+        self.size = len(self.view)
+        self.window = window
+        self.first = first
+        self.ended = False  # whether the end of the array has been read
+        self.start = None  # the byte offset of the window
+        self.pos = pos  # the byte offset of the next item, or of what's next
+        self._load(pos)
+
+    def close(self):
+        "releases data, so that an mmap can be closed"
+        self.view.release()
+
+    def _load(self, pos):
+        "decodes the window of data from byte offset pos, making it bigger if it already starts there"
+        if pos == self.start:
+            self.window *= 2
+        end = min(self.size, pos + self.window)
+        while pos < end < self.size and self.view[end] & 0xc0 == 0x80:  # don't split a character
+            end -= 1
+        try:
+            with self.view[pos:end] as window:
+                self.text = str(window, "utf-8")
+        except UnicodeDecodeError as e:
+            raise _json.JSONDecodeError("Invalid UTF-8 (%s)" % e.reason, "", pos + e.start) from None
+        self.start, self.index, self.pos = pos, 0, pos
+        self.ascii = len(self.text) == end - pos
+        self.complete = end == self.size
+
+    def _offset(self, index):
+        "the byte offset of a character index of the window at or after the current one"
+        if self.ascii:
+            return self.pos + index - self.index
+        return self.pos + len(self.text[self.index:index].encode("utf-8"))
+
+    def _advance(self, index):
+        self.pos = self._offset(index)
+        self.index = index
+
+    def _skip(self):
+        "skips whitespace, returning the next character, or '' at the end of data"
+        while True:
+            self._advance(_WHITESPACE.match(self.text, self.index).end())
+            if self.index < len(self.text):
+                return self.text[self.index]
+            if self.complete:
+                return ""
+            self._load(self.pos)
+
+    def _error(self, message, index):
+        return _json.JSONDecodeError(message, "", self._offset(index))
+
+    def next(self):
+        """returns (offset, end offset, value) of the next item, or None after the end of the array;
+        pos is then the offset of the item after"""
+        if self.ended:
+            return None
+        if self._skip() == "]" and self.first:
+            self._end()
+            return None
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.index)
+                if end < len(self.text) or self.complete:  # a number at the end of the window might go on
+                    break
+            except _json.JSONDecodeError as e:
+                if self.complete:
+                    raise self._error(e.msg, e.pos)
+            self._load(self.pos)
+        offset = self.pos
+        self._advance(end)
+        item_end = self.pos
+        match = _SEPARATOR.match(self.text, end)
+        if match and match.end() < len(self.text):  # the usual case, the comma and the start of the next item
+            self._advance(match.end())
+            self.first = False
+            return offset, item_end, value
+        c = self._skip()
+        if c == ",":
+            self._advance(self.index + 1)
+            self._skip()
+        elif c == "]":
+            self._end()
+        else:
+            raise self._error("Expecting ',' delimiter", self.index)
+        self.first = False
+        return offset, item_end, value
+
+    def _end(self):
+        self._advance(self.index + 1)
+        self.ended = True
+        end = _BYTES_WHITESPACE.match(self.view, self.pos).end()
+        if end < self.size:
+            raise _json.JSONDecodeError("Extra data", "", end)
+
+
+def _array_start(data):
+    "the byte offset of the first item of the JSON array in data"
+    start = _BYTES_WHITESPACE.match(data).end()
+    if data[start:start + 1] != b"[":
+        raise _json.JSONDecodeError("Expecting '['", "", start)
+    return _BYTES_WHITESPACE.match(data, start + 1).end()
+
+
+def _located(view, offset, end, compiled, error):
+    "the error of an item, with the path and offset within the item found by parsing it again as a stream"
+    from obiwan import stream
+    try:
+        stream.load(bytes(view[offset:end]), compiled, None)
+    except ObiwanError as e:
+        e.offset += offset
+        return e
+    except ValueError:
+        pass
+    error.offset = offset
+    return error
+
+
+def _check_array_range(path, start, end, first, limits, compiled=None):
+    """checks the items of the JSON array in the file at path that start at or after byte offset start
+    and before end, each within the limits of the array's items, returning (start, end, item count, byte count, [(index, ObiwanError or message)], stop);
+    stop is the offset of the next item, or None after the end of the array or malformed JSON"""
+    compiled = compiled or _worker_template
+    count, size, errors, stop = 0, 0, [], None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        items = None
+        try:
+            items = ArrayItems(data, start, first)
+            while items.pos < end:
+                item = items.next()
+                if item is None:
+                    break
+                offset, item_end, value = item
+                try:
+                    if limits is not None:
+                        limits._walk(value, 2, 1, None)  # an item is nested in the array
+                except ObiwanError as e:
+                    e.offset = offset
+                    errors.append((count, e))
+                    count += 1
+                    continue
+                try:
+                    compiled._check(value)
+                except ObiwanError as e:
+                    errors.append((count, _located(items.view, offset, item_end, compiled, e)))
+                except Exception as e:
+                    error = ObiwanError(" internal error: %s" % e)
+                    error.offset = offset
+                    errors.append((count, error))
+                count += 1
+            else:
+                if items.pos >= items.size and not items.ended:  # the data ended within the array
+                    raise _json.JSONDecodeError("Expecting value", "", items.size)
+                stop = items.pos
+        except ValueError as e:
+            errors.append((count, "is not valid JSON: %s (at byte offset %d)" % (getattr(e, "msg", e), getattr(e, "pos", start))))
+        finally:
+            if items is not None:
+                size = items.pos - start
+                items.close()
+    return start, end, count, size, errors, stop
+
+
+class ArrayValidation:
+    """iterates over the ItemResults of validating the items of a JSON array in a file; by default
+    only the invalid ones.  template is for the whole array, e.g. [api_user].  The counters are
+    updated as it goes, so the throughput is known during and afterwards"""
+    def __init__(self, path, template, workers=None, only_errors=True, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        from obiwan import stream
+        self.path, self.only_errors = path, only_errors
+        self.limits = compile(template).limits  # applied to each item on its own, as the array isn't loaded
+        node = stream._node(template)
+        if node.kind is any:
+            self.template = any
+        elif node.kind is list:
+            self.template = node.item.compiled
+        else:
+            raise ObiwanError("json validation template %s is not a list template" % (node.compiled.template,))
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk_bytes = chunk_bytes
+        self.items = self.bytes = self.errors = 0
+        self.started = self.finished = None
+
+    elapsed = LineValidation.elapsed
+
+    @property
+    def items_per_second(self):
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    bytes_per_second = LineValidation.bytes_per_second
+
+    def summary(self):
+        return {"items": self.items, "bytes": self.bytes, "errors": self.errors, "seconds": self.elapsed,
+            "items_per_second": self.items_per_second, "bytes_per_second": self.bytes_per_second}
+
+    def _tasks(self, data, first):
+        "yields (function, args) for chunks of the file that start where items probably start"
+        size = len(data)
+        if self.workers <= 1 or size - first <= self.chunk_bytes:
+            yield _check_array_range, (self.path, first, size, True, self.limits)
+            return
+        # items of the same array usually start with the same character, e.g. {, after a comma
+        boundary = re.compile(rb",[ \t\n\r]*(?=%s)" % re.escape(data[first:first + 1]))
+        start = first
+        while start < size:
+            match = boundary.search(data, start + self.chunk_bytes)
+            end = match.end() if match else size
+            yield _check_array_range, (self.path, start, end, start == first, self.limits)
+            start = end
+
+    def _chunk_results(self):
+        "yields the result of each chunk, in order, parsing chunks again that didn't start at an item"
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                yield 0, 0, 0, 0, [(0, "is not valid JSON: Expecting value (at byte offset 0)")], None
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                try:
+                    first = _array_start(data)
+                except ValueError as e:
+                    yield 0, 0, 0, 0, [(0, "is not valid JSON: %s (at byte offset %d)" % (e.msg, e.pos))], None
+                    return
+                expected, compiled = first, None
+                for result in _ordered_results(self._tasks(data, first), self.template, self.workers):
+                    start, end = result[:2]
+                    if start != expected:  # the chunk before ended somewhere else
+                        compiled = compiled or compile(self.template)
+                        result = _check_array_range(self.path, expected, end, expected == first, self.limits,
+                            compiled)
+                    yield result
+                    expected = result[-1]
+                    if expected is None:
+                        return
+
+    def __iter__(self):
+        self.started = time.monotonic()
+        try:
+            for start, end, count, size, errors, stop in self._chunk_results():
+                first = self.items
+                errors = dict(errors)
+                # an array that is not valid JSON ends with an error at index count, for no item
+                indexes = sorted(errors) if self.only_errors else [*range(count), *sorted(i for i in errors if i >= count)]
+                for index in indexes:
+                    error = errors.get(index)
+                    if error is None:
+                        yield ItemResult(first + index, None, (), None)
+                    elif isinstance(error, ObiwanError):
+                        error._at(_INDEX, first + index)
+                        error.ctx = "json validation "
+                        yield ItemResult(first + index, error.offset, error.path, str(error))
+                    else:
+                        yield ItemResult(first + index, None, None, "json validation [%d] %s" % (first + index, error))
+                self.items += count
+                self.bytes += size
+                self.errors += len(errors)
+        finally:
+            self.finished = time.monotonic()
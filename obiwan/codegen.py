@@ -0,0 +1,510 @@
+"""ahead-of-time generation of validators as Python source, so processes don't compile templates as they start
+
+Run with:
+
+    python -m obiwan.codegen mymodule:templates [-o validators_gen.py]
+
+where mymodule.templates is a dict of names to templates.  The generated module has a
+check_<name>(obj, ctx="checking") for each, which raises the same ObiwanErrors as
+duckable(obj, template, ctx) would, and a VALIDATORS dict of them by name.
+
+Templates are written out as straight-line checks with the keys and types inlined.  The
+parts that can't be, such as lambdas and custom ObiwanChecks, are looked up in mymodule
+and compiled the first time they are used.  Generated modules are snapshots; generate
+them again when the templates, or obiwan, change.
+"""
+
+import argparse
+import builtins
+import importlib
+import re
+import sys
+
+import obiwan
+from obiwan import CompiledTemplate, ObiwanCheck, duck, duckable, function, noneable, optional, options, union
+
+_LITERAL_TYPES = (str, int, float, bool, bytes, type(None))  # keys that can be written out with repr()
+
+_HEADER = '''"""validators for %(source)s, generated by python -m obiwan.codegen; do not edit
+
+check_<name>(obj, ctx="checking") raises an ObiwanError like duckable(obj, %(source)s[name], ctx)"""
+
+from collections.abc import Sequence as _Sequence
+from itertools import islice as _islice
+
+from obiwan import ObiwanError
+from obiwan import _CHILD, _INDEX, _ATTRIBUTE, _KEY, _KEY_CHILD, _missing
+from obiwan import _all_of_types, _bulk_leaf, _bulk_tuple, _is_ndarray_type, _ndarray
+from obiwan.codegen import foreign as _foreign, import_type as _import_type
+
+_NoneType = type(None)
+'''
+
+_ENTRY = '''def %(function)s(obj, ctx="checking"):
+    try:
+        %(check)s(obj)
+    except ObiwanError as e:
+        if e.ctx is None:
+            e.ctx = ctx
+        raise
+    except Exception as e:
+        raise ObiwanError(" internal error: %%s" %% e, ctx)
+'''
+
+
+def load(source):
+    "the templates named by source, which is module:attribute"
+    module, _, attribute = source.partition(":")
+    if not attribute:
+        raise ValueError("%s should be module:attribute" % source)
+    return import_type(module, attribute)
+
+
+def import_type(module, qualname):
+    "the object, usually a class, with qualname in module"
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _resolve(template, steps):
+    "follows steps, as recorded by the generator, from a template to one of its nodes"
+    for step, *arg in steps:
+        if step == "value":
+            template = list(obiwan._dict_template(template)[0].values())[arg[0]]
+        elif step == "key":
+            template = list(obiwan._dict_template(template)[0])[arg[0]]
+        elif step == "alternative":
+            template = template.alternatives[arg[0]]
+        elif step == "index":
+            template = template[arg[0]]
+        elif step == "item":  # of a set that is all of one template
+            template = next(iter(template))
+        elif step == "inner":  # of optional, noneable and CompiledTemplate
+            template = template.key if isinstance(template, optional) else template.template
+        elif step == "extends":
+            template = template.extends[arg[0]]
+        elif step == "attribute":
+            template = template.attributes[arg[0]]
+    return template
+
+
+def foreign(source, name, steps):
+    """a check of a node that could not be generated; the node is found in the original templates,
+    and compiled, when it is first used"""
+    check = None
+    def check_foreign(obj):
+        nonlocal check
+        if check is None:
+            check = obiwan.compile(_resolve(load(source)[name], steps))._check
+        check(obj)
+    return check_foreign
+
+
+class _NotPortable(Exception):
+    "raised while generating a node that can only be checked by compiling the original template"
+
+
+def _step(steps, *step):
+    "steps are None inside sets, whose alternatives can't be found again in another process"
+    return None if steps is None else steps + (step,)
+
+
+def _indent(lines, levels=1):
+    return ["    " * levels + line for line in lines]
+
+
+class _Generator:
+
+    def __init__(self, source):
+        self.source = source
+        self.root = None  # the name of the template being generated
+        self.definitions = []  # module level source, in the order it is written
+        self.nodes = {}  # id(template) -> (template, name of its check), so shared templates are written once
+        self.types = {}  # type -> expression
+        self.count = 0
+
+    def _name(self, prefix):
+        self.count += 1
+        return "%s%d" % (prefix, self.count)
+
+    def _define(self, prefix, expression):
+        name = self._name(prefix)
+        self.definitions.append("%s = %s\n" % (name, expression))
+        return name
+
+    def _type(self, kind):
+        "an expression for the class kind"
+        if kind is type(None):
+            return "_NoneType"
+        if getattr(builtins, kind.__name__, None) is kind:
+            return kind.__name__
+        expression = self.types.get(kind)
+        if expression is None:
+            try:
+                if import_type(kind.__module__, kind.__qualname__) is not kind:
+                    raise _NotPortable(kind)
+            except Exception:
+                raise _NotPortable(kind)
+            expression = self.types[kind] = self._define("_type", "_import_type(%r, %r)" % (
+                kind.__module__, kind.__qualname__))
+        return expression
+
+    def _types(self, kinds):
+        if len(kinds) == 1:
+            return self._type(kinds[0])
+        return "(%s)" % ", ".join(map(self._type, kinds))
+
+    def _literal(self, value):
+        if type(value) not in _LITERAL_TYPES:
+            raise _NotPortable(value)
+        return repr(value)
+
+    def generate(self, name, template):
+        self.root = name
+        return self._node(template, ())
+
+    def _node(self, template, steps):
+        "the name of a function that checks obj against template, defining it if need be"
+        entry = self.nodes.get(id(template))
+        if entry is not None:
+            return entry[1]
+        mark, nodes, types = len(self.definitions), dict(self.nodes), dict(self.types)
+        name = self._name("_check")
+        try:
+            body = self._body(template, steps)
+        except _NotPortable:
+            if steps is None:
+                raise
+            del self.definitions[mark:]
+            self.nodes, self.types = nodes, types
+            self.definitions.append("%s = _foreign(%r, %r, %r)\n" % (name, self.source, self.root, steps))
+        else:
+            self.definitions.append("def %s(obj):\n%s\n" % (name, "\n".join(_indent(body or ["pass"]))))
+        self.nodes[id(template)] = (template, name)
+        return name
+
+    def _check(self, template, var, at, steps):
+        "the lines that check var against template, raising ObiwanErrors with the path segment at appended"
+        if isinstance(template, str) or template is any:
+            return []
+        if template is None:
+            return ["if %s is not None:" % var,
+                    "    raise ObiwanError(\" is %%s but should be None\" %% type(%s))%s" % (var, at)]
+        if isinstance(template, (optional, noneable)):
+            lines = self._check(template.key if isinstance(template, optional) else template.template,
+                                var, at, _step(steps, "inner"))
+            return ["if %s is not None:" % var] + _indent(lines) if lines else []
+        if template is function:
+            return ["if not hasattr(%s, \"__call__\"):" % var,
+                    "    raise ObiwanError(\" is %%s, not a function\" %% type(%s))%s" % (var, at)]
+        kinds = obiwan._leaf_types(template)
+        if kinds is not None:
+            while isinstance(template, CompiledTemplate):
+                template = template.template
+            message = " is %s but should be %s" if isinstance(template, type) else " is %s but should be one of %s"
+            return ["if not isinstance(%s, %s):" % (var, self._types(kinds)),
+                    "    raise ObiwanError(%r %% (type(%s), %r))%s" % (message, var, str(template), at)]
+        check = self._node(template, steps)
+        if not at:
+            return ["%s(%s)" % (check, var)]
+        return ["try:",
+                "    %s(%s)" % (check, var),
+                "except ObiwanError as e:",
+                "    raise e%s" % at]
+
+    def _bad(self, message):
+        return ["raise ObiwanError(%r)" % (" " + message,)]
+
+    def _body(self, template, steps):
+        if isinstance(template, CompiledTemplate):
+            return self._body(template.template, _step(steps, "inner"))
+        if isinstance(template, duck):
+            return self._duck(template, steps)
+        if isinstance(template, ObiwanCheck):  # custom checks, and function(...) signatures
+            raise _NotPortable(template)
+        if isinstance(template, set) and obiwan._leaf_types(template) is None:
+            if len(template) == 1:
+                return self._set_of(template, steps)
+            return self._choice(tuple(template), template, None, None)
+        if isinstance(template, union):
+            return self._choice(template.alternatives, template, template.discriminator, steps)
+        if isinstance(template, dict):
+            return self._dict(template, steps)
+        if isinstance(template, list):
+            return self._list(template, steps)
+        if isinstance(template, tuple):
+            return self._tuple(template, steps)
+        if template is duck:
+            return self._bad("you must instansiate a duck and describe its expected attributes")
+        if isinstance(template, (str, type, set, optional, noneable)) or template is None or template is any:
+            return self._check(template, "obj", "", steps)
+        raise _NotPortable(template)  # lambdas, function templates and things isinstance() accepts
+
+    def _kind_test(self, template):
+        "an expression for whether template could accept an object of type kind, or None if it could accept anything"
+        if isinstance(template, CompiledTemplate):
+            return self._kind_test(template.template)
+        if isinstance(template, (optional, noneable)):
+            inner = self._kind_test(template.key if isinstance(template, optional) else template.template)
+            return None if inner is None else "kind is _NoneType or %s" % inner
+        if template is None:
+            return "kind is _NoneType"
+        if isinstance(template, dict):
+            return "issubclass(kind, dict)"
+        if isinstance(template, list):
+            return "(issubclass(kind, _Sequence) or _is_ndarray_type(kind))"
+        if isinstance(template, tuple):
+            return "issubclass(kind, _Sequence)"
+        if isinstance(template, set) and len(template) == 1:
+            return "issubclass(kind, set)"
+        if isinstance(template, (set, union)):
+            tests = [self._kind_test(t) for t in (template if isinstance(template, set) else template.alternatives)]
+            if None in tests:
+                return None
+            return "(%s)" % " or ".join(tests)
+        if isinstance(template, type) and template is not duck and template is not function:
+            return "issubclass(kind, %s)" % self._type(template)
+        return None
+
+    def _choice(self, alternatives, template, discriminator, steps):
+        "like obiwan._compile_choice, with the tests of which alternatives to try written out"
+        allow_none = any(alternative is None for alternative in alternatives)
+        tagged, untagged, accepts_dict = {}, [], False
+        for i, alternative in enumerate(alternatives):
+            if alternative is None:
+                continue
+            tag = None if discriminator is None else obiwan._discriminator_tag(alternative, discriminator)
+            check = self._node(alternative, _step(steps, "alternative", i))
+            if tag is None:
+                untagged.append((check, self._kind_test(alternative)))
+                test = obiwan._kind_test(alternative)
+                try:
+                    accepts_dict = accepts_dict or test is None or test(dict)
+                except TypeError:
+                    accepts_dict = True
+            elif tag in tagged:
+                return self._bad("bad template: %s has more than one alternative with %s %s" % (
+                    template, discriminator, tag))
+            else:
+                tagged[tag] = check
+        lines = []
+        if allow_none:
+            lines += ["if obj is None:",
+                      "    return"]
+        if tagged:
+            tags = self._define("_tags", "{%s}" % ", ".join("%r: %s" % item for item in tagged.items()))
+            lines += ["if isinstance(obj, dict):",
+                      "    tag = obj.get(%s)" % self._literal(discriminator),
+                      "    check = %s.get(tag) if isinstance(tag, str) else None" % tags,
+                      "    if check is not None:",
+                      "        check(obj)",
+                      "        return"]
+        lines.append("kind = type(obj)")
+        for check, test in untagged:
+            attempt = ["try:",
+                       "    %s(obj)" % check,
+                       "    return",
+                       "except Exception:",
+                       "    pass"]
+            lines += attempt if test is None else ["if %s:" % test] + _indent(attempt)
+        if untagged:
+            every = self._define("_every", "(%s,)" % ", ".join(check for check, test in untagged))
+            lines += ["if obj.__class__ is not kind:  # e.g. a mock, which isinstance() might accept as another class",
+                      "    for check in %s:" % every,
+                      "        try:",
+                      "            check(obj)",
+                      "            return",
+                      "        except Exception:",
+                      "            pass"]
+        if tagged and not accepts_dict:
+            lines += ["if isinstance(obj, dict):",
+                      "    if %s not in obj:" % self._literal(discriminator),
+                      "        raise ObiwanError(%r)" % (" should have child called %s" % (discriminator,),),
+                      "    raise ObiwanError(\" is %%r but should be one of %%s\" %% (obj[%r], %r))._at(_CHILD, %r)" % (
+                          discriminator, ", ".join(sorted(tagged)), discriminator)]
+        lines.append("raise ObiwanError(\" is %%s but should be one of %%s\" %% (kind, %r))" % (str(template),))
+        return lines
+
+    def _dict(self, template, steps):
+        try:
+            merged, is_strict = obiwan._dict_template(template)
+        except ValueError as e:
+            return self._bad(str(e))
+        required, noneables, optionals, generics, allowed = [], [], [], [], []
+        for position, (key, value) in enumerate(merged.items()):
+            value_steps = _step(steps, "value", position)
+            if key is options:
+                continue
+            elif isinstance(key, optional):
+                optionals.append((self._literal(key.key), value, value_steps))
+                allowed.append(key.key)
+            elif isinstance(key, noneable):
+                noneables.append((self._literal(key.template), value, value_steps))
+                allowed.append(key.template)
+            elif isinstance(key, str):
+                required.append((repr(key), value, value_steps))
+                allowed.append(key)
+            else:
+                generics.append((key, value, _step(steps, "key", position), value_steps))
+        lines = ["if not isinstance(obj, dict):",
+                 "    raise ObiwanError(\" is %s but should be a dict\" % type(obj))"]
+        if is_strict and not generics:
+            keys = self._define("_keys", "frozenset((%s))" % "".join("%s, " % self._literal(key) for key in allowed))
+            lines += ["if not %s.issuperset(obj):" % keys,
+                      "    for key in obj:",
+                      "        if key not in %s:" % keys,
+                      "            raise ObiwanError(\" should not have a child called %s\" % (key,))"]
+        for key, value, value_steps, is_noneable in [item + (False,) for item in required] + \
+                [item + (True,) for item in noneables]:
+            lines += ["value = obj.get(%s, _missing)" % key,
+                      "if value is _missing:",
+                      "    raise ObiwanError(\" should have child called %%s\" %% (%s,))" % key]
+            check = self._check(value, "value", "._at(_CHILD, %s)" % key, value_steps)
+            if check and is_noneable:
+                check = ["if value is not None:"] + _indent(check)
+            lines += check
+        for key, value, value_steps in optionals:
+            check = self._check(value, "value", "._at(_CHILD, %s)" % key, value_steps)
+            if check:
+                lines += ["value = obj.get(%s, _missing)" % key,
+                          "if value is not _missing:"] + _indent(check)
+        for key, value, key_steps, value_steps in generics:
+            key_types, value_types = obiwan._leaf_types(key), obiwan._leaf_types(value)
+            check_key = self._check(key, "k", "._at(_KEY, k)", key_steps)
+            check_value = self._check(value, "v", "._at(_KEY_CHILD, k)", value_steps)
+            lines += ["keys_ok = %s" % ("_all_of_types(obj, %s)" % self._types(key_types) if key_types else "False"),
+                      "values_ok = %s" % (
+                          "_all_of_types(obj.values(), %s)" % self._types(value_types) if value_types else "False"),
+                      "if not (keys_ok and values_ok):",
+                      "    for k, v in obj.items():"]
+            if check_key:
+                lines += _indent(["if not keys_ok:"] + _indent(check_key), 2)
+            if check_value:
+                lines += _indent(["if not values_ok:"] + _indent(check_value), 2)
+        return lines
+
+    def _bulk(self, item):
+        "an expression for a function that checks the items of a list in bulk, like obiwan._bulk_checker, or None"
+        while isinstance(item, CompiledTemplate):
+            item = item.template
+        kinds = obiwan._leaf_types(item)
+        if kinds is not None:
+            return self._define("_bulk", "_bulk_leaf(%s)" % self._types(kinds))
+        if isinstance(item, tuple) and obiwan._bulk_tuple(item) is not None:
+            slots = []
+            for slot in item:
+                if slot is Ellipsis or slot is any:
+                    slots.append(repr(slot))
+                else:
+                    while isinstance(slot, CompiledTemplate):
+                        slot = slot.template
+                    if isinstance(slot, type):
+                        slots.append(self._type(slot))
+                    else:
+                        slots.append("{%s}" % ", ".join("None" if kind is None else self._type(kind) for kind in slot))
+            return self._define("_bulk", "_bulk_tuple((%s,))" % ", ".join(slots))
+        return None
+
+    def _list(self, template, steps):
+        if len(template) != 1:
+            return self._bad("bad template: %s lists must all be of the same type" % (template,))
+        check = self._check(template[0], "item", "._at(_INDEX, i)", _step(steps, "index", 0))
+        lines = ["if not isinstance(obj, _Sequence) and _ndarray(obj) is None:",
+                 "    raise ObiwanError(\" is %%s but should be %%s\" %% (type(obj), %r))" % (str(template),)]
+        if not check:
+            return lines
+        bulk = self._bulk(template[0])
+        if bulk is None:
+            lines.append("for i, item in enumerate(obj.tolist() if _ndarray(obj) is not None else obj):")
+        else:
+            lines += ["start = %s(obj)" % bulk,
+                      "if start is None:",
+                      "    return",
+                      "# those before the first that failed in bulk are fine, but it may be a false alarm",
+                      "for i, item in _islice(enumerate(obj.tolist() if _ndarray(obj) is not None else obj), start, None):"]
+        return lines + _indent(check)
+
+    def _tuple(self, template, steps):
+        lines = ["if not isinstance(obj, _Sequence):",
+                 "    raise ObiwanError(\" is %%s but should be packed %%s\" %% (type(obj), %r))" % (str(template),)]
+        for i, expect in enumerate(template):
+            if expect is Ellipsis:
+                break
+            if expect is any:
+                continue
+            lines += ["if len(obj) <= %d:" % i,
+                      "    raise ObiwanError(%r)._at(_INDEX, %d)" % (" should be %s but is omitted" % (expect,), i),
+                      "value = obj[%d]" % i]
+            lines += self._check(expect, "value", "._at(_INDEX, %d)" % i, _step(steps, "index", i))
+        else:
+            lines += ["if len(obj) != %d:" % len(template),
+                      "    raise ObiwanError(\" is %%s but should be packed %%s\" %% (type(obj), %r))" % (str(template),)]
+        return lines
+
+    def _set_of(self, template, steps):
+        item = tuple(template)[0]
+        return ["if not isinstance(obj, set):",
+                "    raise ObiwanError(\" is %%s but should be a set of %%s\" %% (type(obj), %r))" % (str(item),),
+                "for i, item in enumerate(obj):"] + \
+            _indent(self._check(item, "item", "._at(_INDEX, i)", _step(steps, "item")) or ["pass"])
+
+    def _duck_attributes(self, template, steps, seen):
+        "the attributes of a duck and those it extends, in the order they are checked"
+        for name, value in template.attributes.items():
+            if name not in seen:
+                seen.add(name)
+                yield name, value, _step(steps, "attribute", name)
+        for i, parent in enumerate(template.extends):
+            yield from self._duck_attributes(parent, _step(steps, "extends", i), seen)
+
+    def _duck(self, template, steps):
+        lines = []
+        for name, value, value_steps in self._duck_attributes(template, steps, set()):
+            is_optional = isinstance(value, optional)
+            if is_optional:
+                value, value_steps = value.key, _step(value_steps, "inner")
+            check = ["value = getattr(obj, %r)" % name] + \
+                self._check(value, "value", "._at(_ATTRIBUTE, %r)" % name, value_steps)
+            if is_optional:
+                lines += ["if hasattr(obj, %r):" % name] + _indent(check)
+            else:
+                lines += ["if not hasattr(obj, %r):" % name,
+                          "    raise ObiwanError(%r)" % (" does not have a %s" % name,)] + check
+        return lines
+
+
+def generate(source, templates=None):
+    """the source of a module of validators for the dict of names to templates that source,
+    module:attribute, refers to; templates is that dict, if it has already been loaded"""
+    if templates is None:
+        templates = load(source)
+    duckable(templates, {str: any}, source)
+    generator = _Generator(source)
+    entries, functions = [], {}
+    for name, template in templates.items():
+        function_name = "check_" + re.sub(r"\W", "_", name)
+        while function_name in functions.values():
+            function_name += "_"
+        functions[name] = function_name
+        entries.append(_ENTRY % {"function": function_name, "check": generator.generate(name, template)})
+    return "\n".join([_HEADER % {"source": source}] + generator.definitions + entries + [
+        "VALIDATORS = {%s}\n" % ", ".join("%r: %s" % item for item in functions.items())])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m obiwan.codegen", description=__doc__.split("\n")[0])
+    parser.add_argument("source", help="module:attribute naming a dict of names to templates")
+    parser.add_argument("-o", "--output", help="write the module to this file rather than stdout")
+    args = parser.parse_args(argv)
+    code = generate(args.source)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(code)
+    else:
+        sys.stdout.write(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,608 @@
+"""msgpack and CBOR decoding that validates against a template as the document is decoded
+
+Like obiwan.stream does for JSON, the parser descends into dict, list and tuple templates
+item by item, so a document fails at its first violation without the rest of it being
+decoded; anything else is decoded into a value and given to the compiled checker.  Errors
+are ObiwanErrors with the path and the byte offset of the bad value, and malformed data
+raises a ValueError.
+
+msgpack is decoded with the Unpacker of the msgpack package if it is installed, and with
+the pure Python decoder here if not; CBOR is always decoded here.  See loads() for a
+quicker way of decoding documents that are already in memory.  bytes, memoryviews and
+mmaps are decoded where they are rather than copied, and files are read in chunks.
+"""
+
+import collections
+import datetime
+import struct
+
+from obiwan import ObiwanError, compile, _CHILD, _INDEX, _KEY, _KEY_CHILD
+from obiwan.stream import DEFAULT_CHUNK_SIZE, _node, chunks
+
+MSGPACK = "msgpack"
+CBOR = "cbor"
+
+ExtType = collections.namedtuple("ExtType", "code data")  # a msgpack extension, as msgpack.ExtType
+Tag = collections.namedtuple("Tag", "tag value")  # a CBOR tagged value of a tag that isn't decoded
+Simple = collections.namedtuple("Simple", "value")  # a CBOR simple value other than false, true, null and undefined
+
+_OTHER = object()  # what read_map_header() and read_array_header() return when the next value is something else
+
+
+class DecodeError(ValueError):
+    "malformed msgpack or CBOR; offset is the byte offset of the problem"
+    def __init__(self, message, offset):
+        super().__init__("%s at byte offset %d" % (message, offset))
+        self.offset = offset
+
+
+def _key(key, offset):
+    "arrays are decoded as lists, which can't be map keys, so those that are keys are made tuples"
+    if isinstance(key, list):
+        key = tuple(key)
+    try:
+        hash(key)
+    except TypeError:
+        raise DecodeError("Unhashable map key", offset)
+    return key
+
+
+def _pairs(pairs):
+    "the dict of a map decoded by the msgpack package, with keys that are arrays made tuples as _key() does"
+    try:
+        return dict(pairs)
+    except TypeError:
+        return {tuple(key) if isinstance(key, list) else key: value for key, value in pairs}
+
+
+def _buffer(source):
+    "source as a memoryview of bytes if it supports the buffer protocol, else None"
+    try:
+        return memoryview(source).cast("B")
+    except TypeError:
+        return None
+
+
+class _Reader:
+    "the bytes of a document: a buffer that is decoded in place, or chunks read as they are needed"
+    def __init__(self, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.pos = 0  # in buf
+        self.base = 0  # the offset in the document of buf[0]
+        self.buf = _buffer(source)
+        self.chunks = None
+        if self.buf is None:
+            self.buf = bytearray()
+            self.chunks = chunks(source, chunk_size)
+
+    def tell(self):
+        return self.base + self.pos
+
+    def _fill(self):
+        "reads another chunk; returns False at the end of the document"
+        if self.chunks is None:
+            return False
+        if self.pos > DEFAULT_CHUNK_SIZE:  # drop what we've decoded, so memory is bounded by the biggest value
+            del self.buf[:self.pos]
+            self.base += self.pos
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += chunk
+                return True
+        self.chunks = None
+        return False
+
+    def read(self, n):
+        while len(self.buf) - self.pos < n:
+            if not self._fill():
+                raise DecodeError("Unexpected end of data", self.tell())
+        pos = self.pos
+        self.pos = pos + n
+        return self.buf[pos:pos + n]
+
+    def peek(self):
+        while self.pos >= len(self.buf):
+            if not self._fill():
+                raise DecodeError("Unexpected end of data", self.tell())
+        return self.buf[self.pos]
+
+    def _uint(self, size):
+        return int.from_bytes(self.read(size), "big")
+
+    def _text(self, data, offset):
+        try:
+            return str(data, "utf-8")
+        except UnicodeDecodeError as e:
+            raise DecodeError("Invalid UTF-8 in string (%s)" % e.reason, offset)
+
+    def unpack_key(self):
+        offset = self.tell()
+        return _key(self.unpack(), offset)
+
+    def at_break(self):
+        "whether an indefinite length container ends here, consuming the end if so"
+        return False
+
+    def end(self):
+        if self.pos < len(self.buf) or self._fill():
+            raise DecodeError("Extra data", self.tell())
+
+
+_MSGPACK_FIXED = {0xca: ">f", 0xcb: ">d", 0xcc: ">B", 0xcd: ">H", 0xce: ">I", 0xcf: ">Q",
+    0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q"}
+
+
+class MsgpackUnpacker(_Reader):
+    "a pure Python msgpack decoder, for when the msgpack package is not installed"
+
+    def read_map_header(self):
+        b = self.peek()
+        if 0x80 <= b <= 0x8f:
+            self.pos += 1
+            return b & 0x0f
+        if b == 0xde or b == 0xdf:
+            self.pos += 1
+            return self._uint(2 if b == 0xde else 4)
+        return _OTHER
+
+    def read_array_header(self):
+        b = self.peek()
+        if 0x90 <= b <= 0x9f:
+            self.pos += 1
+            return b & 0x0f
+        if b == 0xdc or b == 0xdd:
+            self.pos += 1
+            return self._uint(2 if b == 0xdc else 4)
+        return _OTHER
+
+    def unpack(self):
+        offset = self.tell()
+        b = self.read(1)[0]
+        if b <= 0x7f:
+            return b
+        if b >= 0xe0:
+            return b - 0x100
+        if b <= 0x8f:
+            return self._map(b & 0x0f)
+        if b <= 0x9f:
+            return [self.unpack() for _ in range(b & 0x0f)]
+        if b <= 0xbf:
+            return self._text(self.read(b & 0x1f), offset)
+        fmt = _MSGPACK_FIXED.get(b)
+        if fmt is not None:
+            return struct.unpack(fmt, self.read(struct.calcsize(fmt)))[0]
+        if b == 0xc0:
+            return None
+        if b == 0xc2:
+            return False
+        if b == 0xc3:
+            return True
+        if 0xc4 <= b <= 0xc6:  # bin 8, 16, 32
+            return bytes(self.read(self._uint(1 << (b - 0xc4))))
+        if 0xc7 <= b <= 0xc9:  # ext 8, 16, 32
+            size = self._uint(1 << (b - 0xc7))
+            return ExtType(struct.unpack(">b", self.read(1))[0], bytes(self.read(size)))
+        if 0xd4 <= b <= 0xd8:  # fixext 1, 2, 4, 8, 16
+            return ExtType(struct.unpack(">b", self.read(1))[0], bytes(self.read(1 << (b - 0xd4))))
+        if 0xd9 <= b <= 0xdb:  # str 8, 16, 32
+            return self._text(self.read(self._uint(1 << (b - 0xd9))), offset)
+        if b == 0xdc or b == 0xdd:
+            return [self.unpack() for _ in range(self._uint(2 if b == 0xdc else 4))]
+        if b == 0xde or b == 0xdf:
+            return self._map(self._uint(2 if b == 0xde else 4))
+        raise DecodeError("Invalid byte 0x%02x" % b, offset)
+
+    def _map(self, count):
+        result = {}
+        for _ in range(count):
+            key = self.unpack_key()
+            result[key] = self.unpack()
+        return result
+
+
+class NativeMsgpackUnpacker:
+    """the Unpacker of the msgpack package, fed the document in chunks; a buffer is fed as
+    memoryviews of it, so it is never copied as a whole"""
+    def __init__(self, msgpack, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._unpacker = msgpack.Unpacker(raw=False, strict_map_key=False, object_pairs_hook=_pairs)
+        self._out_of_data, self._stack_error = msgpack.OutOfData, msgpack.StackError
+        buf = _buffer(source)
+        if buf is None:
+            self._chunks = iter(chunks(source, chunk_size))
+        else:
+            self._chunks = (buf[i:i + chunk_size] for i in range(0, len(buf), chunk_size))
+        self._fed = 0
+
+    def tell(self):
+        return self._unpacker.tell()
+
+    def _feed(self):
+        # the unpacker starts the value again when it is fed more, so feed at least as much as
+        # it already has, so values that span many chunks aren't decoded quadratically
+        wanted, fed = max(1, self._fed - self.tell()), 0
+        for chunk in self._chunks:
+            self._unpacker.feed(chunk)
+            fed += len(chunk)
+            if fed >= wanted:
+                break
+        self._fed += fed
+        return fed > 0
+
+    def _call(self, method):
+        while True:
+            try:
+                return method()
+            except self._out_of_data:
+                if not self._feed():
+                    raise DecodeError("Unexpected end of data", self.tell())
+            except self._stack_error:
+                error = ObiwanError(" is nested too deeply to decode")
+                error.offset = self.tell()
+                raise error
+            except TypeError:  # from _pairs()
+                raise DecodeError("Unhashable map key", self.tell()) from None
+
+    def _header(self, method):
+        try:
+            return self._call(method)
+        except ValueError as e:
+            if type(e) is not ValueError:  # the errors of malformed data are subclasses
+                raise
+            return _OTHER  # an unexpected type, which is not consumed
+
+    def read_map_header(self):
+        return self._header(self._unpacker.read_map_header)
+
+    def read_array_header(self):
+        return self._header(self._unpacker.read_array_header)
+
+    def unpack(self):
+        return self._call(self._unpacker.unpack)
+
+    def unpack_key(self):
+        offset = self.tell()
+        return _key(self.unpack(), offset)
+
+    def at_break(self):
+        return False
+
+    def end(self):
+        if self._fed > self.tell() or any(self._chunks):
+            raise DecodeError("Extra data", self.tell())
+
+
+class CborUnpacker(_Reader):
+    "a pure Python CBOR (RFC 8949) decoder"
+
+    def _head(self):
+        "reads the head of a data item, returning (major type, additional information, argument)"
+        offset = self.tell()
+        b = self.read(1)[0]
+        major, info = b >> 5, b & 0x1f
+        if info < 24:
+            return major, info, info
+        if info <= 27:
+            return major, info, self._uint(1 << (info - 24))
+        if info == 31 and major in (2, 3, 4, 5, 7):
+            return major, info, None  # indefinite length, or the end of one
+        raise DecodeError("Invalid additional information %d" % info, offset)
+
+    def _container_header(self, major):
+        b = self.peek()
+        if b >> 5 != major:
+            return _OTHER
+        return self._head()[2]  # None for indefinite length
+
+    def read_map_header(self):
+        return self._container_header(5)
+
+    def read_array_header(self):
+        return self._container_header(4)
+
+    def at_break(self):
+        if self.peek() == 0xff:
+            self.pos += 1
+            return True
+        return False
+
+    def _items(self, count):
+        "the number of items of a container is count, or until a break if count is None"
+        i = 0
+        while (i < count) if count is not None else not self.at_break():
+            yield i
+            i += 1
+
+    def unpack(self):
+        offset = self.tell()
+        major, info, arg = self._head()
+        if major == 0:
+            return arg
+        if major == 1:
+            return -1 - arg
+        if major == 2 or major == 3:
+            if arg is None:  # indefinite length, in definite length chunks of the same type
+                parts = []
+                for _ in self._items(None):
+                    chunk_offset = self.tell()
+                    chunk_major, _, size = self._head()
+                    if chunk_major != major or size is None:
+                        raise DecodeError("Invalid chunk of indefinite length string", chunk_offset)
+                    parts.append(bytes(self.read(size)))
+                data = b"".join(parts)
+            else:
+                data = self.read(arg)
+            return bytes(data) if major == 2 else self._text(data, offset)
+        if major == 4:
+            return [self.unpack() for _ in self._items(arg)]
+        if major == 5:
+            result = {}
+            for _ in self._items(arg):
+                key = self.unpack_key()
+                result[key] = self.unpack()
+            return result
+        if major == 6:
+            return self._tagged(arg, self.unpack(), offset)
+        if info == 20:
+            return False
+        if info == 21:
+            return True
+        if info == 22 or info == 23:  # null and undefined
+            return None
+        if 25 <= info <= 27:
+            return struct.unpack((">e", ">f", ">d")[info - 25], arg.to_bytes(1 << (info - 24), "big"))[0]
+        if info == 31:
+            raise DecodeError("Unexpected break", offset)
+        return Simple(arg)
+
+    def _tagged(self, tag, value, offset):
+        try:
+            if tag == 0:
+                return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if tag == 1:
+                return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+            if tag == 2:
+                return int.from_bytes(value, "big")
+            if tag == 3:
+                return -1 - int.from_bytes(value, "big")
+        except (TypeError, ValueError, AttributeError, OverflowError, OSError):
+            raise DecodeError("Invalid value of tag %d" % tag, offset)
+        return Tag(tag, value)
+
+
+def unpacker(format, source, chunk_size=DEFAULT_CHUNK_SIZE):
+    "an unpacker of the msgpack or cbor document in source, a bytes-like, file object or iterable of chunks"
+    if format == CBOR:
+        return CborUnpacker(source, chunk_size)
+    try:
+        import msgpack
+    except ImportError:
+        return MsgpackUnpacker(source, chunk_size)
+    return NativeMsgpackUnpacker(msgpack, source, chunk_size)
+
+
+class Parser:
+    "decodes a document from an unpacker, checking it against templates, and a limits policy if given, as it goes"
+    def __init__(self, unpacker, limits=None):
+        self.unpacker = unpacker
+        self.limits = None if limits is None else limits.reader()
+
+    def more(self, count, i):
+        "whether a container of count items, or of indefinite length if None, has more than i"
+        if count is None:
+            if self.unpacker.at_break():
+                return False
+            if self.limits is not None:
+                self.limits.item(i, self.unpacker.tell())
+            return True
+        return i < count
+
+    def enter(self, count, offset):
+        "a container of count items starts at offset"
+        if self.limits is not None:
+            self.limits.enter(count, offset)
+
+    def leave(self, result):
+        if self.limits is not None:
+            self.limits.leave()
+        return result
+
+    def key(self):
+        "decodes the next map key"
+        offset = self.unpacker.tell()
+        key = self.unpacker.unpack_key()
+        if self.limits is not None and isinstance(key, str):
+            try:
+                self.limits.string(key, offset)
+            except ObiwanError as e:
+                e._at(_KEY, key)
+                raise
+        return key
+
+    def value(self):
+        "decodes the next value without checking it; within the limits, if there are any, as it goes"
+        unpacker = self.unpacker
+        limits = self.limits
+        if limits is None:
+            return unpacker.unpack()
+        offset = unpacker.tell()
+        count = unpacker.read_map_header()
+        if count is not _OTHER:
+            limits.enter(count, offset)
+            result = {}
+            while self.more(count, len(result)):
+                key = self.key()
+                try:
+                    result[key] = self.value()
+                except ObiwanError as e:
+                    e._at(_CHILD, key)
+                    raise
+            return self.leave(result)
+        count = unpacker.read_array_header()
+        if count is not _OTHER:
+            limits.enter(count, offset)
+            result = []
+            while self.more(count, len(result)):
+                try:
+                    result.append(self.value())
+                except ObiwanError as e:
+                    e._at(_INDEX, len(result))
+                    raise
+            return self.leave(result)
+        value = unpacker.unpack()
+        limits.string(value, offset)
+        return value
+
+    def parse(self, node):
+        "decodes the next value, checking it against node"
+        unpacker = self.unpacker
+        offset = unpacker.tell()
+        try:
+            kind = node.kind
+            if kind is dict and node.current().kind is dict:
+                count = unpacker.read_map_header()
+                if count is not _OTHER:
+                    self.enter(count, offset)
+                    return self.leave(self.parse_dict(node, count))
+            elif kind is list or kind is tuple:
+                count = unpacker.read_array_header()
+                if count is not _OTHER:
+                    self.enter(count, offset)
+                    if kind is list:
+                        return self.leave(self.parse_list(node.item, count))
+                    return self.leave(self.parse_tuple(node, count))
+            value = self.value()
+            if kind is not any and not (value is None and node.accept_null):
+                node.compiled._check(value)
+            return value
+        except ObiwanError as e:
+            if e.offset is None:
+                e.offset = offset
+            raise
+
+    def parse_dict(self, node, count):
+        unpacker = self.unpacker
+        result = {}
+        i = 0
+        while self.more(count, i):
+            i += 1
+            key_offset = unpacker.tell()
+            key = self.key()
+            if node.strict and key not in node.allowed:
+                error = ObiwanError(" should not have a child called %s" % (key,))
+                error.offset = key_offset
+                raise error
+            named = node.named.get(key)
+            value_nodes = [] if named is None else [(named, _CHILD)]
+            for check_key, value_node in node.generics:
+                try:
+                    check_key._check(key)
+                except ObiwanError as e:
+                    e._at(_KEY, key)
+                    e.offset = key_offset
+                    raise
+                value_nodes.append((value_node, _KEY_CHILD))
+            if not value_nodes:
+                try:
+                    result[key] = self.value()
+                except ObiwanError as e:
+                    e._at(_CHILD, key)
+                    raise
+                continue
+            # decode the value against the first template, and check it against any others
+            value_offset = unpacker.tell()
+            value_node, fmt = value_nodes[0]
+            try:
+                value = result[key] = self.parse(value_node)
+            except ObiwanError as e:
+                e._at(fmt, key)
+                raise
+            for value_node, fmt in value_nodes[1:]:
+                try:
+                    value_node.compiled._check(value)
+                except ObiwanError as e:
+                    e._at(fmt, key)
+                    e.offset = value_offset
+                    raise
+        for key in node.required:
+            if key not in result:
+                error = ObiwanError(" should have child called %s" % (key,))
+                error.offset = unpacker.tell()
+                raise error
+        return result
+
+    def parse_list(self, item, count):
+        result = []
+        while self.more(count, len(result)):
+            try:
+                result.append(self.parse(item))
+            except ObiwanError as e:
+                e._at(_INDEX, len(result))
+                raise
+        return result
+
+    def parse_tuple(self, node, count):
+        result = []
+        slots = node.slots
+        while self.more(count, len(result)):
+            i = len(result)
+            if i < len(slots):
+                try:
+                    result.append(self.parse(slots[i]))
+                except ObiwanError as e:
+                    e._at(_INDEX, i)
+                    raise
+            elif node.open_ended:
+                try:
+                    result.append(self.value())
+                except ObiwanError as e:
+                    e._at(_INDEX, i)
+                    raise
+            else:
+                raise ObiwanError(" is %s but should be packed %s" % (list, node.template))
+        if len(result) < len(slots):
+            for i in range(len(result), len(slots)):
+                if slots[i].compiled.template is not any:
+                    error = ObiwanError(" should be %s but is omitted" % (slots[i].compiled.template,))._at(_INDEX, i)
+                    error.offset = self.unpacker.tell()
+                    raise error
+            if not node.open_ended:
+                error = ObiwanError(" is %s but should be packed %s" % (list, node.template))
+                error.offset = self.unpacker.tell()
+                raise error
+        return result
+
+
+def loads(format, data, template=any, ctx="msgpack validation ", chunk_size=DEFAULT_CHUNK_SIZE):
+    """decodes and returns the document in data, a bytes-like, file object or iterable of chunks,
+    checking it against template.  A bytes-like msgpack document is decoded whole by the msgpack
+    package, if it is installed, and checked afterwards, as that is much quicker; it is only
+    decoded incrementally if it fails, to find where, or if template has limits, so that they are
+    checked as it is decoded"""
+    if format == MSGPACK and _buffer(data) is not None and compile(template).limits is None:
+        try:
+            import msgpack
+            value = msgpack.unpackb(data, raw=False, strict_map_key=False)
+            if template is not any:
+                compile(template).check(value, ctx)
+            return value
+        # report malformed data and mismatches as load() does, and decode maps with array keys as it
+        # does, which unpackb() can't make dicts of
+        except (ImportError, ValueError, TypeError, ObiwanError):
+            pass
+    return load(unpacker(format, data, chunk_size), template, ctx)
+
+
+def load(unpacker, template=any, ctx="msgpack validation "):
+    """decodes and returns the document from unpacker, checking it against template, and its limits
+    if it has any, as it is decoded"""
+    parser = Parser(unpacker, compile(template).limits)
+    try:
+        ret = parser.parse(_node(template))
+    except ObiwanError as e:
+        if e.ctx is None:
+            e.ctx = ctx
+        raise
+    except RecursionError:
+        raise ObiwanError(" is nested too deeply to decode", ctx)
+    unpacker.end()
+    return ret
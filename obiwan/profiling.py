@@ -0,0 +1,223 @@
+"""opt-in statistics of where validation time goes; see obiwan.enable_stats()
+
+While enabled, CompiledTemplate.check is replaced with a version that times each check, so
+that there is nothing to pay when statistics are not wanted.  Checked functions and the
+runtime checker look at obiwan._profiler, which is None when disabled.
+
+Counts are not locked, so with several threads validating at once they are approximate.
+"""
+
+import copy
+import json as _json
+import random
+import time
+import weakref
+
+import obiwan
+from obiwan import CompiledTemplate
+
+SAMPLES = 1000  # the timings kept per record, at random, to estimate percentiles from
+LABEL_LENGTH = 60
+ROWS = 1000  # the records kept of templates, of functions and of nodes; any more are counted together
+OTHERS = "(others)"
+
+_unprofiled_check = CompiledTemplate.__dict__["check"]
+_latest = None  # the Profiler that stats() reports on, even after disabling
+
+
+class StatsRecord:
+    "the calls, failures and time spent validating a template, a checked function or a template node"
+    __slots__ = ("calls", "failures", "total", "samples")
+
+    def __init__(self):
+        self.calls = self.failures = 0
+        self.total = 0.0
+        self.samples = []
+
+    def add(self, seconds, failed):
+        self.calls += 1
+        self.total += seconds
+        if failed:
+            self.failures += 1
+        if len(self.samples) < SAMPLES:
+            self.samples.append(seconds)
+        else:  # reservoir sampling, so every call is equally likely to be kept
+            i = random.randrange(self.calls)
+            if i < SAMPLES:
+                self.samples[i] = seconds
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def as_dict(self):
+        return {"calls": self.calls, "failures": self.failures, "total": self.total,
+                "mean": self.total / self.calls if self.calls else None,
+                "p50": self.percentile(50), "p99": self.percentile(99)}
+
+
+def _label(description):
+    return description if len(description) <= LABEL_LENGTH else description[:LABEL_LENGTH - 3] + "..."
+
+
+class Profiler:
+    "the records of one period of statistics gathering"
+
+    def __init__(self, nodes=False):
+        self.nodes = nodes
+        # templates are recorded by description, so a template written inline in a call has one
+        # record however many times it is compiled, and the records don't keep templates alive
+        self.templates = {}  # description -> StatsRecord
+        self.functions = {}  # label -> StatsRecord
+        self.template_nodes = {}  # (description, path) -> StatsRecord
+        # templates with the same description can check differently, so each has its own timed copy
+        self._timed = weakref.WeakKeyDictionary()  # CompiledTemplate -> a copy with timed nodes, when nodes is set
+        self._descriptions = weakref.WeakKeyDictionary()  # CompiledTemplate -> description
+        self._code_labels = {}  # code -> label
+
+    def reset(self):
+        self.templates = {}
+        self.functions = {}
+        self.template_nodes = {}
+
+    def _record(self, records, key, others=OTHERS):
+        record = records.get(key)
+        if record is None:
+            if len(records) >= ROWS:
+                key = others
+            record = records.setdefault(key, StatsRecord())
+        return record
+
+    def _description(self, compiled):
+        description = self._descriptions.get(compiled)
+        if description is None:
+            description = self._descriptions[compiled] = repr(compiled.template)
+        return description
+
+    def check(self, compiled, obj, ctx):
+        description = self._description(compiled)
+        target = compiled
+        if self.nodes:
+            target = self._timed.get(compiled)
+            if target is None:
+                target = self._timed_copy(compiled, description)
+        start = time.perf_counter()
+        failed = True
+        try:
+            _unprofiled_check(target, obj, ctx)
+            failed = False
+        finally:
+            self._record(self.templates, description).add(time.perf_counter() - start, failed)
+
+    def _timed_copy(self, compiled, description):
+        "a copy of compiled that times its nodes, or compiled itself once there are ROWS copies"
+        if len(self._timed) >= ROWS:
+            return compiled
+        def timer(path, check):
+            key = (description, path)
+            def timed_node(obj):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    check(obj)
+                    failed = False
+                finally:
+                    self._record(self.template_nodes, key, (OTHERS, "")).add(time.perf_counter() - start, failed)
+            return timed_node
+        timed = copy.copy(compiled)
+        timed._check = obiwan._compile_timed(compiled.template, timer)
+        self._timed[compiled] = timed
+        return timed
+
+    def time_function(self, label, check, *args):
+        start = time.perf_counter()
+        failed = True
+        try:
+            check(*args)
+            failed = False
+        finally:
+            self._record(self.functions, label).add(time.perf_counter() - start, failed)
+
+    def code_label(self, code, f_globals):
+        "the module.qualname of the function code belongs to, for the runtime checker"
+        label = self._code_labels.get(code)
+        if label is None:
+            label = "%s.%s" % (f_globals.get("__name__"), getattr(code, "co_qualname", code.co_name))
+            self._code_labels[code] = label
+        return label
+
+    def stats(self):
+        return ValidationStats(
+            [dict(record.as_dict(), template=_label(description))
+             for description, record in list(self.templates.items())],
+            [dict(record.as_dict(), function=label) for label, record in list(self.functions.items())],
+            [dict(record.as_dict(), template=_label(description), path=path)
+             for (description, path), record in list(self.template_nodes.items())])
+
+
+class ValidationStats:
+    """a snapshot of validation statistics; templates, functions and nodes are lists of dicts with
+    calls, failures, and total, mean, p50 and p99 seconds; each sorted with the most total time first.
+    Functions are named like errors are: module.name() for the arguments and module.name()-> for the return"""
+
+    def __init__(self, templates, functions, nodes):
+        order = lambda row: -row["total"]
+        self.templates = sorted(templates, key=order)
+        self.functions = sorted(functions, key=order)
+        self.nodes = sorted(nodes, key=order)
+
+    def as_dict(self):
+        return {"templates": self.templates, "functions": self.functions, "nodes": self.nodes}
+
+    def to_json(self, **kwargs):
+        return _json.dumps(self.as_dict(), **kwargs)
+
+    def table(self, limit=20):
+        "a plain text table of the limit rows with the most total time in each section"
+        lines = []
+        for title, rows, name in (("templates", self.templates, lambda row: row["template"]),
+                                  ("functions", self.functions, lambda row: row["function"]),
+                                  ("nodes", self.nodes, lambda row: "%s in %s" % (row["path"], row["template"]))):
+            if not rows:
+                continue
+            lines.append("%-64s %10s %8s %12s %12s %12s" % (title, "calls", "failures", "total ms", "p50 us", "p99 us"))
+            for row in rows[:limit]:
+                lines.append("%-64s %10d %8d %12.3f %12.3f %12.3f" % (
+                    name(row)[:64], row["calls"], row["failures"], row["total"] * 1e3,
+                    row["p50"] * 1e6, row["p99"] * 1e6))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.table()
+
+
+def _profiled_check(self, obj, ctx="checking"):
+    profiler = obiwan._profiler
+    if profiler is None:  # a thread that was checking as it was disabled
+        return _unprofiled_check(self, obj, ctx)
+    profiler.check(self, obj, ctx)
+
+
+def install(nodes=False):
+    "starts gathering statistics, returning the Profiler"
+    global _latest
+    _latest = Profiler(nodes)
+    CompiledTemplate.check = CompiledTemplate.__call__ = _profiled_check
+    return _latest
+
+
+def uninstall():
+    CompiledTemplate.check = CompiledTemplate.__call__ = _unprofiled_check
+
+
+def stats():
+    if _latest is None:
+        return ValidationStats([], [], [])
+    return _latest.stats()
+
+
+def reset():
+    if _latest is not None:
+        _latest.reset()
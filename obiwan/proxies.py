@@ -0,0 +1,246 @@
+"""dicts and lists that stay valid as they are changed; see obiwan.validated()
+
+The object is checked against its template once.  After that each change is checked against
+the template of just the key or item it touches, before it is made, so keeping a big object
+valid costs in proportion to the changes rather than to the size of the object.  The dicts
+and lists inside are proxied too when they are looked up, so they can be changed in place.
+The proxies are not dicts or lists, so serialize .target, the object itself.
+"""
+
+import collections.abc
+
+from obiwan import ObiwanError, CompiledTemplate, compile, _index_dict, _dict_sources, \
+    _CHILD, _INDEX, _KEY, _KEY_CHILD
+
+
+class _Shape:
+    "how to check the changes to a dict or list against a template"
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.kind = None  # dict or list if changes can be checked, else None
+        template = compiled.template
+        while isinstance(template, CompiledTemplate):
+            template = template.template
+        if isinstance(template, dict):
+            self.kind = dict
+            self.template = template
+            self.sources = _dict_sources(template)
+            self._index()
+        elif isinstance(template, list) and len(template) == 1:
+            self.kind = list
+            self.item = compile(template[0])
+
+    def _index(self):
+        try:
+            required, noneables, optionals, generics, _, self.strict = _index_dict(self.template, templates=True)
+        except ValueError as e:
+            raise ObiwanError("bad template: %s" % e)
+        self.children = {}  # key -> (compiled template, whether it must be present, whether it can be None)
+        self.children.update((key, (compiled, True, False)) for key, compiled in required)
+        self.children.update((key, (compiled, True, True)) for key, compiled in noneables)
+        self.children.update((key, (compiled, False, False)) for key, compiled in optionals)
+        self.generics = [(check_key, check_value) for check_key, check_value, _, _ in generics]
+        self.sizes = tuple(map(len, self.sources))
+
+    def current(self):
+        """self, indexed again if keys have been added to or removed from the dict template or the
+        templates it inherits from since, as the compiled template does"""
+        if self.kind is dict and tuple(map(len, self.sources)) != self.sizes:
+            self._index()
+        return self
+
+
+def _shape(template):
+    "the shape of a template, cached on its compiled template"
+    compiled = compile(template)
+    shape = getattr(compiled, "_proxy_shape", None)
+    if shape is None:
+        shape = compiled._proxy_shape = _Shape(compiled)
+    return shape
+
+
+def _proxy(obj, shape, ctx, segments):
+    "obj behind a proxy if it is the kind of container shape checks the changes of, else obj itself"
+    if shape.kind is dict and isinstance(obj, dict):
+        return ValidatedDict(obj, shape, ctx, segments)
+    if shape.kind is list and isinstance(obj, list):
+        return ValidatedList(obj, shape, ctx, segments)
+    return obj
+
+
+def _target(value):
+    "value, or the dict or list behind it if it is a proxy, e.g. one read from another proxy"
+    return value.target if isinstance(value, _Validated) else value
+
+
+def validated(obj, template, ctx="checking"):
+    "checks obj against template, and returns a proxy that checks the changes made through it"
+    shape = _shape(template)
+    if shape.kind is None:
+        raise ObiwanError("bad template: %s is not a dict or list template" % (shape.compiled.template,))
+    shape.compiled.check(obj, ctx)
+    proxy = _proxy(obj, shape, ctx, ())
+    if proxy is obj:
+        raise ObiwanError("%s is %s but should be a %s" % (ctx, type(obj), shape.kind.__name__))
+    return proxy
+
+
+class _Validated:
+    def __init__(self, target, shape, ctx, segments):
+        self.target = target  # the dict or list itself
+        self._shape = shape
+        self._ctx = ctx
+        self._segments = segments  # the path from the root, innermost first, as in ObiwanError
+
+    def _error(self, e):
+        "e, which is relative to the target, made relative to the root"
+        for fmt, key in self._segments:
+            e._at(fmt, key)
+        if e.ctx is None:
+            e.ctx = self._ctx
+        return e
+
+    def _check(self, check, value, fmt, key):
+        try:
+            check._check(value)
+        except ObiwanError as e:
+            raise self._error(e._at(fmt, key))
+        except Exception as e:
+            raise self._error(ObiwanError(" internal error: %s" % e)._at(fmt, key))
+
+    def _child(self, value, template, fmt, key):
+        return _proxy(value, _shape(template), self._ctx, ((fmt, key),) + self._segments)
+
+    def __len__(self):
+        return len(self.target)
+
+    def __contains__(self, item):
+        return item in self.target
+
+    def __eq__(self, other):
+        return self.target == getattr(other, "target", other)
+
+    def __repr__(self):
+        return "obiwan.validated(%r)" % (self.target,)
+
+
+class ValidatedDict(_Validated, collections.abc.MutableMapping):
+    "a dict that checks each item set and deleted against its template"
+    def _template(self, key):
+        "the template of the value of key and the format of its path, or (None, None) if it isn't just one"
+        shape = self._shape.current()
+        child = shape.children.get(key)
+        if child is not None:
+            return child[0], _CHILD
+        if len(shape.generics) == 1:
+            return shape.generics[0][1], _KEY_CHILD
+        return None, None
+
+    def __getitem__(self, key):
+        value = self.target[key]
+        template, fmt = self._template(key)
+        return value if template is None else self._child(value, template, fmt, key)
+
+    def __iter__(self):
+        return iter(self.target)
+
+    def _check_item(self, key, value):
+        shape = self._shape.current()
+        child = shape.children.get(key)
+        if child is not None:
+            check, required, can_be_none = child
+            if value is not None or not can_be_none:
+                self._check(check, value, _CHILD, key)
+        elif shape.strict:
+            raise self._error(ObiwanError(" should not have a child called %s" % (key,)))
+        for check_key, check_value in shape.generics:
+            self._check(check_key, key, _KEY, key)
+            self._check(check_value, value, _KEY_CHILD, key)
+
+    def __setitem__(self, key, value):
+        value = _target(value)
+        self._check_item(key, value)
+        self.target[key] = value
+
+    def _check_delete(self, key):
+        child = self._shape.current().children.get(key)
+        if child is not None and child[1] and key in self.target:
+            raise self._error(ObiwanError(" should have child called %s" % (key,)))
+
+    def __delitem__(self, key):
+        self._check_delete(key)
+        del self.target[key]
+
+    def update(self, other=(), **kwargs):
+        "checks all the items before setting any of them"
+        items = {key: _target(value) for key, value in dict(_target(other), **kwargs).items()}
+        for key, value in items.items():
+            self._check_item(key, value)
+        self.target.update(items)
+
+    def clear(self):
+        for key in self.target:
+            self._check_delete(key)
+        self.target.clear()
+
+
+class ValidatedList(_Validated, collections.abc.MutableSequence):
+    "a list that checks each item set, inserted and appended against its template"
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.target[index]
+        value = self.target[index]
+        return self._child(value, self._shape.item, _INDEX, range(len(self.target))[index])
+
+    def __iter__(self):
+        if _shape(self._shape.item).kind is None:
+            return iter(self.target)
+        return (self._child(value, self._shape.item, _INDEX, i) for i, value in enumerate(self.target))
+
+    def _check_items(self, values, first, step=1):
+        "checks the items of the list values, which are going at index first and every step after it"
+        if len(values) == 1:
+            return self._check(self._shape.item, values[0], _INDEX, first)
+        try:
+            self._shape.compiled._check(values)  # lists of plain types are checked in bulk
+        except ObiwanError as e:
+            fmt, index = e._segments[-1]  # the index into values, which is outermost
+            e._segments[-1] = (fmt, first + index * step)
+            raise self._error(e)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_target(item) for item in _target(value)]
+            start, stop, step = index.indices(len(self.target))
+            self._check_items(value, start, step)
+        else:
+            value = _target(value)
+            self._check(self._shape.item, value, _INDEX, range(len(self.target))[index])
+        self.target[index] = value
+
+    def __delitem__(self, index):
+        del self.target[index]
+
+    def insert(self, index, value):
+        value = _target(value)
+        size = len(self.target)
+        self._check(self._shape.item, value, _INDEX, min(max(index + size if index < 0 else index, 0), size))
+        self.target.insert(index, value)
+
+    def append(self, value):
+        value = _target(value)
+        self._check(self._shape.item, value, _INDEX, len(self.target))
+        self.target.append(value)
+
+    def extend(self, values):
+        "checks all the values before adding any of them"
+        values = [_target(value) for value in _target(values)]
+        if values:
+            self._check_items(values, len(self.target))
+        self.target.extend(values)
+
+    def reverse(self):
+        self.target.reverse()
+
+    def sort(self, *args, **kwargs):
+        self.target.sort(*args, **kwargs)
@@ -0,0 +1,123 @@
+"""columnar validation of lists of records, e.g. rows against {"id": int, "ts": float, optional("tag"): str}
+
+The record template is resolved once for all the rows.  Unexpected keys are found with a set
+union over all the rows, and each key's column is pulled out at C speed, which also shows
+which rows lack it.  Each column is then checked in one pass: plain types at C speed, and
+custom checks that can check many values at once, like RangeCheck, on numpy arrays when
+numpy is in use.  Only the rows a column may fail on are checked one at a time.
+"""
+
+import itertools
+import operator
+import sys
+
+from obiwan import ObiwanError, validate, _bulk_checker, _collector, _index_dict, _missing, _CHILD, _INDEX
+
+
+def _column(rows, key):
+    """the values of key in rows, and the indexes of the rows that have it, or None if they all do"""
+    try:
+        return list(map(operator.itemgetter(key), rows)), None
+    except KeyError:
+        pass
+    column = list(map(operator.methodcaller("get", key, _missing), rows))
+    present = list(map(operator.is_not, column, itertools.repeat(_missing)))
+    if all(present):
+        return column, None
+    return list(itertools.compress(column, present)), list(itertools.compress(range(len(rows)), present))
+
+
+def _absent(rows, indexes):
+    "the indexes of the rows not in the sorted list indexes"
+    if indexes is None:
+        return []
+    return sorted(set(range(len(rows))).difference(indexes))
+
+
+def _first_failure(first_failure, values):
+    "the index of the first value that might fail, using numpy for numbers if it is in use"
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and getattr(first_failure, "__name__", None) == "check_many" and len(values) > 1:
+        kinds = set(map(type, values))
+        if kinds == {int} or kinds == {float}:
+            return first_failure(numpy.array(values))
+    return first_failure(values)
+
+
+def _check_column(check, first_failure, values, max_errors):
+    "[(index into values, ObiwanError)] of up to max_errors values that fail check"
+    start = 0
+    if first_failure is not None:
+        start = _first_failure(first_failure, values)
+        if start is None:
+            return []
+    failures = []
+    _collector.count = 0
+    for i in range(start, len(values)):
+        try:
+            check(values[i])
+        except ObiwanError as e:
+            failures.extend((i, error) for error in getattr(e, "errors", [e]))
+            if len(failures) >= max_errors:
+                break
+    return failures[:max_errors]
+
+
+def _columns(template):
+    """(columns, is_strict) of a dict template, where columns is [(key, compiled value template, whether it
+    must be present, whether it can be None)], or None if it isn't a template of named keys.  The columns are
+    in the order a dict is checked in: the required keys, then the noneable ones, then the optional ones"""
+    if not isinstance(template, dict):
+        return None, False
+    try:
+        required, noneables, optionals, generics, _, is_strict = _index_dict(template, templates=True)
+    except ValueError as e:
+        raise ObiwanError("bad template: %s" % e)
+    if generics:
+        return None, False  # generic keys have to be checked against every key anyway
+    return [(key, value, True, False) for key, value in required] + \
+        [(key, value, True, True) for key, value in noneables] + \
+        [(key, value, False, False) for key, value in optionals], is_strict
+
+
+def validate_records(rows, template, max_errors=100, ctx="checking"):
+    """checks a list of dicts against the dict template a column at a time; returns a list of up to
+    max_errors ObiwanErrors for the first rows that fail, each with a path of (row, key, ...), like
+    validate(rows, [template]) does.  Rows that aren't all dicts are checked by validate()"""
+    if max_errors < 1:
+        raise ValueError("max_errors must be at least 1")
+    columns, is_strict = _columns(template)
+    if columns is None or not isinstance(rows, (list, tuple)) or \
+            not all(issubclass(kind, dict) for kind in set(map(type, rows))):
+        return validate(rows, [template], max_errors, ctx)
+    errors = []  # (row, ObiwanError), in the order a dict's checks find them within each row
+    if is_strict:
+        unexpected = set().union(*rows).difference(key for key, value, required, can_be_none in columns)
+        if unexpected:
+            for row, obj in enumerate(rows):
+                errors.extend((row, ObiwanError(" should not have a child called %s" % (key,)))
+                    for key in obj if key in unexpected)
+    saved = _collector.max_errors, _collector.count
+    _collector.max_errors = max_errors
+    try:
+        for key, value, required, can_be_none in columns:
+            values, indexes = _column(rows, key)
+            if required:
+                errors.extend((row, ObiwanError(" should have child called %s" % (key,)))
+                    for row in _absent(rows, indexes)[:max_errors])
+            if can_be_none:
+                present = list(map(operator.is_not, values, itertools.repeat(None)))
+                if not all(present):
+                    values = list(itertools.compress(values, present))
+                    indexes = list(itertools.compress(range(len(rows)) if indexes is None else indexes, present))
+            for i, error in _check_column(value._check, _bulk_checker(value), values, max_errors):
+                errors.append((i if indexes is None else indexes[i], error._at(_CHILD, key)))
+    finally:
+        _collector.max_errors, _collector.count = saved
+    errors.sort(key=operator.itemgetter(0))
+    errors = errors[:max_errors]
+    for row, error in errors:
+        error._at(_INDEX, row)
+        if error.ctx is None:
+            error.ctx = ctx
+    return [error for row, error in errors]
@@ -0,0 +1,559 @@
+"""incremental JSON parsing that validates against a template as the document arrives
+
+The document is read in chunks and tokenised as bytes, so byte offsets are exact.  The
+parser descends into dict, list and tuple templates token by token, so a document fails
+at its first violation without the rest of it being read; anything else (leaf types,
+multiple-choice sets, custom checks) is parsed into a value and given to the compiled
+checker.  Errors are ObiwanErrors with the path and the byte offset of the bad value,
+and malformed JSON raises json.JSONDecodeError.
+
+aload() does the same for documents arriving on an asyncio event loop.  Small documents are
+parsed on the loop once they have arrived; bigger ones are parsed by a thread while they
+arrive, so the loop only waits for chunks and is never held up parsing a big document.
+"""
+
+import asyncio
+import queue
+import re
+import json as _json
+from json.decoder import scanstring as _scanstring
+
+from obiwan import ObiwanError, CompiledTemplate, compile, optional, noneable, \
+    _dict_sources, _index_dict, _CHILD, _INDEX, _KEY, _KEY_CHILD
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_NUMBER = re.compile(rb"(-?(?:0|[1-9][0-9]*))(\.[0-9]+)?([eE][-+]?[0-9]+)?")
+_LITERALS = {b"true": True, b"false": False, b"null": None,
+    b"NaN": float("nan"), b"Infinity": float("inf"), b"-Infinity": float("-inf")}
+_PUNCTUATION = frozenset(b"{}[]:,")
+_LITERAL_END = re.compile(rb"[ \t\n\r{}\[\]:,\"]")
+
+VALUE = "value"  # token kind of strings, numbers and literals
+EOF = "eof"
+
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+def chunks(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    "the byte chunks of a file object, a bytes-like or str document, or an iterable of chunks"
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield source
+    elif isinstance(source, str):
+        yield source.encode("utf-8")
+    else:
+        for chunk in source:
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class Tokens:
+    "a JSON tokeniser over chunks of bytes; next() returns (kind, value, offset)"
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.buf = bytearray()
+        self.pos = 0  # in buf
+        self.base = 0  # the offset in the document of buf[0]
+        self.eof = False
+
+    def fill(self):
+        "reads another chunk; returns False at the end of the document"
+        for chunk in self._chunks:
+            if chunk:
+                self.buf += chunk
+                return True
+        self.eof = True
+        return False
+
+    def error(self, message, offset):
+        return _json.JSONDecodeError(message, "", offset)  # so the reported char is the byte offset
+
+    def next(self):
+        buf = self.buf
+        if self.pos > DEFAULT_CHUNK_SIZE:  # drop what we've parsed, so memory is bounded by the biggest token
+            del buf[:self.pos]
+            self.base += self.pos
+            self.pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, self.pos).end()
+            if pos < len(buf):
+                break
+            self.pos = pos
+            if not self.fill():
+                return EOF, None, self.base + pos
+        c = buf[pos]
+        if c in _PUNCTUATION:
+            self.pos = pos + 1
+            return chr(c), None, self.base + pos
+        if c == 0x22:  # "
+            return VALUE, self._string(pos), self.base + pos
+        return VALUE, self._literal(pos), self.base + pos
+
+    def _string(self, start):
+        buf = self.buf
+        i = start + 1
+        while True:
+            end = buf.find(b"\"", i)
+            if end < 0:
+                i = len(buf)
+                if not self.fill():
+                    raise self.error("Unterminated string", self.base + start)
+                continue
+            backslash = end - 1
+            while buf[backslash] == 0x5c:  # \
+                backslash -= 1
+            if (end - 1 - backslash) % 2 == 0:
+                break
+            i = end + 1
+        self.pos = end + 1
+        try:
+            return _scanstring(buf[start + 1:end + 1].decode("utf-8"), 0)[0]
+        except UnicodeDecodeError as e:
+            raise self.error("Invalid UTF-8 in string (%s)" % e.reason, self.base + start)
+        except ValueError as e:
+            raise self.error("Invalid string (%s)" % e.args[0].split(":")[0], self.base + start)
+
+    def _literal(self, start):
+        buf = self.buf
+        while True:  # a number or literal might continue into the next chunk
+            match = _LITERAL_END.search(buf, start)
+            if match or not self.fill():
+                break
+        end = match.start() if match else len(buf)
+        self.pos = end
+        literal = bytes(buf[start:end])
+        match = _NUMBER.fullmatch(literal)
+        if match:
+            integer, fraction, exponent = match.groups()
+            if fraction is None and exponent is None:
+                return int(integer)
+            return float(literal)
+        try:
+            return _LITERALS[literal]
+        except KeyError:
+            raise self.error("Expecting value", self.base + start)
+
+
+class _Node:
+    "how to parse a template: whether to descend into it token by token, or parse a value and check it"
+    def __init__(self, template):
+        self.compiled = compile(template)
+        self.kind = None
+        template = self.compiled.template
+        while isinstance(template, CompiledTemplate):
+            template = template.template
+        self.accept_null = False
+        if isinstance(template, (optional, noneable)):
+            self.accept_null = True
+            template = template.key if isinstance(template, optional) else template.template
+            self.compiled = compile(template)
+        if isinstance(template, str) or template is any:
+            self.kind = any
+        elif isinstance(template, dict):
+            self.template = template
+            self.sources = _dict_sources(template)
+            self._index()
+        elif isinstance(template, list) and len(template) == 1:
+            self.kind = list
+            self.item = _node(template[0])
+        elif isinstance(template, tuple):
+            self.kind = tuple
+            self.slots = []
+            self.open_ended = False
+            for expect in template:
+                if expect is Ellipsis:
+                    self.open_ended = True
+                    break
+                self.slots.append(_node(expect))
+            self.template = template
+
+    def _index(self):
+        try:
+            required, noneables, optionals, generics, self.allowed, self.strict = \
+                _index_dict(self.template, templates=True)
+        except ValueError:
+            self.kind = None  # the compiled check reports it
+            return
+        self.kind = dict
+        self.required = [key for key, _ in required + noneables]
+        self.named = {key: _node(value) for key, value in required + optionals}
+        self.named.update((key, _node(noneable(value))) for key, value in noneables)
+        self.generics = [(check_key, _node(value)) for check_key, value, _, _ in generics]
+        self.sizes = tuple(map(len, self.sources))
+
+    def current(self):
+        """self, indexed again if keys have been added to or removed from the dict template or the
+        templates it inherits from since, as the compiled template does"""
+        if tuple(map(len, self.sources)) != self.sizes:
+            self._index()
+        return self
+
+
+def _node(template):
+    "the streaming node of a template, cached on its compiled template"
+    compiled = compile(template)
+    node = getattr(compiled, "_stream_node", None)
+    if node is None:
+        node = compiled._stream_node = _Node(compiled)
+    return node
+
+
+class Parser:
+    "parses and validates JSON from a Tokens, within the limits of a limits policy if given"
+    def __init__(self, tokens, limits=None):
+        self.tokens = tokens
+        self.limits = None if limits is None else limits.reader()
+
+    def expect(self, kinds, message):
+        token = self.tokens.next()
+        if token[0] not in kinds:
+            if token[0] == EOF:
+                raise self.tokens.error("Unexpected end of document; " + message, token[2])
+            raise self.tokens.error(message, token[2])
+        return token
+
+    def parse(self, node, token):
+        "parses the value starting with token, checking it against node"
+        try:
+            if token[0] == VALUE and token[1] is None and node.accept_null:
+                return None
+            kind = node.kind
+            if kind is dict:
+                if token[0] == "{" and node.current().kind is dict:
+                    return self.parse_dict(node, token)
+                if token[0] == "[":
+                    raise ObiwanError(" is %s but should be a dict" % list)
+            elif kind is list or kind is tuple:
+                if token[0] == "[":
+                    return self.parse_list(node, token) if kind is list else self.parse_tuple(node, token)
+                if token[0] == "{":
+                    if kind is list:
+                        raise ObiwanError(" is %s but should be %s" % (dict, node.compiled.template))
+                    raise ObiwanError(" is %s but should be packed %s" % (dict, node.template))
+            value = self.value(token)
+            if kind is not any:
+                node.compiled._check(value)
+            return value
+        except ObiwanError as e:
+            if e.offset is None:
+                e.offset = token[2]
+            raise
+
+    def value(self, token):
+        "parses the value starting with token without checking it"
+        kind, value, offset = token
+        limits = self.limits
+        if kind == VALUE:
+            if limits is not None:
+                limits.string(value, offset)
+            return value
+        if kind == "[":
+            result = []
+            if limits is not None:
+                limits.enter(None, offset)
+            token = self.expect(("]", "{", "[", VALUE), "Expecting value")
+            while token[0] != "]":
+                if limits is not None:
+                    limits.item(len(result), token[2])
+                try:
+                    result.append(self.value(token))
+                except ObiwanError as e:
+                    e._at(_INDEX, len(result))
+                    raise
+                if self.expect((",", "]"), "Expecting ',' delimiter")[0] == "]":
+                    break
+                token = self.expect(("{", "[", VALUE), "Expecting value")
+        elif kind == "{":
+            result = {}
+            if limits is not None:
+                limits.enter(None, offset)
+            token = self.expect(("}", VALUE), "Expecting property name enclosed in double quotes")
+            while token[0] != "}":
+                if limits is not None:
+                    limits.item(len(result), token[2])
+                key = self.key(token)
+                try:
+                    result[key] = self.value(self.expect(("{", "[", VALUE), "Expecting value"))
+                except ObiwanError as e:
+                    e._at(_CHILD, key)
+                    raise
+                if self.expect((",", "}"), "Expecting ',' delimiter")[0] == "}":
+                    break
+                token = self.expect((VALUE,), "Expecting property name enclosed in double quotes")
+        else:
+            raise self.tokens.error("Expecting value", offset)
+        if limits is not None:
+            limits.leave()
+        return result
+
+    def key(self, token):
+        key = token[1]
+        if not isinstance(key, str):
+            raise self.tokens.error("Expecting property name enclosed in double quotes", token[2])
+        if self.limits is not None:
+            try:
+                self.limits.string(key, token[2])
+            except ObiwanError as e:
+                e._at(_KEY, key)
+                raise
+        self.expect((":",), "Expecting ':' delimiter")
+        return key
+
+    def parse_dict(self, node, token):
+        result = {}
+        limits = self.limits
+        if limits is not None:
+            limits.enter(None, token[2])
+        token = self.expect(("}", VALUE), "Expecting property name enclosed in double quotes")
+        while token[0] != "}":
+            key_offset = token[2]
+            if limits is not None:
+                limits.item(len(result), key_offset)
+            key = self.key(token)
+            if node.strict and key not in node.allowed:
+                error = ObiwanError(" should not have a child called %s" % (key,))
+                error.offset = key_offset
+                raise error
+            named = node.named.get(key)
+            value_nodes = [] if named is None else [(named, _CHILD)]
+            for check_key, value_node in node.generics:
+                try:
+                    check_key._check(key)
+                except ObiwanError as e:
+                    e._at(_KEY, key)
+                    e.offset = key_offset
+                    raise
+                value_nodes.append((value_node, _KEY_CHILD))
+            token = self.expect(("{", "[", VALUE), "Expecting value")
+            if not value_nodes:
+                try:
+                    result[key] = self.value(token)
+                except ObiwanError as e:
+                    e._at(_CHILD, key)
+                    raise
+            else:  # stream the value through the first template, and check it against any others
+                value_node, fmt = value_nodes[0]
+                try:
+                    value = result[key] = self.parse(value_node, token)
+                except ObiwanError as e:
+                    e._at(fmt, key)
+                    raise
+                for value_node, fmt in value_nodes[1:]:
+                    try:
+                        value_node.compiled._check(value)
+                    except ObiwanError as e:
+                        e._at(fmt, key)
+                        e.offset = token[2]
+                        raise
+            token = self.expect((",", "}"), "Expecting ',' delimiter")
+            if token[0] == "}":
+                break
+            token = self.expect((VALUE,), "Expecting property name enclosed in double quotes")
+        for key in node.required:
+            if key not in result:
+                error = ObiwanError(" should have child called %s" % (key,))
+                error.offset = token[2]
+                raise error
+        if limits is not None:
+            limits.leave()
+        return result
+
+    def items(self, node, token):
+        "yields the checked items of the list starting with token"
+        i = 0
+        limits = self.limits
+        if limits is not None:
+            limits.enter(None, token[2])
+        token = self.expect(("]", "{", "[", VALUE), "Expecting value")
+        while token[0] != "]":
+            if limits is not None:
+                limits.item(i, token[2])
+            try:
+                yield self.parse(node, token)
+            except ObiwanError as e:
+                e._at(_INDEX, i)
+                raise
+            i += 1
+            if self.expect((",", "]"), "Expecting ',' delimiter")[0] == "]":
+                break
+            token = self.expect(("{", "[", VALUE), "Expecting value")
+        if limits is not None:
+            limits.leave()
+
+    def parse_list(self, node, token):
+        return list(self.items(node.item, token))
+
+    def parse_tuple(self, node, token):
+        result = []
+        slots = node.slots
+        limits = self.limits
+        if limits is not None:
+            limits.enter(None, token[2])
+        token = self.expect(("]", "{", "[", VALUE), "Expecting value")
+        while token[0] != "]":
+            i = len(result)
+            if limits is not None:
+                limits.item(i, token[2])
+            if i < len(slots):
+                try:
+                    result.append(self.parse(slots[i], token))
+                except ObiwanError as e:
+                    e._at(_INDEX, i)
+                    raise
+            elif node.open_ended:
+                try:
+                    result.append(self.value(token))
+                except ObiwanError as e:
+                    e._at(_INDEX, i)
+                    raise
+            else:
+                raise ObiwanError(" is %s but should be packed %s" % (list, node.template))
+            token = self.expect((",", "]"), "Expecting ',' delimiter")
+            if token[0] == "]":
+                break
+            token = self.expect(("{", "[", VALUE), "Expecting value")
+        if len(result) < len(slots):
+            for i in range(len(result), len(slots)):
+                if slots[i].compiled.template is not any:
+                    error = ObiwanError(" should be %s but is omitted" % (slots[i].compiled.template,))._at(_INDEX, i)
+                    error.offset = token[2]
+                    raise error
+            if not node.open_ended:
+                error = ObiwanError(" is %s but should be packed %s" % (list, node.template))
+                error.offset = token[2]
+                raise error
+        if limits is not None:
+            limits.leave()
+        return result
+
+    def end(self):
+        token = self.tokens.next()
+        if token[0] != EOF:
+            raise self.tokens.error("Extra data", token[2])
+
+
+def load(source, template=any, ctx="json validation ", chunk_size=DEFAULT_CHUNK_SIZE):
+    """parses and returns the JSON document from source, checking it against template, and its
+    limits if it has any, as it is read"""
+    parser = Parser(Tokens(chunks(source, chunk_size)), compile(template).limits)
+    try:
+        ret = parser.parse(_node(template), parser.expect(("{", "[", VALUE), "Expecting value"))
+    except ObiwanError as e:
+        if e.ctx is None:
+            e.ctx = ctx
+        raise
+    except RecursionError:
+        raise ObiwanError(" is nested too deeply to parse", ctx)
+    parser.end()
+    return ret
+
+
+def iter_items(source, template=any, ctx="json validation ", chunk_size=DEFAULT_CHUNK_SIZE):
+    """yields the items of the JSON array in source one at a time, checking them as they are read;
+    template is the template of the whole array, e.g. [int], or any"""
+    node = _node(template)
+    if node.kind is any:
+        node = _node([any])
+    elif node.kind is not list:
+        raise ObiwanError("%s template %s is not a list template" % (ctx, node.compiled.template))
+    parser = Parser(Tokens(chunks(source, chunk_size)), compile(template).limits)
+    token = parser.expect(("{", "[", VALUE), "Expecting value")
+    try:
+        if token[0] != "[":  # probably fails, but a string is a sequence too
+            yield from parser.parse(node, token)
+        else:
+            yield from parser.items(node.item, token)
+    except ObiwanError as e:
+        if e.ctx is None:
+            e.ctx = ctx
+        raise
+    except RecursionError:
+        raise ObiwanError(" is nested too deeply to parse", ctx)
+    parser.end()
+
+
+_MAX_QUEUED_CHUNKS = 4  # chunks received but not yet parsed, when parsing in a thread
+
+
+async def _achunks(source, chunk_size):
+    "the byte chunks of a stream with an async read(n), such as asyncio's StreamReader, or an async iterable"
+    if hasattr(source, "read"):
+        while True:
+            chunk = await source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+    else:
+        async for chunk in source:
+            yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+async def _prefixed(received, chunks):
+    "the chunks of the list received, emptying it, and then the chunks of the async iterator chunks"
+    while received:
+        yield received.pop(0)
+    async for chunk in chunks:
+        yield chunk
+
+
+def _queued(chunks, consumed):
+    "the chunks put in a queue.Queue until None, calling consumed() as each is taken"
+    for chunk in iter(chunks.get, None):
+        consumed()
+        yield chunk
+
+
+def _load_queued(chunks, consumed, stopped, template, ctx, chunk_size):
+    try:
+        return load(_queued(chunks, consumed), template, ctx, chunk_size)
+    finally:
+        stopped()  # so the reader isn't left waiting for room if this stopped early
+
+
+async def aload(source, template=any, ctx="json validation ", executor=None, chunk_size=DEFAULT_CHUNK_SIZE,
+        inline_bytes=DEFAULT_CHUNK_SIZE):
+    """parses and returns the JSON document from source, an async iterable of byte chunks or a stream
+    with an async read(n), checking it against template as it arrives.  Documents of up to inline_bytes
+    are parsed on the event loop; bigger ones are parsed as they arrive by a thread of executor, by
+    default the loop's, so a document fails at its first violation without the rest being read"""
+    received, size = [], 0
+    chunks = _achunks(source, chunk_size)
+    rest = _prefixed(received, chunks)
+    try:
+        async for chunk in chunks:
+            received.append(chunk)
+            size += len(chunk)
+            if size > inline_bytes:
+                break
+        else:
+            return load(received, template, ctx, chunk_size)
+        loop = asyncio.get_running_loop()
+        pending, room = queue.Queue(), asyncio.Semaphore(_MAX_QUEUED_CHUNKS)
+        stopped = False
+        def stop():
+            nonlocal stopped
+            stopped = True  # set with the room it makes, as parsed may not be done when the reader gets that
+            room.release()
+        def consumed():
+            loop.call_soon_threadsafe(room.release)
+        parsed = loop.run_in_executor(executor, _load_queued, pending, consumed,
+            lambda: loop.call_soon_threadsafe(stop), template, ctx, chunk_size)
+        try:
+            async for chunk in rest:
+                await room.acquire()
+                if stopped:  # failed without needing the rest
+                    break
+                pending.put(chunk)
+        except BaseException:
+            parsed.add_done_callback(lambda future: future.cancelled() or future.exception())  # not logged
+            raise
+        finally:
+            pending.put(None)
+        return await parsed
+    finally:
+        await rest.aclose()
+        await chunks.aclose()
@@ -0,0 +1,42 @@
+import obiwan
+import sys
+import unittest
+
+from obiwan import bench
+
+
+class Tests(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run(["duckable.duck", "runtime"], repeat=1, min_time=0.001)
+        names = {(result["group"], result["name"]) for result in results["benchmarks"]}
+        self.assertIn(("duckable", "duck"), names)
+        self.assertIn(("runtime", "installed_call"), names)
+        self.assertNotIn(("json", "loads"), names)
+        self.assertTrue(all(result["seconds_per_call"] > 0 for result in results["benchmarks"]))
+        ratios = [ratio for _, ratio in bench.compare(results, results)]
+        self.assertEqual(ratios, [1.0] * len(results["benchmarks"]))
+
+    def test_json_documents_are_made_when_run(self):
+        benchmarks = list(bench.json_benchmarks())
+        self.assertTrue(all(benchmark.func is None and "bytes" not in benchmark.params for benchmark in benchmarks))
+        benchmarks[0].prepare()
+        self.assertEqual(benchmarks[0].func(), [{"id": i, "name": "user%d" % i, "score": i / 3, "tags": ["a", "b"],
+            "owner": {"id": i, "email": "u%d@example.com" % i}} for i in range(10)])
+        self.assertEqual(list(benchmarks[0].documents), [10])
+
+    def test_runtime_restores_tracer(self):
+        def tracer(frame, event, arg):
+            return None
+        previous = sys.gettrace()
+        sys.settrace(tracer)
+        try:
+            with bench._RuntimeBenchmark("installed_call", "settrace"):
+                self.assertIs(sys.gettrace(), obiwan._runtime_checker)
+            self.assertIs(sys.gettrace(), tracer)
+        finally:
+            sys.settrace(previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
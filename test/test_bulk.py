@@ -0,0 +1,128 @@
+import json
+import obiwan
+import obiwan.bulk
+import os
+import tempfile
+import unittest
+
+
+class Tests(unittest.TestCase):
+
+    template = {'id': int, obiwan.optional('tags'): [str], 'check': lambda x: x >= 0}
+
+    def lines(self):
+        lines = []
+        for i in range(1, 301):
+            doc = {'id': i, 'tags': ['a'], 'check': i}
+            if i % 100 == 0:
+                doc['tags'] = [1]
+            lines.append(json.dumps(doc))
+        lines[49] = '{"id": 50, "check": -1}'
+        lines[149] = '{"id": '
+        lines[199] = '{"id": 200, "check": 1, "tags": [2]}'
+        return lines
+
+    def check(self, results):
+        results = list(results)
+        self.assertEqual([r.line for r in results], [50, 100, 150, 200, 300])
+        self.assertEqual(results[0].path, ('check',))
+        self.assertEqual(results[1].path, ('tags', 0))
+        self.assertTrue(results[1].message.startswith('line 100["tags"][0] is'), results[1].message)
+        self.assertIsNone(results[2].path)
+        self.assertIn('not valid JSON', results[2].message)
+
+    def test_iterable(self):
+        lines = self.lines() + ['']  # blank lines are allowed
+        self.check(obiwan.json.validate_lines(lines, self.template, workers=1))
+        results = list(obiwan.json.validate_lines(lines[:3], self.template, workers=1, only_errors=False))
+        self.assertEqual([(r.line, r.message) for r in results], [(1, None), (2, None), (3, None)])
+
+    def test_file_with_workers(self):
+        lines = self.lines()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "lines.json")
+            with open(path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            validation = obiwan.bulk.LineValidation(path, self.template, workers=2, chunk_bytes=1000)
+            self.check(validation)
+            self.assertEqual(validation.lines, 300)
+            self.assertEqual(validation.errors, 5)
+            self.assertEqual(validation.bytes, os.path.getsize(path) - 300)
+            self.assertGreater(validation.summary()['lines_per_second'], 0)
+
+    def array(self):
+        items = []
+        for i in range(300):
+            item = {'id': i, 'tags': ['a', 'é ,{"id"'], 'check': i}  # looks like an item starts in the string
+            if i % 100 == 99:
+                item['tags'] = [1]
+            items.append(item)
+        items[49]['check'] = -1
+        return items
+
+    def check_array(self, results, data):
+        results = list(results)
+        self.assertEqual([r.index for r in results], [49, 99, 199, 299])
+        self.assertEqual(results[0].path, (49, 'check'))
+        self.assertEqual(results[1].path, (99, 'tags', 0))
+        self.assertTrue(results[1].message.startswith('json validation [99]["tags"][0] is'), results[1].message)
+        self.assertEqual(data[results[1].offset:results[1].offset + 2], b'1\n')
+
+    def test_array_file(self):
+        data = json.dumps(self.array(), ensure_ascii=False, indent=1).encode()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "array.json")
+            with open(path, "wb") as f:
+                f.write(data)
+            self.check_array(obiwan.json.validate_array(path, [self.template], workers=1), data)
+            validation = obiwan.bulk.ArrayValidation(path, [self.template], workers=2, chunk_bytes=500)
+            self.check_array(validation, data)
+            self.assertEqual(validation.items, 300)
+            self.assertEqual(validation.errors, 4)
+            self.assertGreater(validation.summary()['items_per_second'], 0)
+            self.assertEqual(len(list(obiwan.json.validate_array(path, any, workers=1, only_errors=False))), 300)
+            with open(path, "wb") as f:
+                f.write(data[:5000] + b' ]')
+            results = list(obiwan.bulk.ArrayValidation(path, [self.template], workers=2, chunk_bytes=500))
+            self.assertIsNone(results[-1].path)
+            self.assertIn('not valid JSON', results[-1].message)
+            with self.assertRaises(obiwan.ObiwanError):
+                obiwan.json.validate_array(path, {'id': int})
+            for broken in (b'', b'{"id": 1}', b'[{"id": 1}, '):
+                with open(path, "wb") as f:
+                    f.write(broken)
+                validation = obiwan.bulk.ArrayValidation(path, any, workers=1, only_errors=False)
+                results = list(validation)
+                self.assertEqual(len(results), validation.items + 1)
+                self.assertEqual(validation.errors, 1)
+                self.assertIn('not valid JSON', results[-1].message)
+
+    def test_limits(self):
+        template = {'id': int, obiwan.optional('tags'): [str], 'check': lambda x: x >= 0}
+        obiwan.limit(template, obiwan.limits(length=2))
+        lines = ['{"id": 1, "check": 1}', '{"id": 2, "check": 2, "tags": []}']
+        results = list(obiwan.json.validate_lines(lines, template, workers=1))
+        self.assertEqual([(r.line, r.path) for r in results], [(2, ())])
+        self.assertIn('has 3 items', results[0].message)
+
+        array, array_template = [[1, 2], [1, 2, 3], [4]], [[int]]
+        obiwan.limit(array_template, obiwan.limits(length=5, depth=1))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "array.json")
+            with open(path, "w") as f:
+                json.dump(array, f)
+            results = list(obiwan.json.validate_array(path, array_template, workers=1))
+        self.assertEqual([(r.index, r.path, r.offset) for r in results], [(0, (0,), 1), (1, (1,), 9), (2, (2,), 20)])
+        self.assertIn('nested more than the limit of 1 deep', results[0].message)
+
+    def test_array_items(self):
+        data = ' [1, "aé", {"b": [1.5]}, 12345678901234567890 ]\n'.encode()
+        items = obiwan.bulk.ArrayItems(data, 2, window=4)
+        found = list(iter(items.next, None))
+        self.assertEqual([value for offset, end, value in found], [1, 'aé', {'b': [1.5]}, 12345678901234567890])
+        self.assertEqual([data[offset:end] for offset, end, value in found][1:3], ['"aé"'.encode(), b'{"b": [1.5]}'])
+        self.assertEqual(list(iter(obiwan.bulk.ArrayItems(b'[ ]', 2).next, None)), [])
+        for bad, offset in ((b'[1, ]', 4), (b'[1 2]', 3), (b'[1] 2', 4)):
+            with self.assertRaises(ValueError) as raised:
+                list(iter(obiwan.bulk.ArrayItems(bad, 1).next, None))
+            self.assertEqual(raised.exception.pos, offset, bad)
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import types
+import unittest
+
+import obiwan
+from obiwan import codegen, noneable, optional, options, strict, subtype, union
+
+base = {"id": int}
+TEMPLATES = {
+    "user": {options: [strict, subtype(base)], "name": str, optional("age"): int, noneable("nick"): str,
+             "tags": [str], "pos": (int, int, ...), "extra": {str: int}, "even": lambda x: x % 2 == 0},
+    "event": union({"type": "login", "user": str}, {"type": "logout", "user": str, "reason": str},
+                   discriminator="type"),
+    "point": obiwan.duck(x=obiwan.number, y=obiwan.number),
+}
+
+
+class Tests(unittest.TestCase):
+
+    def generated(self):
+        module = types.ModuleType("validators_gen")
+        exec(codegen.generate(__name__ + ":TEMPLATES"), module.__dict__)
+        return module
+
+    def test_same_as_duckable(self):
+        module = self.generated()
+        user = {"id": 1, "name": "n", "nick": None, "tags": ["a"], "pos": (1, 2, "x"), "extra": {"a": 1}, "even": 2}
+        docs = [("user", user), ("user", dict(user, tags=["a", 1])), ("user", dict(user, bogus=1)),
+                ("user", dict(user, age="1")), ("user", dict(user, pos=(1,))), ("user", dict(user, extra={"a": "b"})),
+                ("user", dict(user, even=3)), ("user", {"id": 1}), ("user", []),
+                ("event", {"type": "login", "user": "u"}), ("event", {"type": "logout", "user": "u"}),
+                ("event", {"type": "x"}), ("event", 1),
+                ("point", types.SimpleNamespace(x=1, y=2.5)), ("point", types.SimpleNamespace(x=1))]
+        for name, doc in docs:
+            expected = actual = None
+            try:
+                obiwan.duckable(doc, TEMPLATES[name], "doc")
+            except obiwan.ObiwanError as e:
+                expected = str(e), e.path
+            try:
+                module.VALIDATORS[name](doc, "doc")
+            except obiwan.ObiwanError as e:
+                actual = str(e), e.path
+            self.assertEqual(expected, actual, (name, doc))
+        self.assertIs(module.VALIDATORS["user"], module.check_user)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "validators_gen.py")
+            codegen.main([__name__ + ":TEMPLATES", "-o", output])
+            with open(output) as f:
+                source = f.read()
+        self.assertIn("def check_event(obj, ctx=\"checking\"):", source)
+        self.assertIn("_foreign(", source)  # the lambda is compiled from the original when it's used
+        compile(source, output, "exec")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import io
+import unittest
+
+import obiwan
+from obiwan import packed
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Tests(unittest.TestCase):
+
+    template = {"id": int, obiwan.optional("tags"): [str], "pos": (int, int, ...)}
+
+    # {"id": 1, "tags": ["a", "b"], "pos": [1, 2, 3]}, and the same with "x" as its id
+    msgpack_doc = bytes.fromhex("83a2696401a474616773 92a161a162a3706f73 93010203")
+    msgpack_bad = bytes.fromhex("83a26964a178a474616773 92a161a162a3706f73 93010203")
+    cbor_doc = bytes.fromhex("a3626964016474616773826161616263706f7383010203")
+    cbor_bad = bytes.fromhex("a362696461786474616773826161616263706f7383010203")
+    doc = {"id": 1, "tags": ["a", "b"], "pos": [1, 2, 3]}
+
+    def unpackers(self, data):
+        yield packed.MsgpackUnpacker(data)
+        yield packed.MsgpackUnpacker(memoryview(data))
+        yield packed.MsgpackUnpacker([data[i:i + 3] for i in range(0, len(data), 3)])
+        if msgpack is not None:
+            yield packed.NativeMsgpackUnpacker(msgpack, data, chunk_size=3)
+
+    def test_msgpack(self):
+        for unpacker in self.unpackers(self.msgpack_doc):
+            self.assertEqual(packed.load(unpacker, self.template), self.doc)
+        for unpacker in self.unpackers(self.msgpack_bad):
+            with self.assertRaisesRegex(obiwan.ObiwanError, r'^msgpack validation \["id"\] is') as e:
+                packed.load(unpacker, self.template)
+            self.assertEqual(e.exception.offset, 4)
+        self.assertEqual(obiwan.msgpack.loads(self.msgpack_doc, self.template), self.doc)
+        self.assertEqual(obiwan.msgpack.load(io.BytesIO(self.msgpack_doc), self.template, chunk_size=2), self.doc)
+        with self.assertRaises(obiwan.ObiwanError) as e:
+            obiwan.msgpack.loads(self.msgpack_bad, self.template)
+        self.assertEqual((e.exception.path, e.exception.offset), (("id",), 4))
+        for data in (self.msgpack_doc[:-1], self.msgpack_doc + b"\x00", b"\xc1"):
+            for unpacker in self.unpackers(data):
+                self.assertRaises(ValueError, packed.load, unpacker, self.template)
+        values = bytes.fromhex("9acb3ff8000000000000cdffffd0fec0c2c3c40161d7010000000000000001d90178810102")
+        self.assertEqual(packed.load(packed.MsgpackUnpacker(values)),
+                         [1.5, 65535, -2, None, False, True, b"a", packed.ExtType(1, bytes(7) + b"\x01"), "x", {1: 2}])
+
+    def test_array_keys(self):
+        # {"a": {[1, 2]: 3}}, whose key is a tuple as a list can't be a key, and {[[1]]: 2}, which can't be decoded
+        data = bytes.fromhex("81a161 81920102 03")
+        for template in (any, {"a": dict}):
+            for unpacker in self.unpackers(data):
+                self.assertEqual(packed.load(unpacker, template), {"a": {(1, 2): 3}})
+            self.assertEqual(obiwan.msgpack.loads(data, template), {"a": {(1, 2): 3}})
+        for unpacker in self.unpackers(bytes.fromhex("81 919101 02")):
+            self.assertRaisesRegex(ValueError, "Unhashable map key", packed.load, unpacker)
+
+    def test_limits(self):
+        template = {"id": int, obiwan.optional("tags"): [str], "pos": (int, int, ...)}
+        obiwan.limit(template, obiwan.limits(length=2))
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^msgpack validation +has 3 items"):
+            obiwan.msgpack.loads(self.msgpack_doc, template)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^msgpack validation +has 3 items"):
+            packed.load(packed.MsgpackUnpacker(self.msgpack_doc), template)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^cbor validation +has 3 items"):
+            obiwan.cbor.loads(self.cbor_doc, template)
+        # checked as it is decoded, so it fails without the rest being read
+        def endless(start, item):
+            yield start
+            while True:
+                yield item
+        for limits, message in ((obiwan.limits(nodes=10), r"^msgpack validation +has more than the limit of 10 values"),
+                                (obiwan.limits(depth=3), r"^msgpack validation \[0\]\[0\]\[0\] is nested more than")):
+            template = [list]
+            obiwan.limit(template, limits)
+            array = b"\xdd\xff\xff\xff\xff", b"\x91\x91\x91\x01"  # of 2 ** 32 - 1 [[[1]]]
+            for unpacker in (packed.MsgpackUnpacker(endless(*array)), packed.unpacker(packed.MSGPACK, endless(*array))):
+                self.assertRaisesRegex(obiwan.ObiwanError, message, packed.load, unpacker, template)
+        template = [list]
+        obiwan.limit(template, obiwan.limits(length=3))
+        self.assertRaisesRegex(obiwan.ObiwanError, r"^cbor validation +has more than the limit of 3 items",
+                               obiwan.cbor.load, endless(b"\x9f", b"\x81\x81\x81\x01"), template)  # of indefinite length
+
+    def test_deeply_nested(self):
+        deep = b"\x91" * 100000 + b"\xc0"  # [[[...[None]...]]]
+        for unpacker in self.unpackers(deep):
+            with self.assertRaisesRegex(obiwan.ObiwanError, "nested too deeply"):
+                packed.load(unpacker, [object])
+        with self.assertRaisesRegex(obiwan.ObiwanError, "^msgpack validation.* is nested too deeply"):
+            obiwan.msgpack.loads(deep)
+        with self.assertRaisesRegex(obiwan.ObiwanError, "^cbor validation +is nested too deeply"):
+            obiwan.cbor.loads(b"\x81" * 100000 + b"\xf6")
+
+    def test_cbor(self):
+        self.assertEqual(obiwan.cbor.loads(self.cbor_doc, self.template), self.doc)
+        self.assertEqual(obiwan.cbor.load([self.cbor_doc[i:i + 2] for i in range(0, len(self.cbor_doc), 2)],
+                                          self.template), self.doc)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r'^cbor validation \["id"\] is') as e:
+            obiwan.cbor.loads(self.cbor_bad, self.template)
+        self.assertEqual(e.exception.offset, 4)
+        # indefinite lengths, half floats, bignums and tags
+        self.assertEqual(obiwan.cbor.loads(bytes.fromhex("bf61619f0102ff6162f93e00ff")), {"a": [1, 2], "b": 1.5})
+        self.assertEqual(obiwan.cbor.loads(bytes.fromhex("7f657374726561646d696e67ff")), "streaming")
+        self.assertEqual(obiwan.cbor.loads(bytes.fromhex("c249010000000000000000")), 2 ** 64)
+        self.assertEqual(obiwan.cbor.loads(bytes.fromhex("d82063612f62")), packed.Tag(32, "a/b"))
+        with self.assertRaisesRegex(obiwan.ObiwanError, r'^cbor validation \["a"\] is') as e:
+            obiwan.cbor.loads(bytes.fromhex("bf616160ff"), {"a": int})
+        self.assertEqual(e.exception.offset, 3)
+        for data in (self.cbor_doc[:-1], self.cbor_doc + b"\x00", b"\xff", b"\x1c"):
+            self.assertRaises(ValueError, obiwan.cbor.loads, data)
+
+    @unittest.skipIf(msgpack is None, "needs the msgpack package")
+    def test_same_as_msgpack(self):
+        doc = {"people": [{"id": i, "tags": ["x"] * i, "pos": [i, i, i]} for i in range(50)],
+               "extra": [1.5, -2 ** 63, 2 ** 64 - 1, b"bin", None, True, "é" * 40, msgpack.ExtType(3, b"e")],
+               1: {2: 3}}
+        data = msgpack.packb(doc, use_bin_type=True)
+        expected = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        self.assertEqual(packed.load(packed.MsgpackUnpacker(data)), expected)
+        self.assertEqual(obiwan.msgpack.loads(data, {"people": [self.template], "extra": list}), expected)
+        self.assertEqual(obiwan.msgpack.loads(obiwan.msgpack.dumps(self.doc, self.template), self.template), self.doc)
+        self.assertRaises(obiwan.ObiwanError, obiwan.msgpack.dumps, {"id": "x"}, self.template)
+
+
+if __name__ == "__main__":
+    unittest.main()
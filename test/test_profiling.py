@@ -0,0 +1,89 @@
+import gc
+import json
+import obiwan
+import obiwan.profiling
+import unittest
+import unittest.mock
+import weakref
+
+
+class Tests(unittest.TestCase):
+
+    def tearDown(self):
+        obiwan.disable_stats()
+
+    def test_stats(self):
+        template = {"name": str, "items": [{"id": int}]}
+
+        @obiwan.checked
+        def handle(a: int) -> str:
+            return "ok"
+
+        obiwan.enable_stats(nodes=True)
+        for i in range(10):
+            obiwan.duckable({"name": "a", "items": [{"id": i}, {"id": i}]}, template)
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.duckable({"name": "a", "items": [{"id": "x"}]}, template)
+        handle(1)
+        with self.assertRaises(obiwan.ObiwanError):
+            handle("1")
+        stats = obiwan.stats()
+        row = next(row for row in stats.templates if row["template"].startswith("{'name'"))
+        self.assertEqual((row["calls"], row["failures"]), (11, 1))
+        self.assertGreater(row["p99"], 0)
+        functions = {row["function"]: row for row in stats.functions}
+        name = "%s.%s" % (__name__, handle.__qualname__)
+        self.assertEqual((functions[name + "()"]["calls"], functions[name + "()"]["failures"]), (2, 1))
+        self.assertEqual(functions[name + "()->"]["calls"], 1)
+        paths = {row["path"]: row for row in stats.nodes if row["template"].startswith("{'name'")}
+        self.assertEqual(paths['["items"][*]["id"]']["calls"], 21)
+        self.assertEqual(paths['["items"][*]["id"]']["failures"], 1)
+        self.assertIn("templates", stats.table())
+        self.assertEqual(len(json.loads(stats.to_json())["functions"]), 2)
+
+        obiwan.disable_stats()
+        obiwan.duckable({"name": "a", "items": []}, template)
+        self.assertEqual(obiwan.stats().templates, stats.templates)  # not recording
+        obiwan.reset_stats()
+        self.assertEqual(obiwan.stats().templates, [])
+
+    def test_inline_templates(self):
+        obiwan.enable_stats(nodes=True)
+        for i in range(20):
+            obiwan.duckable({"id": i}, {"id": int})  # a new template each time
+        compiled = obiwan.CompiledTemplate([{"id": int}])  # not in the compile() cache
+        compiled.check([])
+        stats = obiwan.stats()
+        rows = [row for row in stats.templates if row["template"] == "{'id': <class 'int'>}"]
+        self.assertEqual([row["calls"] for row in rows], [20])
+        self.assertEqual([row["calls"] for row in stats.nodes if row["template"] == "{'id': <class 'int'>}"], [20])
+        ref = weakref.ref(compiled)
+        del compiled
+        gc.collect()
+        self.assertIsNone(ref())  # the statistics don't keep templates alive
+
+        class AtLeast(obiwan.ObiwanCheck):
+            def __init__(self, least):
+                self.least = least
+
+            def check(self, obj, ctx):
+                if obj < self.least:
+                    raise obiwan.ObiwanError("%s is less than %d" % (ctx, self.least))
+
+            def __repr__(self):
+                return "AtLeast"
+
+        obiwan.duckable({"x": 5}, {"x": AtLeast(1)})
+        with self.assertRaises(obiwan.ObiwanError):  # the same description, but its own timed copy
+            obiwan.duckable({"x": 5}, {"x": AtLeast(10)})
+
+        obiwan.reset_stats()
+        with unittest.mock.patch.object(obiwan.profiling, "ROWS", 3):
+            for obj, template in ((1, int), ("a", str), ({"b": 1}, {"b": int}), ({"c": 1}, {"c": int})):
+                obiwan.duckable(obj, template)
+        self.assertEqual(sorted(row["template"] for row in obiwan.stats().templates),
+                         ["(others)", "<class 'int'>", "<class 'str'>", "{'b': <class 'int'>}"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import json
+import obiwan
+import obiwan.proxies
+import unittest
+
+
+class Tests(unittest.TestCase):
+
+    template = {
+        obiwan.options: [obiwan.strict],
+        'name': str,
+        obiwan.optional('note'): str,
+        obiwan.noneable('owner'): {'id': int},
+        'users': {str: {'age': int, 'tags': [str]}},
+        'counts': [int],
+    }
+
+    def state(self):
+        return obiwan.validated({
+            'name': 'state',
+            'owner': None,
+            'users': {'bob': {'age': 1, 'tags': []}},
+            'counts': [1, 2, 3],
+        }, self.template)
+
+    def assertFails(self, path, func, *args):
+        with self.assertRaises(obiwan.ObiwanError) as raised:
+            func(*args)
+        self.assertEqual(raised.exception.path, path, str(raised.exception))
+        return raised.exception
+
+    def test_initial_check(self):
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.validated({'name': 1}, self.template)
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.validated(1, int)
+
+    def test_dict(self):
+        state = self.state()
+        state['note'] = 'hi'
+        state['owner'] = {'id': 1}
+        state['owner'] = None
+        del state['note']
+        e = self.assertFails(('name',), state.__setitem__, 'name', 1)
+        self.assertEqual(str(e), 'checking["name"] is <class \'int\'> but should be <class \'str\'>')
+        self.assertFails((), state.__setitem__, 'other', 1)  # strict
+        self.assertFails((), state.__delitem__, 'name')
+        self.assertFails((), state.pop, 'owner')
+        self.assertFails((), state.clear)
+        self.assertFails(('note',), state.update, {'name': 'ok', 'note': 2})
+        self.assertEqual(state.target['name'], 'state')  # nothing is changed if anything fails
+        state.update(name='renamed')
+        self.assertEqual(state['name'], 'renamed')
+        self.assertEqual(state.setdefault('note', 'x'), 'x')
+
+    def test_template_changed(self):
+        template = {'name': str}
+        state = obiwan.validated({'name': 'state'}, template)
+        template['size'] = int  # the keys changed, so the changes are checked against the new ones
+        state['size'] = 1
+        self.assertFails(('size',), state.__setitem__, 'size', 'x')
+        self.assertFails((), state.__delitem__, 'size')
+
+    def test_nested(self):
+        state = self.state()
+        state['users']['alice'] = {'age': 2, 'tags': ['a']}
+        state['users']['alice']['tags'].append('b')
+        self.assertEqual(state.target['users']['alice']['tags'], ['a', 'b'])
+        self.assertFails(('users', 'alice', 'tags', 2), state['users']['alice']['tags'].append, 1)
+        self.assertFails(('users', 1), state['users'].__setitem__, 1, {'age': 2, 'tags': []})
+        self.assertFails(('users', 'carol', 'age'), state['users'].__setitem__, 'carol', {'age': 'x', 'tags': []})
+        self.assertFails(('users', 'bob'), state['users']['bob'].__delitem__, 'age')
+        self.assertEqual(obiwan.validate(state.target, self.template), [])
+
+    def test_list(self):
+        counts = self.state()['counts']
+        counts.append(4)
+        counts.insert(0, 0)
+        counts.extend([5, 6])
+        counts += [7]
+        counts[0] = -1
+        counts[1:3] = [10, 20]
+        del counts[0]
+        self.assertEqual(counts, [10, 20, 3, 4, 5, 6, 7])
+        self.assertFails(('counts', 7), counts.append, 'x')
+        self.assertFails(('counts', 0), counts.insert, -100, 'x')
+        self.assertFails(('counts', 8), counts.extend, [8, 'x'])
+        self.assertFails(('counts', 4), counts.__setitem__, slice(2, 6, 2), [1, 'x'])
+        self.assertFails(('counts', 6), counts.__setitem__, -1, 'x')
+        self.assertEqual(counts, [10, 20, 3, 4, 5, 6, 7])
+        counts.sort(reverse=True)
+        self.assertEqual(counts.target[0], 20)
+        counts.reverse()
+        self.assertEqual(counts.target[0], 3)
+
+    def test_proxied_values(self):
+        state = self.state()
+        state['users']['alice'] = state['users']['bob']  # values read through a proxy are proxies
+        state['users'].update(carol=state['users']['bob'])
+        state['users']['bob']['tags'].extend(state['users']['bob']['tags'])
+        state['counts'][:] = state['counts']
+        self.assertIs(state.target['users']['alice'], state.target['users']['bob'])
+        self.assertEqual(json.loads(json.dumps(state.target)), state)
+        people = obiwan.validated({'people': [{'id': 1}]}, {'people': [{'id': int}]})
+        people['people'].append(people['people'][0])
+        people['people'].insert(0, people['people'][0])
+        people['people'][1] = people['people'][0]
+        self.assertEqual(people.target, {'people': [{'id': 1}] * 3})
+        self.assertNotIsInstance(people.target['people'][2], obiwan.proxies.ValidatedDict)
@@ -0,0 +1,64 @@
+import importlib.util
+import obiwan
+import unittest
+
+
+class Tests(unittest.TestCase):
+
+    template = {
+        obiwan.options: [obiwan.strict],
+        'id': int,
+        'ts': float,
+        obiwan.optional('tag'): str,
+        obiwan.noneable('owner'): {'id': int},
+        'score': obiwan.RangeCheck(0, 100),
+    }
+
+    def rows(self):
+        return [{'id': i, 'ts': i / 2, 'tag': 'x', 'owner': None if i % 2 else {'id': i}, 'score': i % 100}
+                for i in range(1000)]
+
+    def check(self, rows):
+        expected = obiwan.validate(rows, [self.template])
+        errors = obiwan.validate_records(rows, self.template)
+        self.assertEqual([(e.path, str(e)) for e in errors], [(e.path, str(e)) for e in expected])
+        return errors
+
+    def test_valid(self):
+        self.assertEqual(obiwan.validate_records(self.rows(), self.template), [])
+        self.assertEqual(obiwan.validate_records([], self.template), [])
+
+    def test_errors(self):
+        rows = self.rows()
+        rows[5]['ts'] = 'x'
+        del rows[3]['id']
+        del rows[4]['tag']
+        rows[9]['score'] = 200
+        rows[2]['tag'] = 5
+        rows[7]['owner'] = {'id': 'x'}
+        rows[8]['extra'] = 1
+        errors = self.check(rows)
+        self.assertEqual([e.path for e in errors], [(2, 'tag'), (3,), (5, 'ts'), (7, 'owner', 'id'), (8,), (9, 'score')])
+        self.assertEqual(len(obiwan.validate_records(rows, self.template, max_errors=2)), 2)
+
+    def test_order_within_rows(self):
+        # errors in a row come in the order validate() finds them, not the template's, so both keep the same ones
+        template = {obiwan.options: [obiwan.strict], obiwan.optional('tag'): str, obiwan.noneable('owner'): int,
+                    'id': int}
+        rows = [{'id': 1, 'owner': None}, {'tag': 1, 'owner': 'x', 'extra': 1}, {'tag': 2, 'id': 'x', 'owner': 1}]
+        for max_errors in range(1, 7):
+            expected = obiwan.validate(rows, [template], max_errors)
+            errors = obiwan.validate_records(rows, template, max_errors)
+            self.assertEqual([e.path for e in errors], [e.path for e in expected])
+
+    def test_fallback(self):
+        self.check([{'id': 1}, 2])
+        self.check({'id': 1})
+        self.assertEqual([e.path for e in obiwan.validate_records([{'a': 1}, {1: 1}], {str: int})], [(1, 1)])
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs numpy")
+    def test_numpy(self):
+        import numpy  # so numeric columns are checked by numpy
+        rows = self.rows()
+        rows[600]['score'] = -1
+        self.assertEqual([e.path for e in self.check(rows)], [(600, 'score')])
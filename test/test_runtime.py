@@ -0,0 +1,273 @@
+import asyncio
+import obiwan
+import sys
+import threading
+import types
+import unittest
+
+
+class Tests(unittest.TestCase):
+
+    def test_checked(self):
+        @obiwan.checked
+        def scale(point: (int, int), factor: int = 1, *rest: str, label: str = "", **extra: int) -> (int, int):
+            return (point[0] * factor, point[1] * factor)
+
+        self.assertEqual(scale((1, 2), 3), (3, 6))
+        scale((1, 2), 3, "a", "b", label="x", z=1)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^scale\(point\)\[1\] is"):
+            scale((1, "2"))
+        self.assertRaises(obiwan.ObiwanError, scale, (1, 2), factor=1.5)
+        self.assertRaises(obiwan.ObiwanError, scale, (1, 2), 1, 2)
+        self.assertRaises(obiwan.ObiwanError, scale, (1, 2), label=1)
+        self.assertRaises(obiwan.ObiwanError, scale, (1, 2), z="a")
+        self.assertEqual(scale.__name__, "scale")
+        self.assertIs(obiwan.checked(scale), scale)
+
+        @obiwan.checked
+        def bad() -> int:
+            return "a"
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^bad\(\)->"):
+            bad()
+
+
+    def test_unannotated_is_untouched(self):
+        def plain(x, y: "just documentation"):
+            return x
+        self.assertIs(obiwan.checked(plain), plain)
+
+
+    def test_methods(self):
+        class Shape:
+            def __init__(self, sides: int):
+                self.sides = sides
+
+            @obiwan.checked
+            def grow(self, by: int) -> int:
+                return self.sides + by
+
+            @staticmethod
+            @obiwan.checked
+            def make(sides: int) -> "Shape":
+                return Shape(sides)
+
+            @obiwan.checked
+            @classmethod
+            def square(cls, size: int) -> int:
+                return size * size
+
+        self.assertEqual(Shape(3).grow(1), 4)
+        self.assertRaises(obiwan.ObiwanError, Shape(3).grow, "1")
+        self.assertRaises(obiwan.ObiwanError, Shape.make, 1.0)
+        self.assertEqual(Shape.square(2), 4)
+        self.assertRaises(obiwan.ObiwanError, Shape.square, "2")
+
+
+    def test_instrument(self):
+        module = types.ModuleType("instrumented")
+        exec('''
+from obiwan import number
+
+def add(a: int, b: int) -> int:
+    return a + b
+
+def plain(a):
+    return a
+
+class Account:
+    def deposit(self, amount: number) -> number:
+        return amount
+
+    @staticmethod
+    def parse(text: str) -> int:
+        return int(text)
+
+    @classmethod
+    def open(cls, owner: str):
+        return cls()
+
+    @property
+    def balance(self) -> int:
+        return "lots"
+''', vars(module))
+        plain = module.plain
+        self.assertIs(obiwan.instrument(module), module)
+        self.assertIs(module.plain, plain)
+        self.assertEqual(module.add(1, 2), 3)
+        self.assertRaises(obiwan.ObiwanError, module.add, 1, "2")
+        account = module.Account()
+        self.assertEqual(account.deposit(1.5), 1.5)
+        self.assertRaises(obiwan.ObiwanError, account.deposit, "1")
+        self.assertEqual(module.Account.parse("3"), 3)
+        self.assertRaises(obiwan.ObiwanError, module.Account.parse, 3)
+        self.assertIsInstance(module.Account.open("me"), module.Account)
+        self.assertRaises(obiwan.ObiwanError, module.Account.open, 1)
+        with self.assertRaises(obiwan.ObiwanError):
+            account.balance
+        # instrumenting twice doesn't stack wrappers
+        add = module.add
+        obiwan.instrument(module)
+        self.assertIs(module.add, add)
+
+
+    @unittest.skipUnless(hasattr(sys, "monitoring"), "sys.monitoring needs Python 3.12")
+    def test_monitoring(self):
+        def add(a: int, b: int) -> int:
+            return a + b
+
+        def wrong() -> int:
+            return "a"
+
+        def plain(a):
+            return a
+
+        results = []
+        def in_thread():
+            try:
+                add(1, "2")
+            except obiwan.ObiwanError as e:
+                results.append(e)
+
+        was_enabled = obiwan._enabled
+        obiwan.install_obiwan_runtime_check(backend="monitoring")
+        try:
+            self.assertEqual(add(1, 2), 3)
+            self.assertEqual(plain("x"), "x")
+            self.assertRaises(obiwan.ObiwanError, add, 1, 2.0)
+            self.assertRaises(obiwan.ObiwanError, wrong)
+            thread = threading.Thread(target=in_thread)
+            thread.start()
+            thread.join()
+            self.assertEqual(len(results), 1)  # every thread is checked without installing in it
+        finally:
+            obiwan._uninstall_monitoring()
+            obiwan._enabled = was_enabled
+
+
+    def test_checked_sampling(self):
+        @obiwan.checked(sampling=obiwan.sampling(every=2))
+        def double(x: int) -> int:
+            return x * 2
+
+        self.assertRaises(obiwan.ObiwanError, double, 1.5)
+        self.assertEqual(double(1.5), 3.0)
+        self.assertEqual(double.sampling.skipped, 1)
+        obiwan.sample(double, None)
+        self.assertRaises(obiwan.ObiwanError, double, 1.5)
+        self.assertRaises(obiwan.ObiwanError, double, 1.5)
+
+
+    def test_instrument_sampling(self):
+        module = types.ModuleType("sampled")
+        exec('''
+def f(a: int) -> int:
+    return a
+
+def g(a: int) -> int:
+    return a
+''', vars(module))
+        obiwan.instrument(module, sampling=obiwan.sampling(first=5, every=1000))
+        self.assertIsNot(module.f.sampling, module.g.sampling)
+        for i in range(10):
+            module.f(i)
+            module.g(i)
+        self.assertEqual((module.f.sampling.performed, module.f.sampling.skipped), (6, 4))
+        self.assertEqual((module.g.sampling.performed, module.g.sampling.skipped), (6, 4))
+
+
+    @unittest.skipUnless(hasattr(sys, "monitoring"), "sys.monitoring needs Python 3.12")
+    def test_monitoring_sampling(self):
+        def wrong(a: int) -> int:
+            return "a"
+
+        policy = obiwan.sample(wrong, obiwan.sampling(every=2))
+        was_enabled = obiwan._enabled
+        obiwan.install_obiwan_runtime_check(backend="monitoring")
+        try:
+            failed = 0
+            for i in range(6):
+                try:
+                    wrong(i)
+                except obiwan.ObiwanError:
+                    failed += 1
+        finally:
+            obiwan._uninstall_monitoring()
+            obiwan._enabled = was_enabled
+        # the arguments and return of a call are checked together, or not at all
+        self.assertEqual((policy.performed, policy.skipped), (3, 3))
+        self.assertEqual(failed, 3)
+
+
+    def test_generators_and_coroutines(self):
+        @obiwan.checked
+        async def fetch(key: str) -> int:
+            return len(key) if key != "bad" else "bad"
+
+        self.assertEqual(asyncio.run(fetch("abc")), 3)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^fetch\(\)->"):
+            asyncio.run(fetch("bad"))
+        self.assertRaises(obiwan.ObiwanError, asyncio.run, fetch(1))  # arguments are checked when awaited
+        self.assertTrue(asyncio.iscoroutinefunction(fetch))
+
+        @obiwan.checked
+        def count(start: int) -> [int]:
+            received = yield start
+            while received is not None:
+                received = yield received
+            return "done"
+
+        gen = count(1)
+        self.assertIsInstance(gen, types.GeneratorType)
+        self.assertEqual(next(gen), 1)
+        self.assertEqual(gen.send(2), 2)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^count\(\)->\[2\] is"):
+            gen.send("3")
+        gen = count(1)
+        next(gen)
+        with self.assertRaises(StopIteration) as stop:
+            gen.send(None)
+        self.assertEqual(stop.exception.value, "done")  # only the items are checked
+
+        @obiwan.checked
+        async def stream(n: int) -> [int]:
+            for i in range(n):
+                yield i
+            yield "end"
+
+        async def collect():
+            return [i async for i in stream(2)]
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^stream\(\)->\[2\] is"):
+            asyncio.run(collect())
+
+
+
+class SettraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.previous, self.was_enabled = sys.gettrace(), obiwan._enabled
+        obiwan.install_obiwan_runtime_check(backend="settrace")
+
+    def tearDown(self):
+        sys.settrace(self.previous)  # and leave any monitoring installed by other tests alone
+        obiwan._enabled = self.was_enabled
+
+    def test_settrace_generators_and_coroutines(self):
+        def count(start: int) -> [int]:
+            yield start
+            yield start + 1
+            yield "x"
+
+        async def fetch(key: str) -> int:
+            await asyncio.sleep(0)
+            return key
+
+        gen = count(1)
+        self.assertEqual(next(gen), 1)
+        self.assertEqual(next(gen), 2)  # resuming doesn't check the arguments again
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^count\(\)->\[\*\] is"):
+            next(gen)
+        sys.settrace(obiwan._runtime_checker)  # python stops tracing when the tracer raises
+        self.assertRaises(obiwan.ObiwanError, lambda: list(count("1")))
+        sys.settrace(obiwan._runtime_checker)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^fetch\(\)->"):
+            asyncio.run(fetch("a"))
@@ -0,0 +1,198 @@
+import asyncio
+import concurrent.futures
+import io
+import json
+import obiwan
+import obiwan.stream
+import unittest
+
+
+def chunked(text, size):
+    data = text.encode("utf-8")
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class Tests(unittest.TestCase):
+
+    template = {
+        'people': [{
+            'id': int,
+            obiwan.noneable('name'): str,
+            obiwan.optional('tags'): [str],
+            'pos': (int, int, ...),
+        }],
+        str: object,
+    }
+
+    def test_parse(self):
+        doc = {
+            'people': [{'id': i, 'name': None if i % 2 else "né\"\\", 'pos': [1, 2, i], 'tags': ['a']}
+                for i in range(100)],
+            'extra': [1.5e3, -2, True, False, None, "ሴ\n", {}, []],
+        }
+        text = json.dumps(doc)
+        for size in (1, 3, 7, 1 << 16):
+            self.assertEqual(obiwan.json.load_stream(chunked(text, size), self.template), doc)
+        self.assertEqual(obiwan.json.load_stream(io.StringIO(text), self.template), doc)
+        self.assertEqual(obiwan.json.load_stream(io.BytesIO(text.encode()), self.template, chunk_size=5), doc)
+        self.assertEqual(obiwan.json.load_stream([b" [NaN, -Infinity, 0.5e-3] "])[1:], [float("-inf"), 0.5e-3])
+
+    def test_template_changed(self):
+        template = {obiwan.options: [obiwan.strict], 'id': int}
+        self.assertEqual(obiwan.json.load_stream([b'{"id": 1}'], template), {'id': 1})
+        template['name'] = str  # the keys changed, so the document is read against the new ones
+        self.assertRaisesRegex(obiwan.ObiwanError, 'should have child called name',
+                               obiwan.json.load_stream, [b'{"id": 1}'], template)
+        self.assertEqual(obiwan.json.load_stream([b'{"id": 1, "name": "a"}'], template), {'id': 1, 'name': 'a'})
+        self.assertRaisesRegex(obiwan.ObiwanError, 'should have child called name',
+                               obiwan.cbor.loads, bytes.fromhex("a1626964 01"), template)  # {"id": 1}
+
+    def test_malformed(self):
+        for text in ['[1,', '{"a" 1}', '[1] x', '"abc', 'tru', '[1,]', '{"a":1,}', '{1: 2}', '']:
+            self.assertRaises(json.JSONDecodeError, obiwan.json.load_stream, chunked(text, 2))
+
+    def test_deeply_nested(self):
+        deep = b'[' * 100000 + b']' * 100000
+        with self.assertRaisesRegex(obiwan.ObiwanError, "nested too deeply"):
+            obiwan.json.load_stream([deep])
+        with self.assertRaisesRegex(obiwan.ObiwanError, "nested too deeply"):
+            list(obiwan.json.iter_items([deep]))
+        with self.assertRaisesRegex(obiwan.ObiwanError, "nested too deeply"):
+            obiwan.json.load_stream([b'{"a": ' * 100000], {'a': object})
+
+    def test_errors(self):
+        text = '{"people": [{"id": 1, "name": null, "pos": [1, 2]}, {"id": "2", "name": "b", "pos": [1, 2]}]}'
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.json.load_stream(chunked(text, 4), self.template)
+        self.assertEqual(cm.exception.path, ('people', 1, 'id'))
+        self.assertEqual(cm.exception.offset, text.index('"2"'))
+        self.assertIn('["people"][1]["id"] is', str(cm.exception))
+        for text, path in [
+                ('{"people": [{"id": 1, "pos": [1, 2]}]}', ('people', 0)),  # missing noneable
+                ('{"people": [{"id": 1, "name": "a", "pos": [1]}]}', ('people', 0, 'pos', 1)),
+                ('{"people": {}}', ('people',)),
+                ('{"people": [{"id": 1, "name": "a", "pos": [1, 2], "tags": [1]}]}', ('people', 0, 'tags', 0))]:
+            with self.assertRaises(obiwan.ObiwanError, msg=text) as cm:
+                obiwan.json.load_stream(chunked(text, 3), self.template)
+            self.assertEqual(cm.exception.path, path)
+            # agrees with checking the parsed document
+            self.assertRaises(obiwan.ObiwanError, obiwan.json.loads, text, template=self.template)
+
+    def test_fails_fast(self):
+        def source():
+            yield b'[{"id": 1}, {"id": "x"}, '
+            raise AssertionError("read past the first violation")
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.json.load_stream(source(), [{"id": int}])
+        self.assertEqual(cm.exception.path, (1, 'id'))
+
+        strict = {obiwan.options: [obiwan.strict], 'id': int}
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.json.load_stream([b'{"id": 1, "bad": [1, 2, 3'], strict)
+        self.assertEqual(cm.exception.offset, 10)
+
+    def test_iter_items(self):
+        items = obiwan.json.iter_items(chunked('[{"id": 1}, {"id": 2}, {"id": "3"}]', 2), [{"id": int}])
+        self.assertEqual(next(items), {"id": 1})
+        self.assertEqual(next(items), {"id": 2})
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            next(items)
+        self.assertEqual(cm.exception.path, (2, 'id'))
+        self.assertEqual(list(obiwan.json.iter_items([b"[]"])), [])
+        self.assertRaises(obiwan.ObiwanError, list, obiwan.json.iter_items([b'{}'], [int]))
+
+    def test_limits(self):
+        template = [[int]]
+        obiwan.limit(template, obiwan.limits(depth=2, nodes=8, length=3))
+        self.assertEqual(obiwan.json.load_stream([b'[[1, 2], [3]]'], template), [[1, 2], [3]])
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^json validation \[0\] has more than the limit of 3 items") as e:
+            obiwan.json.load_stream([b'[[1, 2, 3, 4]]'], template)
+        self.assertEqual(e.exception.offset, 11)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^json validation \[0\] has more than the limit of 3 items"):
+            asyncio.run(obiwan.json.aload(self.async_chunks(b'[[1, 2, 3, 4]]'), template))
+
+        def endless():  # fails as soon as a limit is exceeded, without reading the rest
+            yield b'['
+            while True:
+                yield b'[[[1]]], '
+        for limits, message in ((obiwan.limits(length=3), r"^json validation +has more than the limit of 3 items"),
+                                (obiwan.limits(nodes=10), r"^json validation \[2\] has more than the limit of 10"),
+                                (obiwan.limits(depth=3), r"^json validation \[0\]\[0\]\[0\] is nested more than")):
+            template = [list]
+            obiwan.limit(template, limits)
+            self.assertRaisesRegex(obiwan.ObiwanError, message, obiwan.json.load_stream, endless(), template)
+        template = {"abc": [str]}
+        obiwan.limit(template, obiwan.limits(string=3))
+        self.assertEqual(obiwan.json.load_stream([b'{"abc": ["def"]}'], template), {"abc": ["def"]})
+        self.assertRaisesRegex(obiwan.ObiwanError, r'^json validation \["abc"\]\[1\] is 4 long',
+                               obiwan.json.load_stream, [b'{"abc": ["def", "ghij"]}'], template)
+        self.assertRaisesRegex(obiwan.ObiwanError, r'^key json validation \[abcd\] is 4 long',
+                               obiwan.json.load_stream, [b'{"abcd": []}'], template)
+        template = [[int]]
+        obiwan.limit(template, obiwan.limits(depth=2, nodes=8, length=3))
+        items = obiwan.json.iter_items([b'[[1, 2], [3, 4], [5, 6], [7]]'], template)
+        self.assertEqual(next(items), [1, 2])
+        self.assertEqual(next(items), [3, 4])
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^json validation \[2\] has more than the limit of 8 values"):
+            next(items)
+        items = obiwan.json.iter_items([b'[[], [], [], []]'], template)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^json validation +has more than the limit of 3 items"):
+            list(items)
+        self.assertEqual(list(obiwan.json.iter_items([b'[[1, 2], [3]]'], template)), [[1, 2], [3]])
+
+    @staticmethod
+    async def async_chunks(data):
+        yield data
+
+    def test_aload(self):
+        doc = {'people': [{'id': i, 'name': None, 'pos': [i, i]} for i in range(5000)]}
+        data = json.dumps(doc).encode()
+        read = []
+
+        async def source(data, size=1000):
+            for i in range(0, len(data), size):
+                await asyncio.sleep(0)
+                read.append(i)
+                yield data[i:i + size]
+
+        async def ticking(coroutine):
+            "the result of coroutine, and how often another task ran meanwhile"
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0)
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return await coroutine, ticks
+            finally:
+                ticker.cancel()
+
+        result, ticks = asyncio.run(ticking(obiwan.json.aload(source(data), self.template, chunk_size=4096)))
+        self.assertEqual(result, doc)
+        self.assertGreater(ticks, len(read))
+        self.assertEqual(asyncio.run(obiwan.json.aload(source(b'[1, 2]'), [int])), [1, 2])
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            bad = data.replace(b'"id": 10,', b'"id": "x",')
+            del read[:]
+            with self.assertRaises(obiwan.ObiwanError) as cm:
+                asyncio.run(obiwan.json.aload(source(bad), self.template, executor, chunk_size=4096))
+            self.assertEqual(cm.exception.path, ('people', 10, 'id'))
+            self.assertEqual(cm.exception.offset, bad.index(b'"x"'))
+            self.assertLess(len(read), len(bad) // 1000)  # it stopped reading
+
+        class Stream:  # like asyncio.StreamReader
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+            async def read(self, size):
+                return self.data.read(size)
+        self.assertEqual(asyncio.run(obiwan.json.aload(Stream(data), self.template, chunk_size=100)), doc)
+        with self.assertRaises(json.JSONDecodeError):
+            asyncio.run(obiwan.json.aload(Stream(data[:-1]), self.template, chunk_size=100))
+
+        deep = b'[' * 100000 + b']' * 100000
+        for inline_bytes in (len(deep), 1000):  # parsed on the event loop, and by a thread
+            with self.assertRaisesRegex(obiwan.ObiwanError, "^json validation +is nested too deeply"):
+                asyncio.run(obiwan.stream.aload(source(deep), [object], inline_bytes=inline_bytes))
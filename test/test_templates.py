@@ -1,5 +1,14 @@
+import array
+import dataclasses
+import gc
+import importlib.util
+import io
+import os
 import obiwan
+import subprocess
+import sys
 import unittest
+import unittest.mock
 
 class Tests(unittest.TestCase):
 
@@ -122,9 +131,463 @@ class Tests(unittest.TestCase):
 
 
     def test_disabling(self):
-        self.assertTrue(obiwan._enabled)
-        obiwan._enabled = False
-        obiwan.check({}, {"k":str}) # would fail if obiwan were enabled
+        was_enabled = obiwan._enabled
+        try:
+            obiwan._enabled = False
+            obiwan.check({}, {"k":str}) # would fail if obiwan were enabled
+            obiwan._enabled = True
+            self.assertRaises(obiwan.ObiwanError, obiwan.check,
+                {}, {"k":str})
+            # and configure() disables the json, msgpack and cbor wrappers too
+            self.assertFalse(obiwan.configure(enabled=False))
+            try:
+                self.assertEqual(list(obiwan.json.iter_items([b'[{"k": 1}]'], [{"k": str}])), [{"k": 1}])
+                self.assertEqual(obiwan.json.load_stream([b'{"k": 1}'], {"k": str}), {"k": 1})
+                self.assertEqual(obiwan.msgpack.loads(b"\x81\xa1k\x01", {"k": str}), {"k": 1})
+                self.assertEqual(obiwan.msgpack.load(io.BytesIO(b"\x81\xa1k\x01"), {"k": str}), {"k": 1})
+                self.assertEqual(obiwan.cbor.loads(b"\xa1\x61k\x01", {"k": str}), {"k": 1})
+                try:
+                    import msgpack
+                except ImportError:
+                    pass
+                else:
+                    self.assertEqual(obiwan.msgpack.dumps({"k": 1}, {"k": str}), b"\x81\xa1k\x01")
+                    f = io.BytesIO()
+                    obiwan.msgpack.dump({"k": 1}, f, {"k": str})
+                    self.assertEqual(f.getvalue(), b"\x81\xa1k\x01")
+            finally:
+                self.assertTrue(obiwan.configure(enabled=True))
+            self.assertRaises(obiwan.ObiwanError, list, obiwan.json.iter_items([b'[{"k": 1}]'], [{"k": str}]))
+            self.assertRaises(obiwan.ObiwanError, obiwan.msgpack.loads, b"\x81\xa1k\x01", {"k": str})
+        finally:
+            obiwan._enabled = was_enabled
+
+
+    def test_configure(self):
+        def f(a: int) -> int:
+            return a
+        wrapped = obiwan.checked(f)
+        was_enabled = obiwan._enabled
+        obiwan._enabled = True  # as install_obiwan_runtime_check() does; check() does nothing until then
+        try:
+            self.assertTrue(obiwan.configure())
+            self.assertFalse(obiwan.configure(enabled=False))
+            try:
+                obiwan.check({}, {"k": str})
+                self.assertIs(obiwan.checked(f), f)
+                self.assertEqual(wrapped("x"), "x")
+                self.assertEqual(obiwan.json.loads('{"k": 1}', template={"k": str}), {"k": 1})
+                self.assertEqual(obiwan.json.dumps({"k": 1}, template={"k": str}), '{"k": 1}')
+                self.assertRaises(obiwan.ObiwanError, obiwan.compile({"k": str}).check, {})
+            finally:
+                self.assertTrue(obiwan.configure(enabled=True))
+            self.assertRaises(obiwan.ObiwanError, obiwan.check, {}, {"k": str})
+            self.assertRaises(obiwan.ObiwanError, wrapped, "x")
+            self.assertRaises(obiwan.ObiwanError, obiwan.json.loads, '{"k": 1}', template={"k": str})
+        finally:
+            obiwan._enabled = was_enabled
+
+
+    def test_import(self):
+        # importing obiwan is fast because it leaves the modules only some features need until they're used
+        code = "import sys, obiwan; print(' '.join(sorted(sys.modules)))"
+        modules = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        for name in ("inspect", "json", "decimal", "weakref", "functools", "collections", "threading", "random"):
+            self.assertNotIn(name, modules.split())
+        code = "import obiwan; from obiwan import check; print(check({}, {'k': str}), obiwan.configure())"
+        env = dict(os.environ, OBIWAN_DISABLED="1")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env)
+        self.assertEqual(output.stdout.split(), ["None", "False"])
+
+
+    def test_compile(self):
+        template = {'id': int, obiwan.optional('tags'): [str], 'pos': (int, int, ...)}
+        compiled = obiwan.compile(template)
+        self.assertIs(compiled, obiwan.compile(template))
+        self.assertIs(compiled, obiwan.compile(compiled))
+        compiled.check({'id': 1, 'pos': [1, 2, 3]})
+        compiled({'id': 1, 'tags': ['a'], 'pos': (1, 2)})
+        self.assertTrue(compiled.is_valid({'id': 1, 'pos': (1, 2)}))
+        self.assertFalse(compiled.is_valid({'id': 1, 'tags': [1], 'pos': (1, 2)}))
+        self.assertFalse(compiled.is_valid({'id': 1, 'pos': (1,)}))
+        with self.assertRaisesRegex(obiwan.ObiwanError, r'^checking\["pos"\]\[1\] is'):
+            compiled.check({'id': 1, 'pos': (1, 'a')})
+        # compiled templates nest inside other templates
+        obiwan.duckable([{'id': 1, 'pos': (1, 2)}], [compiled])
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, [{'id': 1}], [compiled])
+
+
+    def test_compile_cache(self):
+        template = {'name': str}
+        policy = obiwan.limit(template, obiwan.limits(string=3))
+        compiled = obiwan.compile(template)
+        cached = len(obiwan._compiled_cache)
+        for i in range(obiwan._compiled_cache_size + 100):
+            obiwan.duckable({'name': 'a'}, {'name': str})  # throwaway templates don't push others out
+            obiwan.duck(obiwan.duck(a=int), b=int)
+            obiwan.subtype(template)
+        self.assertEqual(len(obiwan._compiled_cache), cached)
+        for i in range(obiwan._compiled_cache_size + 100):
+            reused = [i]
+            obiwan.compile(reused)
+            obiwan.compile(reused)
+        self.assertIs(obiwan.compile(template), compiled)
+        self.assertIs(compiled.limits, policy)  # templates with policies are never evicted
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, {'name': 'abcd'}, template)
+
+
+    def test_compile_bad_templates(self):
+        bad = obiwan.compile([int, str])
+        self.assertRaises(obiwan.ObiwanError, bad.check, [1])
+        # a bad alternative in a multiple-choice is just a choice that never matches
+        obiwan.duckable(1, {int, obiwan.duck})
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, "a", {int, obiwan.duck})
+        with self.assertRaisesRegex(obiwan.ObiwanError, "internal error"):
+            obiwan.duckable({'a': 1}, {'a': lambda x: x.missing})
+
+
+    def test_error_path(self):
+        template = {'person': [{'id': int, 'tags': {str: int}, 'pos': (int, int)}]}
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable({'person': [{'id': 1, 'tags': {}, 'pos': (1, 2)},
+                                        {'id': 2, 'tags': {'a': 'b'}, 'pos': (1, 2)}]}, template)
+        self.assertEqual(cm.exception.path, ('person', 1, 'tags', 'a'))
+        self.assertEqual(cm.exception.ctx, 'checking')
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable({'person': [{'id': 1, 'tags': {}, 'pos': (1, 'x')}]}, template, 'body')
+        self.assertEqual(cm.exception.path, ('person', 0, 'pos', 1))
+        self.assertEqual(str(cm.exception),
+            "body[\"person\"][0][\"pos\"][1] is <class 'str'> but should be <class 'int'>")
+        # custom checks format their own message against the lazily rendered context
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable([{'name': 'abcd'}], [{'name': obiwan.StringCheck(3)}])
+        self.assertEqual(cm.exception.path, (0, 'name'))
+        self.assertEqual(str(cm.exception), "checking[0][\"name\"] is 4 long, but must be less than 3")
+
+
+    def test_sampling(self):
+        policy = obiwan.sampling(first=2, every=3)
+        self.assertEqual([policy() for i in range(8)], [True, True, True, False, False, True, False, False])
+        self.assertEqual((policy.performed, policy.skipped), (4, 4))
+        policy = obiwan.sampling(per_second=2)
+        self.assertEqual([policy() for i in range(4)], [True, True, False, False])
+        policy = obiwan.sampling(rate=0)
+        self.assertFalse(policy())
+        self.assertEqual(policy.coverage, 0)
+
+        template = {"k": str}
+        was_enabled = obiwan._enabled
         obiwan._enabled = True
-        self.assertRaises(obiwan.ObiwanError, obiwan.check,
-            {}, {"k":str})
+        try:
+            policy = obiwan.sample(template, obiwan.sampling(every=2))
+            self.assertRaises(obiwan.ObiwanError, obiwan.check, {}, template)
+            obiwan.check({}, template)  # skipped
+            self.assertRaises(obiwan.ObiwanError, obiwan.json.loads, "{}", template=template)
+            obiwan.json.loads("{}", template=template)  # skipped
+            self.assertEqual((policy.performed, policy.skipped), (2, 2))
+            # duckable always checks
+            self.assertRaises(obiwan.ObiwanError, obiwan.duckable, {}, template)
+            obiwan.sample(template, None)
+            self.assertRaises(obiwan.ObiwanError, obiwan.check, {}, template)
+            self.assertRaises(obiwan.ObiwanError, obiwan.check, {}, template)
+        finally:
+            obiwan._enabled = was_enabled
+
+
+    def test_bulk_lists(self):
+        def failing_path(obj, template):
+            with self.assertRaises(obiwan.ObiwanError) as cm:
+                obiwan.duckable(obj, template)
+            return cm.exception.path
+
+        obiwan.duckable([1, 2, True], [int])
+        obiwan.duckable([1, 2.5, None], [{int, float, None}])
+        obiwan.duckable([1, 2.5], [obiwan.number])
+        self.assertEqual(failing_path([1, 2, 3.0, "4"], [int]), (2,))
+        self.assertEqual(failing_path([1, 2, None], [obiwan.number]), (2,))
+        self.assertEqual(failing_path("abc", [int]), (0,))
+        obiwan.duckable(array.array('d', [1.5, 2]), [float])
+        obiwan.duckable(array.array('i'), [str])
+        obiwan.duckable(memoryview(b"abc"), [int])
+        self.assertEqual(failing_path(array.array('i', [1]), [float]), (0,))
+
+        obiwan.duckable([(1, 2), [3, 4]], [(int, int)])
+        obiwan.duckable([(1, 2, "x"), (3, 4)], [(int, int, ...)])
+        obiwan.duckable([(1, "a"), (3, None)], [(int, any)])
+        self.assertEqual(failing_path([(1, 2), (3, 4.0)], [(int, int)]), (1, 1))
+        self.assertEqual(failing_path([(1, 2), (3, 4, 5)], [(int, int)]), (1,))
+        self.assertEqual(failing_path([(1, 2), 3], [(int, int)]), (1,))
+        # the bulk check finds the first failure itself, so the items before it are checked only once
+        first_failure = obiwan._bulk_checker((int, int))
+        self.assertEqual(first_failure([(1, 2)] * 5 + [(1, 2, 3), (1, "x")]), 5)
+        self.assertEqual(first_failure([(1, 2)] * 5 + [(1, "x"), 3]), 5)
+        self.assertEqual(first_failure([(1, 2)] * 5 + [3, (1, "x")]), 5)
+        self.assertIsNone(first_failure([(1, 2)] * 5))
+        self.assertEqual(obiwan._bulk_checker((int, ...))([(1,), (2, "x"), ()]), 2)
+
+
+    def test_range_check(self):
+        percent = obiwan.RangeCheck(0, 100)
+        obiwan.duckable(50, percent)
+        obiwan.duckable([0, 12.5, 100], [percent])
+        obiwan.duckable(array.array('b', [0, 100]), [percent])
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, 101, percent)
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, "1", percent)
+        for obj, path in [([1, 2, 101, -1], (2,)), ([1, float("nan")], (1,)), ([1, "2"], (1,))]:
+            with self.assertRaises(obiwan.ObiwanError) as cm:
+                obiwan.duckable(obj, [percent])
+            self.assertEqual(cm.exception.path, path)
+            self.assertEqual(percent.check_many(obj), path[0])
+        self.assertIsNone(percent.check_many([0, 100]))
+        self.assertIsNone(obiwan.RangeCheck().check_many([1, float("nan")]))  # which check() accepts too
+
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "needs numpy")
+    def test_numpy(self):
+        import numpy
+        obiwan.duckable(numpy.arange(10), [int])
+        obiwan.duckable(numpy.arange(10, dtype=float), [obiwan.number])
+        obiwan.duckable(numpy.zeros((5, 2), dtype=int), [(int, int)])
+        obiwan.duckable(numpy.array([1, "a"], dtype=object), [{int, str}])
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, numpy.arange(10, dtype=float), [int])
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, numpy.zeros((5, 3), dtype=int), [(int, int)])
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable(numpy.array([1.0, 50, 150, numpy.nan]), [obiwan.RangeCheck(0, 100)])
+        self.assertEqual(cm.exception.path, (2,))
+
+        converted = []
+        class Counted(numpy.ndarray):  # records how much of it is converted to a list
+            def tolist(self):
+                converted.append(len(self))
+                return super().tolist()
+        obiwan.duckable(numpy.arange(1000).view(Counted), [int])
+        obiwan.duckable(numpy.arange(1000.0).view(Counted), [obiwan.RangeCheck(0, 1000)])
+        self.assertEqual(converted, [])  # passed in bulk
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable(numpy.arange(1000.0).view(Counted), [obiwan.RangeCheck(0, 900)])
+        self.assertEqual(cm.exception.path, (901,))
+        self.assertEqual(converted, [99])  # only from the first failure
+
+
+    def test_memoize(self):
+        template = ((str, int), ...)
+        memo = obiwan.memoize(template, maxsize=2)
+        config = (("a", 1), ("b", 2))
+        obiwan.duckable(config, template)
+        obiwan.duckable(config, template)
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        obiwan.duckable((("a", 1),), template)  # equal values are different objects
+        self.assertEqual((memo.hits, memo.misses), (1, 2))
+        with_list = (("a", [1]),)
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, with_list, template)
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, with_list, template)
+        obiwan.duckable([["a", 1]], template)  # mutable; never cached
+        obiwan.duckable((("c", 3),), template)
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.evictions, 1)
+        self.assertEqual(memo.uncacheable, 1)
+        # scalars are keyed by type, so 1 and True don't collide
+        choice = {int, str}
+        memo = obiwan.memoize(choice)
+        obiwan.duckable(1, choice)
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, 1.0, choice)
+        obiwan.duckable(1, choice)
+        self.assertEqual(memo.hits, 1)
+
+
+    def test_limits(self):
+        template = {"name": str, "items": [any]}
+        policy = obiwan.limit(template, obiwan.limits(depth=4, nodes=100, length=10, string=8))
+        obiwan.duckable({"name": "ok", "items": [[1, 2], {"a": [3]}]}, template)
+        def fails(obj, path, text):
+            with self.assertRaises(obiwan.ObiwanError) as cm:
+                obiwan.duckable(obj, template)
+            self.assertEqual(cm.exception.path, path)
+            self.assertIn(text, str(cm.exception))
+        fails({"name": "too long a name", "items": []}, ("name",), "is 15 long")
+        fails({"name": "", "items": list(range(11))}, ("items",), "has 11 items")
+        fails({"name": "", "items": [[1, {"a": [2]}]]}, ("items", 0, 1, "a"), "nested more than the limit of 4")
+        fails({"name": "", "items": [list(range(10))] * 10}, ("items", 8), "values in all")
+        fails({"name": "", "items": [{"a key too long": 1}]}, ("items", 0, "a key too long"), "is 14 long")
+        hostile = []
+        for _ in range(100000):
+            hostile = [hostile]
+        fails({"name": "", "items": hostile}, ("items", 0, 0, 0), "nested more than")
+        obiwan.limit(template, None)
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, {"name": "", "items": [[1]]}, lambda obj: obj[0][0])
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.json.loads("[" * 100000 + "]" * 100000, template=[any])
+        self.assertIn("nested too deeply", str(cm.exception))
+
+    def test_spotcheck(self):
+        template = obiwan.spotcheck([int], first=2, last=2, sample=3, seed=1)
+        items = list(range(1000))
+        obiwan.duckable(items, template)
+        sampled = template.indexes(len(items))
+        self.assertEqual(len(sampled), 7)
+        self.assertEqual(sampled[:2] + sampled[-2:], [0, 1, 998, 999])
+        self.assertEqual(template.indexes(len(items)), sampled)  # the same every time with a seed
+        items[500] = "x"  # probably not sampled
+        items[999] = "x"
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable(items, template)
+        self.assertEqual(cm.exception.path, (999,))
+        self.assertEqual(cm.exception.sampled, sampled)
+        items[sampled[2]] = "x"
+        errors = obiwan.validate({"items": items}, {"items": template})
+        self.assertEqual([(e.path, e.sampled) for e in errors],
+                         [(("items", sampled[2]), sampled), (("items", 999), sampled)])
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, {"a": 1}, template)
+        obiwan.duckable([1, 2, 3], template)
+        self.assertIsNone(template.indexes(3))  # small enough to check everything
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable([1, "x"], template)
+        self.assertIsNone(cm.exception.sampled)
+        self.assertEqual(obiwan.spotcheck([int], sample=3, seed=5).indexes(1000),
+                         obiwan.spotcheck([int], sample=3, seed=5).indexes(1000))
+        users = {"u%d" % i: {"age": i} for i in range(1000)}
+        users["u999"] = {"age": "x"}
+        with self.assertRaises(obiwan.ObiwanError) as cm:
+            obiwan.duckable(users, obiwan.spotcheck({str: {"age": int}}, sample=10))
+        self.assertEqual(cm.exception.path, ("u999", "age"))
+        tags = {str(i) for i in range(1000)}
+        obiwan.duckable(tags, obiwan.spotcheck({str}))
+        self.assertRaises(obiwan.ObiwanError, obiwan.duckable, [], obiwan.spotcheck({"a": int}))
+
+    def test_memoize_frozen_dataclass(self):
+        @dataclasses.dataclass(frozen=True)
+        class Point:
+            x: int
+            y: int
+        template = obiwan.duck(x=int, y=int)
+        memo = obiwan.memoize(template)
+        point = Point(1, 2)
+        obiwan.duckable(point, template)
+        obiwan.duckable(point, template)
+        self.assertEqual(memo.hits, 1)
+        del point
+        gc.collect()
+        self.assertEqual(len(memo), 0)  # weakly referenced
+
+    def test_validate(self):
+        template = {"name": str, "items": [{"id": int, obiwan.optional("tags"): [str]}],
+                    "pair": {int, (str, int)}, "point": obiwan.duck(x=int, y=int)}
+
+        class Point:
+            x = "a"
+
+        obj = {"name": 1, "items": [{"id": "x"}, {"id": 2, "tags": [1, 2]}, 5], "pair": ("a", "b"), "point": Point()}
+        errors = obiwan.validate(obj, template)
+        self.assertEqual([e.path for e in errors], [("name",), ("items", 0, "id"), ("items", 1, "tags", 0),
+            ("items", 1, "tags", 1), ("items", 2), ("pair", 1), ("point", "x"), ("point",)])
+        self.assertEqual(str(errors[-1]), 'checking["point"] does not have a y')
+        self.assertEqual(len(obiwan.validate(obj, template, max_errors=3)), 3)
+        self.assertEqual(obiwan.validate({"name": "a", "items": [], "pair": 1, "point": Point()}, template,
+            max_errors=1)[0].path, ("point", "x"))
+        [error] = obiwan.validate({"pair": 1.5}, {"pair": {int, (str, int)}})
+        self.assertEqual(error.path, ("pair",))
+        self.assertIn("but should be one of", error.message)
+        self.assertEqual([e.path for e in obiwan.validate([1, "a", 2, "b"], [int])], [(1,), (3,)])
+        self.assertEqual(obiwan.validate([1, 2], [int]), [])
+        with self.assertRaises(obiwan.ObiwanError):  # duckable still stops at the first
+            obiwan.duckable(obj, template)
+        with self.assertRaises(ValueError):
+            obiwan.validate(obj, template, max_errors=0)
+
+    def test_union(self):
+        template = obiwan.union({"type": "login", "user": str}, {"type": "logout", "user": str, "reason": str},
+                                {"type": str, "other": int}, [int], int, discriminator="type")
+        for obj in ({"type": "login", "user": "a"}, {"type": "x", "other": 1}, [1, 2], 3):
+            obiwan.duckable(obj, template)
+        with self.assertRaisesRegex(obiwan.ObiwanError, "^checking should have child called reason$"):
+            obiwan.duckable({"type": "logout", "user": "a"}, template)  # the tagged alternative's own error
+        for obj in ({"type": "x"}, [1, "a"], 2.5, {"user": 1}):
+            with self.assertRaisesRegex(obiwan.ObiwanError, "but should be one of union"):
+                obiwan.duckable(obj, template)
+        tagged = obiwan.union({"type": "login", "user": str}, {"type": "logout"}, discriminator="type")
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"^checking\[\"type\"\] is 'x' but should be one of login, logout$"):
+            obiwan.duckable({"type": "x"}, tagged)
+        with self.assertRaisesRegex(obiwan.ObiwanError, "should have child called type"):
+            obiwan.duckable({}, tagged)
+        with self.assertRaisesRegex(obiwan.ObiwanError, "more than one alternative"):
+            obiwan.duckable({}, obiwan.union({"type": "a"}, {"type": "a"}, discriminator="type"))
+        self.assertEqual([e.path for e in obiwan.validate({"type": "logout", "user": 1}, template)],
+                         [("user",), ()])
+        # sets are dispatched by type too
+        self.assertTrue(obiwan.is_duckable(True, {str, int}))
+        self.assertTrue(obiwan.is_duckable(None, {str, None}))
+        self.assertFalse(obiwan.is_duckable(1.5, {str, int}))
+        mock = unittest.mock.Mock(spec=str)
+        self.assertTrue(obiwan.is_duckable(mock, {str, bytes}))
+
+    def test_dict_index(self):
+        base = {"id": int}
+        template = {obiwan.options: [obiwan.strict, obiwan.subtype(base)], "name": str}
+        obiwan.duckable({"id": 1, "name": "a"}, template)
+        base["extra"] = str  # the template is indexed again
+        with self.assertRaisesRegex(obiwan.ObiwanError, "should have child called extra"):
+            obiwan.duckable({"id": 1, "name": "a"}, template)
+        template["more"] = int
+        obiwan.duckable({"id": 1, "name": "a", "extra": "x", "more": 2}, template)
+        with self.assertRaisesRegex(obiwan.ObiwanError, "should not have a child called zz"):
+            obiwan.duckable({"id": 1, "name": "a", "extra": "x", "more": 2, "zz": 3}, template)
+        generic = {obiwan.options: [obiwan.strict], str: int}
+        obiwan.duckable({"a": 1, "b": 2}, generic)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r'checking\["b"\] is <class .str.> but should be <class .int.>'):
+            obiwan.duckable({"a": 1, "b": "x"}, generic)
+        with self.assertRaisesRegex(obiwan.ObiwanError, r"checking\[2\] is <class .int.> but should be <class .str.>"):
+            obiwan.duckable({"a": 1, 2: 3}, generic)
+
+    def test_duck_class_cache(self):
+        template = obiwan.duck(name=str, get_name=obiwan.function(...))
+
+        class Person:
+            name = "anon"
+
+            def get_name(self) -> str:
+                return self.name
+
+        obiwan.duckable(Person(), template)
+        obiwan.duckable(Person(), template)  # from the per-class cache
+        shadowed = Person()
+        shadowed.name = 1
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.duckable(shadowed, template)
+        Person.get_name = 42  # the class changed, so it is checked again
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.duckable(Person(), template)
+        del Person.get_name
+        with self.assertRaisesRegex(obiwan.ObiwanError, "does not have a get_name"):
+            obiwan.duckable(Person(), template)
+
+        template = obiwan.duck(tags=[str])
+
+        class Tagged:
+            tags = ["a"]
+
+        obiwan.duckable(Tagged(), template)
+        Tagged.tags.append(1)  # changed in place, so it isn't remembered
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.duckable(Tagged(), template)
+
+    def test_function_cache(self):
+        template = obiwan.function(int)
+
+        def callback(a: int):
+            pass
+
+        obiwan.duckable(callback, template)
+        obiwan.duckable(callback, template)
+        self.assertIn(callback, template._passed)
+        callback.__code__ = (lambda a, b: None).__code__
+        with self.assertRaises(obiwan.ObiwanError):
+            obiwan.duckable(callback, template)
+
+        class Handler:
+            def handle(self, a: int):
+                pass
+
+        method = obiwan.function(any, int)
+        obiwan.duckable(Handler().handle, method)
+        obiwan.duckable(Handler().handle, method)
+        self.assertIn(Handler.handle, method._passed_bound)